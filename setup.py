@@ -40,6 +40,12 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'lmdb': ['lmdb'],
+        'arrow': ['pyarrow'],
+    },
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -1,3 +1,9 @@
 # -*- coding: utf-8 -*-
 
 """Unit test package for tusharedb."""
+import os
+import tempfile
+
+# 测试使用临时数据库，必须在导入 tusharedb.db 之前设置
+os.environ.setdefault('LEVEL_DB_NAME', tempfile.mkdtemp(prefix='tusharedb-test-'))
+os.environ.setdefault('TS_TOKEN', 'test')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.adjust`."""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import adjust
+
+
+def FORMAT(x): return float('%.2f' % x)
+
+
+class TestRoundPrice(unittest.TestCase):
+
+    def assertFormat(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        expected = np.array([FORMAT(x) for x in values])
+        np.testing.assert_array_equal(adjust.round_price(values), expected)
+
+    def test_ties(self):
+        # 二进制表示离 .5 边界很近的值，np.rint(x * 100) 与字符串格式化不同
+        self.assertFormat([1.005, 2.675, 1.115, 0.125, 0.375, 10.005, 1234.565,
+                           -1.005, -2.675, -0.125, 0.005, 0.015, 0.025])
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        prices = np.round(rng.random_sample(100000) * 100, 2)
+        factors = rng.random_sample(100000) * 50 + 1
+        self.assertFormat(prices * factors)
+        self.assertFormat(prices * factors / factors[::-1])
+        # 正好落在 .xx5 上的值
+        self.assertFormat(np.round(rng.random_sample(100000) * 1000, 3))
+
+    def test_special(self):
+        values = adjust.round_price([np.nan, np.inf, -np.inf, 0., -0.001, 1e12 + 0.005])
+        np.testing.assert_array_equal(values, [np.nan, np.inf, -np.inf, 0., -0., FORMAT(1e12 + 0.005)])
+
+    def test_shape(self):
+        values = np.arange(12, dtype=np.float64).reshape(3, 4) / 7
+        got = adjust.round_price(values)
+        self.assertEqual(got.shape, (3, 4))
+        np.testing.assert_array_equal(got.ravel(), [FORMAT(x) for x in values.ravel()])
+
+
+class TestQfqBase(unittest.TestCase):
+    '''
+    qfq 以 adj_factor 序列中最新的因子为基准，即使最后几天没有行情(停牌)
+    '''
+
+    def setUp(self):
+        self.bars = pd.DataFrame({'ts_code': ['A', 'A', 'B', 'B'],
+                                  'trade_date': ['20190103', '20190102', '20190103', '20190102'],
+                                  'close': [10., 11., 20., 21.],
+                                  'adj_factor': [2., 1., 3., 3.]})
+        # A 在 20190104 之后停牌，期间除权
+        self.fcts = pd.DataFrame({'ts_code': ['A', 'A', 'A', 'B', 'B'],
+                                  'trade_date': ['20190107', '20190103', '20190102', '20190103', '20190102'],
+                                  'adj_factor': [4., 2., 1., 3., 3.]})
+
+    def test_base_factor(self):
+        self.assertEqual(adjust.base_factor(self.fcts), {'A': 4., 'B': 3.})
+        self.assertEqual(adjust.base_factor(self.fcts[self.fcts['ts_code'] == 'A'][
+            ['trade_date', 'adj_factor']]), 4.)
+        self.assertIsNone(adjust.base_factor(self.fcts.iloc[:0]))
+
+    def test_same_as_pro_bar(self):
+        got = adjust.adjust(self.bars, 'qfq', base=adjust.base_factor(self.fcts))
+        # pro_bar: 价格 * adj_factor / adj_factor 序列的第一个(最新的)因子
+        self.assertEqual(list(got['close']), [FORMAT(10. * 2 / 4), FORMAT(11. * 1 / 4), 20., 21.])
+
+        one = self.bars[self.bars['ts_code'] == 'A'].drop('ts_code', axis=1)
+        got = adjust.adjust(one, 'qfq', base=float(self.fcts['adj_factor'][0]))
+        self.assertEqual(list(got['close']), [5., 2.75])
+
+    def test_default_base(self):
+        # 没有基准或缺少某个代码时使用 df 中最新的因子
+        got = adjust.adjust(self.bars, 'qfq')
+        self.assertEqual(list(got['close']), [10., 5.5, 20., 21.])
+        got = adjust.adjust(self.bars, 'qfq', base={'B': 3.})
+        self.assertEqual(list(got['close']), [10., 5.5, 20., 21.])
+
+
+if __name__ == '__main__':
+    unittest.main()
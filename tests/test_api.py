@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.api`."""
+import unittest
+
+import pandas as pd
+
+from tusharedb import api as tsapi
+from tusharedb import cache, config, db
+from tusharedb.api import DataApi
+
+CODE = '000001.SZ'
+MISSING = '999999.SZ'
+
+
+def _bars(code, dates, close):
+    return pd.DataFrame({'ts_code': code, 'trade_date': [str(d) for d in dates],
+                         'close': close})
+
+
+class _Pro:
+    '''
+    记录请求的 tushare pro_api
+    '''
+
+    def __init__(self):
+        self.calls = []
+
+    def query(self, api_name, **kwargs):
+        self.calls.append((api_name, kwargs))
+        return _bars(kwargs.get('ts_code'), [20190102], [9.])
+
+
+class TestQueryFallback(unittest.TestCase):
+    '''
+    本地没有的 key 从 tushare 获取
+    '''
+
+    def setUp(self):
+        self.history, self.recent = [
+            db.dbs[c](CODE) for c in config.get_api_db('daily', config.API_TYPE_TS_CODE)]
+        self.history.replace(_bars(CODE, [20190104, 20190103], [1., 2.]))
+        self.api = DataApi(query_cache=cache.DataFrameCache(0))
+        self.api.pro = _Pro()
+
+    def tearDown(self):
+        self.history.delete()
+        self.recent.delete()
+
+    def test_local(self):
+        df = self.api.daily(ts_code=CODE)
+        self.assertEqual(list(df['close']), [1., 2.])
+        self.assertEqual(self.api.pro.calls, [])
+
+    def test_missing_code(self):
+        df = self.api.daily(ts_code=MISSING)
+        self.assertEqual(list(df['close']), [9.])
+        self.assertEqual(self.api.pro.calls, [('daily', {'ts_code': MISSING})])
+
+    def test_missing_single_store(self):
+        # index_daily 只有一个存储
+        df = self.api.index_daily(ts_code=MISSING, start_date='20190101')
+        self.assertEqual(list(df['close']), [9.])
+        self.assertEqual(len(self.api.pro.calls), 1)
+
+    def test_empty_manifest(self):
+        # 清单中没有行的存储不能代表本地有数据
+        stores = [db.dbs[c](MISSING) for c in config.get_api_db('daily', config.API_TYPE_TS_CODE)]
+        for store in stores:
+            store.replace(_bars(MISSING, [], []))
+        try:
+            df = self.api.daily(ts_code=MISSING, start_date='20190101')
+        finally:
+            for store in stores:
+                store.delete()
+        self.assertEqual(list(df['close']), [9.])
+
+    def test_out_of_range(self):
+        # 本地有数据，日期范围内没有时返回空表，不请求 tushare
+        df = self.api.daily(ts_code=CODE, start_date='20200101')
+        self.assertTrue(df.empty)
+        self.assertEqual(self.api.pro.calls, [])
+
+    def test_local_only(self):
+        self.assertIsNone(self.api.query('daily_qfq', ts_code=MISSING))
+        self.assertEqual(self.api.pro.calls, [])
+
+
+class TestAdjDaily(unittest.TestCase):
+    '''
+    qfq 的基准是 adj_factor 中最新的因子，最后几天停牌时与行情中最新的因子不同
+    '''
+
+    def setUp(self):
+        self.qfq = db.dbs[config.DT_CODE_QFQ](CODE)
+        self.qfq.replace(pd.DataFrame({'ts_code': CODE, 'trade_date': ['20190103', '20190102'],
+                                       'close': [20., 11.], 'adj_factor': [2., 1.]}))
+        self.fcts = db.dbs[config.DT_CODE_ADJFACTOR](CODE)
+        self.fcts.replace(pd.DataFrame({'ts_code': CODE, 'trade_date': ['20190107', '20190103', '20190102'],
+                                        'adj_factor': [4., 2., 1.]}))
+        self.cache = tsapi.api.cache
+        tsapi.api.cache = cache.DataFrameCache(0)
+
+    def tearDown(self):
+        tsapi.api.cache = self.cache
+        self.qfq.delete()
+        self.fcts.delete()
+
+    def test_base_after_last_bar(self):
+        df = tsapi.adj_daily(CODE, start_date='20190101', end_date='20190110')
+        self.assertEqual(list(df['close']), [5., 2.75])
+        # 范围内没有之后的因子时以最后一个交易日为基准
+        df = tsapi.adj_daily(CODE, start_date='20190101', end_date='20190104')
+        self.assertEqual(list(df['close']), [10., 5.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.backend`."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from tusharedb import backend
+
+
+@unittest.skipIf(backend.lmdb is None, 'lmdb is not installed')
+class TestLmdbBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = backend.open_backend(os.path.join(self.path, 'lmdb'), backend.BACKEND_LMDB,
+                                       map_size=1 << 24)
+        for key in (b'a:1', b'a:2', b'a:3', b'b:1'):
+            self.db.put(key, key.upper())
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path)
+
+    def test_get_put_delete(self):
+        self.assertEqual(self.db.get(b'a:1'), b'A:1')
+        self.assertIsInstance(self.db.get(b'a:1'), bytes)
+        self.db.delete(b'a:1')
+        self.assertIsNone(self.db.get(b'a:1'))
+        self.assertIsNone(self.db.get(b'c'))
+
+    def test_iterator(self):
+        with self.db.iterator(prefix=b'a:') as it:
+            self.assertEqual(list(it), [(b'a:1', b'A:1'), (b'a:2', b'A:2'), (b'a:3', b'A:3')])
+        with self.db.iterator(prefix=b'a:', include_value=False) as it:
+            it.seek(b'a:2')
+            self.assertEqual(list(it), [b'a:2', b'a:3'])
+        with self.db.iterator(prefix=b'a:', include_key=False) as it:
+            # seek 到 prefix 之前时从 prefix 开始
+            it.seek(b'')
+            self.assertEqual(next(it), b'A:1')
+        with self.db.iterator(prefix=b'c') as it:
+            self.assertEqual(list(it), [])
+
+    def test_write_batch(self):
+        with self.db.write_batch() as wb:
+            wb.put(b'c', b'C')
+            wb.delete(b'b:1')
+        self.assertEqual(self.db.get(b'c'), b'C')
+        self.assertIsNone(self.db.get(b'b:1'))
+
+        # 异常时整个 batch 丢弃
+        with self.assertRaises(IOError):
+            with self.db.write_batch() as wb:
+                wb.put(b'd', b'D')
+                wb.delete(b'c')
+                raise IOError('write failed')
+        self.assertIsNone(self.db.get(b'd'))
+        self.assertEqual(self.db.get(b'c'), b'C')
+
+    def test_snapshot(self):
+        snap = self.db.snapshot()
+        try:
+            with self.db.write_batch() as wb:
+                wb.put(b'a:1', b'new')
+                wb.put(b'a:4', b'A:4')
+            self.db.delete(b'a:2')
+            self.assertEqual(snap.get(b'a:1'), b'A:1')
+            with snap.iterator(prefix=b'a:', include_value=False) as it:
+                self.assertEqual(list(it), [b'a:1', b'a:2', b'a:3'])
+        finally:
+            snap.close()
+        self.assertEqual(self.db.get(b'a:1'), b'new')
+
+    def test_migrate(self):
+        src = backend.open_backend(os.path.join(self.path, 'leveldb'), backend.BACKEND_LEVELDB)
+        try:
+            keys = [b'k:%04d' % i for i in range(25)]
+            for key in keys:
+                src.put(key, key * 2)
+            self.assertEqual(backend.migrate(src, self.db, batch_size=10), len(keys))
+        finally:
+            src.close()
+        for key in keys:
+            self.assertEqual(self.db.get(key), key * 2)
+        # 目标中已有的 key 保留
+        self.assertEqual(self.db.get(b'b:1'), b'B:1')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            backend.open_backend(os.path.join(self.path, 'x'), 'rocksdb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.cache`."""
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from tusharedb import cache, config, db
+from tusharedb.api import DataApi
+
+CODE = '000001.SZ'
+
+
+def _frame(n):
+    return pd.DataFrame({'close': [float(i) for i in range(n)]})
+
+
+class TestDataFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.size = cache.df_size(_frame(10))
+        self.cache = cache.DataFrameCache(self.size * 2)
+
+    def test_evict_by_size(self):
+        for key in 'abc':
+            self.cache.put(key, _frame(10), [key])
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertEqual(self.cache.info().currsize, self.size * 2)
+
+        # 最近读取的保留，淘汰最久没有使用的
+        self.cache.put('d', _frame(10), ['d'])
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertIsNone(self.cache.get('c'))
+
+        # 超过 maxsize 的不缓存
+        self.cache.put('big', _frame(100), ['big'])
+        self.assertIsNone(self.cache.get('big'))
+        self.assertEqual(self.cache.info().currsize, self.size * 2)
+
+    def test_replace_key(self):
+        self.cache.put('a', _frame(10), ['a'])
+        self.cache.put('a', _frame(10), ['a'])
+        self.assertEqual(self.cache.info().currsize, self.size)
+
+    def test_disabled(self):
+        off = cache.DataFrameCache(0)
+        off.put('a', _frame(1), ['a'])
+        self.assertIsNone(off.get('a'))
+        self.assertEqual(off.info().currsize, 0)
+
+    def test_invalidate(self):
+        self.cache.put('a', _frame(1), [b'ts:code:bfq:000001.SZ:'])
+        self.cache.put('b', _frame(1), [b'ts:code:bfq:000002.SZ:'])
+        self.cache.invalidate(b'ts:code:bfq:000001.SZ:')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        # 清空整个数据类型时前缀更短
+        self.cache.invalidate(b'ts:code:bfq:')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.info().currsize, 0)
+
+
+class TestInvalidateOnAppend(unittest.TestCase):
+    '''
+    append 之后 DataApi 不会返回旧的缓存
+    '''
+
+    def setUp(self):
+        self.db = db.dbs[config.DT_CODE_QFQ](CODE)
+        self.db.replace(pd.DataFrame({'ts_code': CODE, 'trade_date': ['20190103', '20190102'],
+                                      'close': [1., 2.], 'adj_factor': [1., 1.]}))
+        self.cache = cache.DataFrameCache(1 << 20)
+
+    def tearDown(self):
+        self.db.delete()
+
+    def test_append(self):
+        with mock.patch.object(cache, 'query_cache', self.cache):
+            api = DataApi(query_cache=self.cache)
+            self.assertEqual(len(api.query('daily_qfq', ts_code=CODE)), 2)
+            self.assertEqual(len(api.query('daily_qfq', ts_code=CODE)), 2)
+            self.assertEqual(self.cache.info().hits, 1)
+
+            self.db.append(pd.DataFrame({'ts_code': CODE, 'trade_date': ['20190104'],
+                                         'close': [3.], 'adj_factor': [1.]}))
+            self.assertEqual(self.cache.info().currsize, 0)
+            df = api.query('daily_qfq', ts_code=CODE)
+            self.assertEqual(list(df['close']), [3., 1., 2.])
+
+
+if __name__ == '__main__':
+    unittest.main()
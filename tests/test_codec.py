@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.codec`."""
+import pickle
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import codec, db
+
+COMPRESSIONS = (None,) + codec.COMPRESSIONS
+
+
+def _spec(encoding, compression):
+    return '+'.join(p for p in (encoding, compression) if p) or None
+
+
+class TestEncodeArray(unittest.TestCase):
+
+    def setUp(self):
+        self.arrays = {
+            'raw': (None, np.arange(50, dtype=np.float64) / 3),
+            'raw_int': (None, np.arange(50, dtype=np.int32)),
+            'pickle': (None, np.array(['%s.SZ' % i for i in range(50)], dtype=object)),
+            'dict': ('dict', np.array(['SH', 'SZ', None, 'SH', 'BJ'] * 10, dtype=object)),
+            'delta': ('delta', np.arange(20190101, 20190151, dtype=np.int32)),
+            'delta_str': ('delta', np.array([str(20190101 + i) for i in range(50)], dtype=object)),
+        }
+
+    def assertArrayEqual(self, got, expected):
+        self.assertEqual(got.dtype, expected.dtype)
+        np.testing.assert_array_equal(got, expected)
+
+    def test_round_trip(self):
+        for name, (encoding, values) in self.arrays.items():
+            for compression in COMPRESSIONS:
+                with self.subTest(name=name, compression=compression):
+                    data = codec.encode_array(values, _spec(encoding, compression))
+                    self.assertTrue(codec.is_encoded(data))
+                    self.assertArrayEqual(codec.decode_array(data), values)
+
+    def test_rows(self):
+        for name, (encoding, values) in self.arrays.items():
+            for compression in COMPRESSIONS:
+                data = codec.encode_array(values, _spec(encoding, compression))
+                for rows in (slice(0, 1), slice(5, 17), slice(40, None), np.array([3, 0, 49])):
+                    with self.subTest(name=name, compression=compression, rows=rows):
+                        self.assertArrayEqual(codec.decode_array(data, rows=rows), values[rows])
+
+    def test_raw_is_read_only_view(self):
+        values = np.arange(10, dtype=np.float64)
+        arr = codec.decode_array(codec.encode_array(values))
+        self.assertFalse(arr.flags.writeable)
+
+    def test_legacy_pickle(self):
+        for _, values in self.arrays.values():
+            data = pickle.dumps(values)
+            self.assertFalse(codec.is_encoded(data))
+            self.assertArrayEqual(codec.decode_array(data), values)
+            self.assertArrayEqual(codec.decode_array(data, rows=slice(2, 5)), values[2:5])
+
+        index = pd.Index(['a', 'b', 'c'])
+        self.assertTrue(codec.decode_index(pickle.dumps(index)).equals(index))
+
+    def test_empty(self):
+        for encoding in (None, 'dict', 'delta'):
+            for dtype in (object, np.int32, np.float64):
+                values = np.array([], dtype=dtype)
+                with self.subTest(encoding=encoding, dtype=dtype):
+                    data = codec.encode_array(values, _spec(encoding, 'zlib'))
+                    self.assertArrayEqual(codec.decode_array(data), values)
+
+    def test_index(self):
+        for index in (pd.RangeIndex(5), pd.RangeIndex(3, 13, 2), pd.RangeIndex(0),
+                      pd.Index([20190103, 20190102])):
+            with self.subTest(index=index):
+                got = codec.decode_index(codec.encode_index(index))
+                self.assertTrue(got.equals(index))
+        got = codec.decode_index(codec.encode_index(pd.RangeIndex(3, 13, 2)), rows=slice(1, 3))
+        self.assertEqual(list(got), [5, 7])
+
+
+class TestCodecs(unittest.TestCase):
+
+    def _header(self, data):
+        return codec._unpack(data)[0]
+
+    def test_dict(self):
+        values = np.array(['SH', 'SZ', None, 'SH'] * 10, dtype=object)
+        data = codec.encode_array(values, 'dict')
+        self.assertEqual(self._header(data)['codec'], codec.CODEC_DICT)
+        np.testing.assert_array_equal(codec.decode_array(data), values)
+
+        got = codec.decode_array(data, as_category=True)
+        self.assertIsInstance(got, pd.Categorical)
+        self.assertEqual(list(got.categories), ['SH', 'SZ'])
+        self.assertTrue(pd.isna(got[2]))
+        self.assertEqual(list(codec.decode_array(data, as_category=True, rows=slice(0, 2))),
+                         ['SH', 'SZ'])
+
+    def test_dict_fallback(self):
+        # 高基数或非字符串的列退回 pickle
+        for values in (np.array(['%s' % i for i in range(10)], dtype=object),
+                       np.array([1, 'a'] * 10, dtype=object)):
+            data = codec.encode_array(values, 'dict')
+            self.assertEqual(self._header(data)['codec'], codec.CODEC_PICKLE)
+            np.testing.assert_array_equal(codec.decode_array(data), values)
+
+    def test_delta(self):
+        for values in (np.array([20190104, 20190103, 20180102], dtype=np.int32),
+                       np.array([0, 2 ** 40, -2 ** 40], dtype=np.int64),
+                       np.array(['20190104', '20190103'], dtype=object)):
+            data = codec.encode_array(values, 'delta')
+            self.assertEqual(self._header(data)['codec'], codec.CODEC_DELTA)
+            got = codec.decode_array(data)
+            self.assertEqual(got.dtype, values.dtype)
+            np.testing.assert_array_equal(got, values)
+
+    def test_delta_fallback(self):
+        # 前导 0 的字符串不能还原，浮点数不能做差分
+        for values in (np.array(['000001', '000002'], dtype=object),
+                       np.array([1.5, 2.5])):
+            data = codec.encode_array(values, 'delta')
+            self.assertNotEqual(self._header(data)['codec'], codec.CODEC_DELTA)
+            np.testing.assert_array_equal(codec.decode_array(data), values)
+
+    def _round_trip(self, compression, expected):
+        values = np.repeat(np.arange(100, dtype=np.float64), 10)
+        data = codec.encode_array(values, 'raw+%s' % compression)
+        self.assertEqual(self._header(data)['compression'], expected)
+        self.assertLess(len(data), values.nbytes)
+        np.testing.assert_array_equal(codec.decode_array(data), values)
+
+    @unittest.skipIf(codec.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self._round_trip('zstd', 'zstd')
+
+    @unittest.skipIf(codec.lz4_frame is None, 'lz4 is not installed')
+    def test_lz4(self):
+        self._round_trip('lz4', 'lz4')
+
+    def test_zlib(self):
+        self._round_trip('zlib', 'zlib')
+
+    def test_zlib_fallback(self):
+        saved = codec.zstandard, codec.lz4_frame
+        codec.zstandard = codec.lz4_frame = None
+        try:
+            for compression in ('zstd', 'lz4'):
+                with self.subTest(compression=compression):
+                    self._round_trip(compression, 'zlib')
+        finally:
+            codec.zstandard, codec.lz4_frame = saved
+
+
+class TestEmptyFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.db = db.StockBasicDb()
+        self.db.delete()
+
+    def tearDown(self):
+        self.db.delete()
+
+    def test_empty_frame(self):
+        df = pd.DataFrame({'ts_code': pd.Series([], dtype=object),
+                           'close': pd.Series([], dtype=np.float64)})
+        self.db.replace(df)
+        got = self.db.read()
+        self.assertTrue(got.empty)
+        self.assertEqual(sorted(got.columns), ['close', 'ts_code'])
+        self.assertEqual(got['close'].dtype, np.float64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.dataset`."""
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from tusharedb import config, dataset, db
+
+
+@unittest.skipIf(dataset.pa is None, 'pyarrow is not installed')
+class TestRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.news = {
+            '20190102': pd.DataFrame({'datetime': ['2019-01-02 09:00:00', '2019-01-02 10:00:00'],
+                                      'content': ['a', 'b']}),
+            '20190103': pd.DataFrame({'datetime': ['2019-01-03 09:00:00'], 'content': ['c']}),
+        }
+        self.bars = {
+            date: pd.DataFrame({'ts_code': ['000001.SZ', '000002.SZ'],
+                                'trade_date': [date, date], 'close': [1., 2.]})
+            for date in ('20190102', '20190103')
+        }
+        self.types = [config.DT_NEWS, config.DT_DAILY_BFQ]
+        db.dbs[config.DT_NEWS].save_many(self.news)
+        db.dbs[config.DT_DAILY_BFQ].save_many(self.bars)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+        for data_type in self.types:
+            db.dbs[data_type].clear()
+
+    def _read_all(self, data_type):
+        dbcls = db.dbs[data_type]
+        return {key: dbcls(key).read() for key in dbcls.list_keys()}
+
+    def test_round_trip(self):
+        for fmt in dataset.FORMATS:
+            with self.subTest(fmt=fmt):
+                before = {t: self._read_all(t) for t in self.types}
+                self.assertEqual(dataset.export(self.dest, fmt, self.types, full=True), 2)
+                for data_type in self.types:
+                    db.dbs[data_type].clear()
+
+                self.assertEqual(dataset.import_dataset(self.dest, fmt, self.types), 2)
+                for data_type in self.types:
+                    after = self._read_all(data_type)
+                    self.assertEqual(sorted(after), sorted(before[data_type]))
+                    for key, df in after.items():
+                        self.assertNotIn(dataset.KEY_COL, df)
+                        pd.testing.assert_frame_equal(df, before[data_type][key])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.db`."""
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import cache, config, db
+from tusharedb.api import DataApi
+
+CODE = '000001.SZ'
+
+
+def _bars(dates, close):
+    return pd.DataFrame({'ts_code': CODE, 'trade_date': [str(d) for d in dates],
+                         'close': close})
+
+
+def _expected(*dfs):
+    '''
+    逐个 upsert 的结果，trade_date 降序
+    '''
+    df = pd.concat(dfs).drop_duplicates('trade_date', keep='last')
+    df = df.sort_values('trade_date', ascending=False)
+    df['trade_date'] = df['trade_date'].astype(np.int32)
+    return df.reset_index(drop=True)
+
+
+class TestPartitionedDfDb(unittest.TestCase):
+
+    def setUp(self):
+        self.db = db.dbs[config.DT_CODE_QFQ](CODE)
+        self.db.delete()
+        self.first = _bars([20190104, 20190103, 20180103, 20180102], [1., 2., 3., 4.])
+
+    def tearDown(self):
+        self.db.delete()
+
+    def assertFrame(self, got, expected):
+        # ts_code 按 schema 读取为 category
+        got = got[list(expected.columns)].astype({'ts_code': object})
+        pd.testing.assert_frame_equal(got, expected.astype({'ts_code': object}))
+
+    def test_append(self):
+        self.db.replace(self.first)
+        second = _bars([20190107, 20190103, 20170103], [5., 6., 7.])
+        self.db.append(second)
+
+        chunks = self.db.chunks()
+        self.assertEqual(sorted(chunks), ['2017', '2018', '2019'])
+        self.assertEqual(chunks['2019']['segments'], 1)
+        self.assertEqual(chunks['2018']['segments'], 0)
+        got = self.db.read()
+        self.assertTrue(got.index.equals(pd.RangeIndex(len(got))))
+        self.assertFrame(got, _expected(self.first, second))
+
+        got = self.db.read(['close'], start_date='20180103', end_date='20190103')
+        self.assertEqual(list(got['close']), [6., 3.])
+
+    def test_append_rewrites_chunk(self):
+        self.db.replace(self.first)
+        dfs = [self.first]
+        for i in range(config.MAX_SEGMENTS + 1):
+            dfs.append(_bars([20190110 + i, 20190103], [10. + i, 20. + i]))
+            self.db.append(dfs[-1])
+        self.assertEqual(self.db.chunks()['2019']['segments'], 0)
+        self.assertFrame(self.db.read(), _expected(*dfs))
+
+    def test_compact(self):
+        self.db.replace(self.first)
+        second = _bars([20190107, 20190103], [5., 6.])
+        self.db.append(second)
+        self.db.append(_bars([20190108], [8.]))
+        before = self.db.read()
+
+        self.db.compact()
+        self.assertTrue(all(c['segments'] == 0 for c in self.db.chunks().values()))
+        self.assertEqual(self.db.meta()['rows'], len(before))
+        pd.testing.assert_frame_equal(self.db.read(), before)
+
+    def test_save_rewrites_chunk(self):
+        self.db.replace(self.first)
+        self.db.append(_bars([20190107, 20190103], [5., 6.]))
+        self.db.save(_bars([20190110], [9.]))
+
+        self.assertFalse([k for k in self.db.keys() if b':s' in k])
+        self.assertEqual(list(self.db.read()['close']), [9., 3., 4.])
+
+
+class TestMergeSegments(unittest.TestCase):
+
+    def _frame(self, dates, close):
+        return pd.DataFrame({'trade_date': np.array(dates, dtype=np.int32), 'close': close})
+
+    def test_overlapping_dates(self):
+        a = self._frame([20190105, 20190103, 20190101], [1., 2., 3.])
+        b = self._frame([20190104, 20190103, 20190102], [4., 5., 6.])
+        c = self._frame([20190106, 20190101], [7., 8.])
+        df = db.merge_segments([a, b, c])
+        self.assertEqual(list(df['trade_date']),
+                         [20190106, 20190105, 20190104, 20190103, 20190102, 20190101])
+        # 重复的日期保留后面的 segment
+        self.assertEqual(list(df['close']), [7., 1., 4., 5., 6., 8.])
+
+    def test_disjoint_dates(self):
+        a = self._frame([20180105, 20180103], [1., 2.])
+        b = self._frame([20190104, 20190102], [3., 4.])
+        df = db.merge_segments([a, b])
+        self.assertEqual(list(df['close']), [3., 4., 1., 2.])
+
+    def test_requires_trade_date(self):
+        a = self._frame([20190105], [1.])[['close']]
+        with self.assertRaises(ValueError):
+            db.merge_segments([a, a])
+
+
+class TestMergeTwo(unittest.TestCase):
+    '''
+    线性归并与整体排序去重的结果相同
+    '''
+
+    def _segment(self, rng, i):
+        dates = np.sort(rng.choice(np.arange(20190101, 20190161), 20, replace=False))[::-1]
+        return pd.DataFrame({'trade_date': dates.astype(np.int32),
+                             'close': np.full(len(dates), float(i))})
+
+    def _reference(self, dfs):
+        df = pd.concat(dfs, ignore_index=True)
+        df = df.sort_values('trade_date', ascending=False, kind='mergesort')
+        return df.drop_duplicates('trade_date', keep='last').reset_index(drop=True)
+
+    def test_merge_two(self):
+        rng = np.random.RandomState(0)
+        a, b = self._segment(rng, 0), self._segment(rng, 1)
+        df = db._merge_two(a, b)
+        self.assertTrue(df['trade_date'].is_monotonic_decreasing)
+        self.assertEqual(len(df), len(a) + len(b))
+        pd.testing.assert_frame_equal(db._dedup(df).reset_index(drop=True),
+                                      self._reference([a, b]))
+
+    def test_merge_segments(self):
+        rng = np.random.RandomState(1)
+        for n in (2, 3, 8):
+            dfs = [self._segment(rng, i) for i in range(n)]
+            with self.subTest(n=n):
+                pd.testing.assert_frame_equal(db.merge_segments(dfs).reset_index(drop=True),
+                                              self._reference(dfs))
+
+    def test_dedup_keeps_last(self):
+        df = pd.DataFrame({'trade_date': np.array([3, 2, 2, 2, 1], dtype=np.int32),
+                           'close': [1., 2., 3., 4., 5.]})
+        self.assertEqual(list(db._dedup(df)['close']), [1., 4., 5.])
+
+
+class TestPushdown(unittest.TestCase):
+    '''
+    下推的日期范围和等值条件与读取全部数据后过滤的结果相同
+    '''
+    data_type = 'code:testpushdown'
+
+    @classmethod
+    def setUpClass(cls):
+        config.setup_api('test_pushdown', ts_code_db=cls.data_type,
+                         filters=['start_date', 'end_date', 'exchange'],
+                         schema={'trade_date': config.DTYPE_DATE})
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        dates = pd.bdate_range('2018-01-01', periods=300)[::-1].strftime('%Y%m%d')
+        self.db = db.dbs[self.data_type](CODE)
+        self.db.replace(pd.DataFrame({
+            'trade_date': dates,
+            'exchange': rng.choice(['SSE', 'SZSE', 'BSE'], len(dates)),
+            'close': rng.random_sample(len(dates)),
+        }))
+        self.full = self.db.read()
+
+    def tearDown(self):
+        self.db.delete()
+
+    def _filter(self, start_date=None, end_date=None, exchange=None):
+        df = self.full
+        if start_date:
+            df = df[df['trade_date'] >= int(start_date)]
+        if end_date:
+            df = df[df['trade_date'] <= int(end_date)]
+        if exchange:
+            df = df[df['exchange'] == exchange]
+        return df
+
+    def test_pushdown(self):
+        self.assertIsNotNone(self.db.get(self.db.index_prefix + 'exchange'))
+        cases = [
+            {'start_date': '20180301', 'end_date': '20180601'},
+            {'start_date': '20180301'},
+            {'end_date': '20180301'},
+            {'start_date': '20200101'},
+            {'exchange': 'SZSE'},
+            {'exchange': 'NONE'},
+            {'start_date': '20180301', 'end_date': '20180601', 'exchange': 'BSE'},
+            {'end_date': '20180102', 'exchange': 'SSE'},
+        ]
+        for kwargs in cases:
+            with self.subTest(**kwargs):
+                filters = {'exchange': kwargs['exchange']} if 'exchange' in kwargs else None
+                got = self.db.read(start_date=kwargs.get('start_date'),
+                                   end_date=kwargs.get('end_date'), filters=filters)
+                expected = self._filter(**kwargs)
+                # 空的 object 列不会推断为字符串类型，只比较列名
+                pd.testing.assert_frame_equal(got, expected, check_dtype=not expected.empty)
+
+    def test_pushdown_columns(self):
+        got = self.db.read(['close'], start_date='20180301', end_date='20180601',
+                           filters={'exchange': 'SSE'})
+        expected = self._filter('20180301', '20180601', 'SSE')[['close']]
+        pd.testing.assert_frame_equal(got, expected)
+
+
+class TestMergeStores(unittest.TestCase):
+    '''
+    history 和 recent 两个存储按 trade_date 合并
+    '''
+
+    def setUp(self):
+        self.history, self.recent = [
+            db.dbs[c](CODE) for c in config.get_api_db('daily', config.API_TYPE_TS_CODE)]
+        self.history.replace(_bars([20190104, 20190103, 20190102], [1., 2., 3.]))
+        self.recent.replace(_bars([20190107, 20190104], [4., 5.]))
+        self.api = DataApi(query_cache=cache.DataFrameCache(0))
+
+    def tearDown(self):
+        self.history.delete()
+        self.recent.delete()
+
+    def test_fields_without_trade_date(self):
+        full = self.api.daily(ts_code=CODE)
+        self.assertEqual(list(full['trade_date']), ['20190107', '20190104', '20190103', '20190102'])
+        df = self.api.daily(ts_code=CODE, fields='close')
+        self.assertEqual(list(df.columns), ['close'])
+        self.assertEqual(list(df['close']), [4., 5., 2., 3.])
+        self.assertEqual(list(df['close']), list(full['close']))
+
+
+class TestSaveMany(unittest.TestCase):
+    '''
+    save_many 在同一个 WriteBatch 中提交，中途出错时什么都不写入
+    '''
+
+    def setUp(self):
+        self.aliases = config.get_api_db('daily', config.API_TYPE_TS_CODE)
+        self.stores = [db.dbs[alias](CODE) for alias in self.aliases]
+        self.old = _bars([20190103, 20190102], [1., 2.])
+        for store in self.stores:
+            store.replace(self.old)
+
+    def tearDown(self):
+        for store in self.stores:
+            store.delete()
+
+    def test_fail_partway(self):
+        new = _bars([20190104], [3.])
+        with self.assertRaises(Exception):
+            db.dbs.save_many({(self.aliases[0], CODE): new, (self.aliases[1], CODE): None})
+        for store in self.stores:
+            self.assertEqual(list(store.read()['close']), [1., 2.])
+            self.assertEqual(store.meta()['rows'], 2)
+
+        with self.assertRaises(Exception):
+            db.dbs[self.aliases[0]].save_many({CODE: new, '000002.SZ': None}, 'append')
+        self.assertEqual(list(self.stores[0].read()['close']), [1., 2.])
+        self.assertTrue(db.dbs[self.aliases[0]]('000002.SZ').empty())
+
+    def test_invalidate_on_write(self):
+        query_cache = cache.DataFrameCache(1 << 20)
+        other = db.dbs[self.aliases[0]]('000002.SZ')
+        with mock.patch.object(cache, 'query_cache', query_cache):
+            api = DataApi(query_cache=query_cache)
+            self.assertEqual(list(api.daily(ts_code=CODE)['close']), [1., 2.])
+            query_cache.put('other', self.old, [other.key_prefix])
+            self.assertEqual(list(api.daily(ts_code=CODE)['close']), [1., 2.])
+            self.assertEqual(query_cache.info().hits, 1)
+
+            # 直接写入、save_many 和 Db.batch 都使依赖该前缀的缓存失效
+            self.stores[0].replace(_bars([20190104], [3.]))
+            self.assertEqual(list(api.daily(ts_code=CODE)['close']), [3., 1., 2.])
+            db.save_many([(self.stores[1], _bars([20190107], [4.]))], 'append')
+            self.assertEqual(list(api.daily(ts_code=CODE)['close']), [4., 3., 1., 2.])
+            with self.stores[1].batch() as b:
+                self.stores[1].delete(wb=b)
+            self.assertEqual(list(api.daily(ts_code=CODE)['close']), [3.])
+            self.assertIsNotNone(query_cache.get('other'))
+
+
+class TestSnapshot(unittest.TestCase):
+    '''
+    snapshot() 中的读取不受其他线程同时写入的影响
+    '''
+
+    def setUp(self):
+        self.db = db.dbs[config.DT_CODE_QFQ](CODE)
+        self.db.replace(_bars([20190104, 20190103, 20180102], [1., 2., 3.]))
+
+    def tearDown(self):
+        self.db.delete()
+
+    def _in_thread(self, func):
+        result = {}
+
+        def run():
+            result['value'] = func()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return result['value']
+
+    def test_isolated_from_write(self):
+        with db.snapshot():
+            self.assertEqual(list(self.db.read()['close']), [1., 2., 3.])
+
+            # 其他线程写入新的分区和 segment，并能读到自己写入的结果
+            def write():
+                self.db.append(_bars([20200102, 20190107, 20190103], [4., 5., 6.]))
+                return list(self.db.read()['close'])
+            self.assertEqual(self._in_thread(write), [4., 5., 1., 6., 3.])
+
+            self.assertTrue(db.in_snapshot())
+            self.assertEqual(sorted(self.db.chunks()), ['2018', '2019'])
+            self.assertEqual(list(self.db.read()['close']), [1., 2., 3.])
+            self.assertEqual(list(self.db.read(['close'], start_date='20190101')['close']), [1., 2.])
+
+        self.assertFalse(db.in_snapshot())
+        self.assertEqual(list(self.db.read()['close']), [4., 5., 1., 6., 3.])
+
+    def test_nested(self):
+        with db.snapshot():
+            self._in_thread(lambda: self.db.replace(_bars([20190107], [4.])))
+            with db.snapshot():
+                self.assertEqual(list(self.db.read()['close']), [4.])
+            self.assertEqual(list(self.db.read()['close']), [1., 2., 3.])
+
+
+if __name__ == '__main__':
+    unittest.main()
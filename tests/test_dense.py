@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.dense`."""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from tusharedb import dense
+
+
+def _old_header(shape):
+    '''
+    旧版本 numpy 的 header: 只补齐到 16 字节，没有给 shape 预留空间
+    '''
+    d = "{'descr': '<f8', 'fortran_order': False, 'shape': %r, }" % (shape,)
+    pad = -(10 + len(d) + 1) % 16
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(d) + pad + 1) + \
+        d.encode() + b' ' * pad + b'\n'
+
+
+class TestWriteRows(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'close.npy')
+        rng = np.random.RandomState(0)
+        self.values = rng.random_sample((30, 7))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_in_place(self):
+        dense.write_field(self.path, 'close', 0, self.values[:10])
+        dense.write_field(self.path, 'close', 10, self.values[10:])
+        np.testing.assert_array_equal(np.load(self.filename), self.values)
+
+        # 重写最后几行，文件截断到新的行数
+        dense.write_field(self.path, 'close', 5, self.values[:3])
+        expected = np.concatenate([self.values[:5], self.values[:3]])
+        np.testing.assert_array_equal(np.load(self.filename), expected)
+
+    def test_header_grows(self):
+        head = self.values[:9]
+        with open(self.filename, 'wb') as f:
+            f.write(_old_header(head.shape))
+            f.write(head.tobytes())
+        np.testing.assert_array_equal(np.load(self.filename), head)
+
+        # 行数增加后 header 超过原来的长度，需要整体重写
+        dense.write_field(self.path, 'close', 9, self.values[9:])
+        with open(self.filename, 'rb') as f:
+            _, offset = dense._read_header(f)
+        self.assertNotEqual(offset, len(_old_header(head.shape)))
+        np.testing.assert_array_equal(np.load(self.filename), self.values)
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_expand_codes(self):
+        dense.write_field(self.path, 'close', 0, self.values[:10, :5])
+        dense.write_field(self.path, 'close', 10, self.values[10:])
+        got = np.load(self.filename)
+        self.assertTrue(np.isnan(got[:10, 5:]).all())
+        np.testing.assert_array_equal(got[:10, :5], self.values[:10, :5])
+        np.testing.assert_array_equal(got[10:], self.values[10:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.indicators`."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from tushare.util.formula import EMA, MA
+
+from tusharedb import adjust, dense, indicators
+
+
+def FORMAT(x): return float('%.2f' % x)
+
+
+class TestIndicators(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.close = np.round(np.cumsum(rng.normal(0, 0.5, 7000)) + 500, 2)
+
+    def test_ma_matches_tushare(self):
+        # pro_bar 的 ma 列: 取整后与 tushare MA 逐个相同
+        for n in (5, 10, 20, 60):
+            expected = MA(pd.Series(self.close), n).map(FORMAT).values
+            got = adjust.round_price(indicators.ma(self.close, n))
+            np.testing.assert_array_equal(got, expected)
+
+    def test_ma_panel_matches_columns(self):
+        panel = np.stack([self.close, self.close[::-1]], axis=1)
+        panel[100:103, 1] = np.nan
+        values = indicators.ma(panel, 10)
+        for j in range(2):
+            np.testing.assert_array_equal(values[:, j], indicators.ma(panel[:, j], 10))
+        self.assertTrue(np.isnan(values[100:112, 1]).all())
+
+    def test_ema_matches_tushare(self):
+        values, _ = indicators.ema(self.close, 12)
+        np.testing.assert_allclose(values, EMA(pd.Series(self.close), 12), rtol=1e-12)
+
+    def test_ema_state(self):
+        values, _ = indicators.ema(self.close, 12)
+        head, state = indicators.ema(self.close[:4000], 12, save_at=3000)
+        tail, _ = indicators.ema(self.close[3000:], 12, state)
+        np.testing.assert_allclose(tail, values[3000:], rtol=1e-12)
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        self.close = rng.random_sample((120, 4)) * 10 + 10
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, rows, codes, close):
+        np.save(os.path.join(self.path, 'dates.npy'), 20190101 + np.arange(rows, dtype=np.int32))
+        np.save(os.path.join(self.path, 'codes.npy'), np.array(codes))
+        np.save(os.path.join(self.path, 'close.npy'), close[:rows])
+
+    def _full(self, spec):
+        return {name: indicators._float(dense.load(name, self.path).values)
+                for name in spec}
+
+    def test_incremental(self):
+        spec = {'ma5': ('ma', ['close'], 5), 'ema5': ('ema', ['close'], 5)}
+        codes = ['A.SH', 'B.SH', 'C.SH', 'D.SH']
+        self._write(100, codes, self.close)
+        indicators.update(self.path, spec)
+        self._write(120, codes, self.close)
+        counts = indicators.update(self.path, spec, refresh=2)
+        self.assertEqual(counts, {'ma5': 22, 'ema5': 22})
+        incremental = self._full(spec)
+        indicators.update(self.path, spec, full=True)
+        for name, values in self._full(spec).items():
+            np.testing.assert_allclose(incremental[name], values, rtol=1e-12)
+
+    def test_codes_reordered(self):
+        # dense.update(full=True) 重新排序代码后，不能沿用按位置保存的状态
+        spec = {'ma5': ('ma', ['close'], 5), 'ema5': ('ema', ['close'], 5)}
+        self._write(100, ['A.SH', 'B.SH', 'C.SH', 'D.SH'], self.close)
+        indicators.update(self.path, spec)
+        close = self.close[:, [0, 3, 1, 2]]
+        self._write(110, ['A.SH', 'AB.SH', 'B.SH', 'C.SH'], close)
+        counts = indicators.update(self.path, spec)
+        self.assertEqual(counts, {'ma5': 110, 'ema5': 110})
+        np.testing.assert_array_equal(dense.load('ma5', self.path).values[:, 2],
+                                      indicators.ma(close[:110, 2], 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
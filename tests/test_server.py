@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.server`."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pandas as pd
+
+from tusharedb import cache, config, db, server
+from tusharedb.api import DataApi
+
+CODE = '000001.SZ'
+
+
+class TestServer(unittest.TestCase):
+    '''
+    客户端模式的结果与本地查询相同，包括列类型
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bars = db.dbs[config.DT_CODE_BFQ](CODE)
+        cls.bars.replace(pd.DataFrame({'ts_code': CODE, 'trade_date': ['20190103', '20190102'],
+                                       'close': [1., 2.]}))
+        cls.basic = db.dbs[config.DT_NORMAL_STOCK_BASIC]()
+        cls.basic.replace(pd.DataFrame({'ts_code': [CODE, '000002.SZ'], 'name': ['平安银行', '万科A'],
+                                        'exchange': ['SZSE', 'SZSE'], 'list_status': ['L', 'L'],
+                                        'is_hs': ['S', None]}))
+
+        cls.dir = tempfile.mkdtemp()
+        cls.address = os.path.join(cls.dir, 'tusharedb.sock')
+        cls.server = server.Server(cls.address, {
+            native: DataApi(native_dtypes=native, query_cache=cache.DataFrameCache(0))
+            for native in (False, True)})
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.dir)
+        cls.bars.delete()
+        cls.basic.delete()
+
+    def _client(self, native, fmt):
+        api = DataApi(native_dtypes=native, server=self.address)
+        api.client.format = fmt
+        self.addCleanup(api.client.close)
+        return api
+
+    def test_same_as_local(self):
+        queries = [
+            lambda api: api.daily(ts_code=CODE),
+            lambda api: api.daily(ts_code=CODE, fields='close,trade_date'),
+            lambda api: api.stock_basic(),
+            lambda api: api.stock_basic(exchange='SZSE', fields='ts_code,name'),
+        ]
+        formats = [server.FORMAT_COLUMNS] + ([server.FORMAT_ARROW] if server.pa else [])
+        for native in (False, True):
+            local = DataApi(native_dtypes=native, query_cache=cache.DataFrameCache(0))
+            for fmt in formats:
+                client = self._client(native, fmt)
+                for i, query in enumerate(queries):
+                    with self.subTest(native=native, fmt=fmt, query=i):
+                        pd.testing.assert_frame_equal(query(client), query(local))
+
+    def test_snapshot_not_supported(self):
+        with self.assertRaises(RuntimeError):
+            self._client(False, server.FORMAT_COLUMNS).snapshot()
+
+
+if __name__ == '__main__':
+    unittest.main()
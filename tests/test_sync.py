@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.sync`."""
+import datetime
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from tusharedb import config, db, sync
+
+CODE = '000001.SZ'
+
+
+def _bars(dates):
+    return pd.DataFrame({'ts_code': CODE, 'trade_date': [str(d) for d in dates],
+                         'close': [float(d % 100) for d in dates]})
+
+
+class _Remote:
+    '''
+    按 start_date/end_date 返回数据的 tushare，fail 中的窗口抛出异常
+    '''
+
+    def __init__(self, dates, fail=()):
+        self.dates = dates
+        self.fail = set(fail)
+        self.calls = []
+
+    def __call__(self, api, api_name, **kwargs):
+        self.calls.append((api_name, kwargs.get('start_date'), kwargs.get('end_date')))
+        if (api_name, kwargs.get('start_date')) in self.fail:
+            raise IOError('fetch %s failed' % api_name)
+        return _bars([d for d in self.dates if int(kwargs['start_date']) <= d <= int(kwargs['end_date'])])
+
+
+class _Calendar:
+    '''
+    tushare 的 trade_cal，周一到周五开市
+    '''
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, api, api_name, **kwargs):
+        self.calls.append((api_name, kwargs['start_date'], kwargs['end_date']))
+        days = pd.date_range(kwargs['start_date'], kwargs['end_date'])
+        return pd.DataFrame({'cal_date': days.strftime('%Y%m%d'),
+                             'is_open': (days.dayofweek < 5).astype(int)})
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.calendar = _Calendar()
+        patcher = mock.patch.object(sync.util, 'query', self.calendar)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = datetime.datetime.now()
+
+    def tearDown(self):
+        db.dbs[config.DT_NORMAL_TRADE_CAL]().delete()
+        db.StateDb().delete_plan_test()
+
+    def _days_ago(self, days):
+        return (self.now - datetime.timedelta(days=days)).strftime('%Y%m%d')
+
+    def test_sync_trade_cal(self):
+        df = sync.sync_trade_cal()
+        self.assertEqual(self.calendar.calls, [
+            ('trade_cal', config.SYNC_START.replace('-', ''), self.now.strftime('%Y1231'))])
+        self.assertEqual(df['cal_date'].max(), self.now.strftime('%Y1231'))
+        self.assertEqual(len(db.dbs[config.DT_NORMAL_TRADE_CAL]().read()), len(df))
+
+    def test_trade_dates(self):
+        self.assertEqual(sync.trade_dates('2019-01-01', '20190110'),
+                         ['20190101', '20190102', '20190103', '20190104', '20190107',
+                          '20190108', '20190109', '20190110'])
+        # 本地日历已覆盖，不再请求
+        sync.trade_dates('20190105', '20190106')
+        self.assertEqual(len(self.calendar.calls), 1)
+
+    def test_refetch_when_not_covered(self):
+        db.dbs[config.DT_NORMAL_TRADE_CAL]().replace(
+            self.calendar(None, 'trade_cal', start_date='20181201', end_date='20181231'))
+        self.assertEqual(sync.trade_dates('20181228', '20190102'), ['20181228', '20181231', '20190101', '20190102'])
+        self.assertEqual(len(self.calendar.calls), 2)
+
+    def test_plan(self):
+        start = self._days_ago(30)
+        dates = sync.trade_dates(start, self.now)
+        state = db.StateDb()
+        missing = dates[:3]
+        for date in dates[3:]:
+            state.append_plan_test(date)
+
+        # 未完成的，以及最近 stale_days 天内的(可能还会更新)
+        stale = self._days_ago(config.SYNC_STALE_DAYS)
+        expected = missing + [d for d in dates[3:] if d >= stale]
+        self.assertEqual(sync.plan('plan_test', start_date=start), expected)
+        self.assertEqual(sync.plan('plan_test', start_date=start, stale_days=-1), missing)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        self.written = []
+        self.writers = set()
+
+    def _fetch(self, fail=()):
+        def fetch(item):
+            self.fetched.append(item)
+            if item in fail:
+                raise IOError('fetch %s failed' % item)
+            return item * 10
+        return fetch
+
+    def _write(self, item, result):
+        self.writers.add(threading.current_thread())
+        self.written.append((item, result))
+
+    def test_all_written_by_caller(self):
+        sync.pipeline(range(20), self._fetch(), self._write, workers=4)
+        self.assertEqual(sorted(self.written), [(i, i * 10) for i in range(20)])
+        self.assertEqual(self.writers, {threading.current_thread()})
+
+    def test_fetch_error(self):
+        # 出错后不再获取新的 item，之前获取的结果写完后抛出异常
+        with self.assertRaises(IOError):
+            sync.pipeline(range(20), self._fetch(fail=[5]), self._write, workers=1)
+        self.assertEqual(self.fetched, list(range(6)))
+        self.assertEqual(self.written, [(i, i * 10) for i in range(5)])
+
+    def test_fetch_error_many_workers(self):
+        before = threading.active_count()
+        with self.assertRaises(IOError) as cm:
+            sync.pipeline(range(100), self._fetch(fail=[3]), self._write, workers=4)
+        self.assertIn('3', str(cm.exception))
+        self.assertLess(len(self.fetched), 100)
+        self.assertEqual(sorted(self.written), [(i, i * 10) for i in sorted(self.fetched) if i != 3])
+        self.assertEqual(threading.active_count(), before)
+
+    def test_write_error(self):
+        # 写出错时队列已满，worker 需要被取出剩余结果后才能退出
+        def write(item, result):
+            time.sleep(0.01)
+            raise ValueError('write %s failed' % item)
+
+        before = threading.active_count()
+        with self.assertRaises(ValueError):
+            sync.pipeline(range(100), self._fetch(), write, workers=4, queue_size=1)
+        self.assertLess(len(self.fetched), 100)
+        self.assertEqual(threading.active_count(), before)
+
+
+class TestCodeStores(unittest.TestCase):
+    '''
+    按日期保存的数据转置为按代码保存，recent 存储合并到历史存储
+    '''
+
+    def setUp(self):
+        self.codes = [CODE, '000002.SZ']
+        self.dates = ['20181228', '20181231', '20190102', '20190103']
+        self.history_db, self.recent_db = config.get_api_db('daily', config.API_TYPE_TS_CODE)
+        self.state = db.StateDb()
+        self.state.sync_code_history_end = '2019-01-01'
+        db.dbs[config.DT_DAILY_BFQ].save_many({
+            date: pd.DataFrame({'ts_code': self.codes, 'trade_date': date,
+                                'close': [float(date[-2:]), 100 + float(date[-2:])]})
+            for date in self.dates})
+
+    def tearDown(self):
+        for data_type in (config.DT_DAILY_BFQ, self.history_db, self.recent_db):
+            db.dbs[data_type].clear()
+        self.state.delete_code()
+        with self.state.batch() as b:
+            b.delete(self.state.key_prefix + b'sync_code_history_end')
+
+    def _dates(self, data_type, code):
+        df = db.dbs[data_type](code).read()
+        return [] if df is None else [str(d) for d in df['trade_date']]
+
+    def _read(self, code):
+        return sync._read_code('daily', code).reset_index(drop=True)
+
+    def test_rebuild_and_merge(self):
+        sync.rebuild_code_stores(apis=('daily',))
+        self.assertEqual(sorted(self.state.list_code()), sorted(self.codes))
+        for code in self.codes:
+            self.assertEqual(self._dates(self.history_db, code), ['20181231', '20181228'])
+            self.assertEqual(self._dates(self.recent_db, code), ['20190103', '20190102'])
+        before = self._read(CODE)
+        self.assertEqual(list(before['close']), [3., 2., 31., 28.])
+
+        sync.merge_code(end='20190102', apis=('daily',))
+        self.assertEqual(self.state.sync_code_history_end, '2019-01-02')
+        for code in self.codes:
+            self.assertEqual(self._dates(self.history_db, code), ['20190102', '20181231', '20181228'])
+            self.assertEqual(self._dates(self.recent_db, code), ['20190103'])
+            self.assertEqual(db.dbs[self.history_db](code).chunks()['2019']['segments'], 0)
+        pd.testing.assert_frame_equal(self._read(CODE), before)
+
+        # 已合并到 end 时不再执行
+        with mock.patch.object(sync, 'pipeline') as pipeline:
+            sync.merge_code(end='20190101', apis=('daily',))
+        pipeline.assert_not_called()
+
+        # recent 中的数据全部合并后删除
+        sync.merge_code(end='20190110', apis=('daily',))
+        for code in self.codes:
+            self.assertEqual(self._dates(self.recent_db, code), [])
+            self.assertEqual(len(self._dates(self.history_db, code)), len(self.dates))
+        pd.testing.assert_frame_equal(self._read(CODE), before)
+
+
+class TestFetchWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.dates = [20190115, 20190114, 20190110, 20190108, 20190102]
+        self.saved = {}
+
+    def tearDown(self):
+        sync._clear_windows(['daily', 'adj_factor'], CODE)
+
+    def _run(self, remote, end):
+        def fetch(code):
+            return {api_name: sync._fetch_window(api_name, code, '20190101', end=end, ts_code=code,
+                                                 start_date='20190101', end_date=end)
+                    for api_name in ('daily', 'adj_factor')}
+
+        def write(code, result):
+            self.saved.update(result)
+            sync._clear_windows(['daily', 'adj_factor'], code)
+
+        with mock.patch.object(sync.util, 'query', remote):
+            sync.pipeline([CODE], fetch, write, workers=1)
+
+    def test_resume_on_a_later_day(self):
+        # 第一次运行 adj_factor 失败，daily 的窗口暂存在写线程
+        first = _Remote(self.dates, fail=[('adj_factor', '20190101')])
+        with self.assertRaises(IOError):
+            self._run(first, '20190110')
+        self.assertEqual(db.StateDb().get_window('daily:%s:20190101' % CODE), '20190110')
+        self.assertEqual(list(db.StageDb('daily:%s:20190101' % CODE).read()['trade_date']),
+                         ['20190110', '20190108', '20190102'])
+
+        # 之后的某天继续: 窗口名不变，只请求暂存之后的部分
+        second = _Remote(self.dates)
+        self._run(second, '20190115')
+        self.assertEqual(second.calls, [('daily', '20190111', '20190115'),
+                                        ('adj_factor', '20190101', '20190115')])
+        self.assertEqual(list(self.saved['daily']['trade_date'].astype(int)), self.dates)
+        self.assertIsNone(db.StateDb().get_window('daily:%s:20190101' % CODE))
+        self.assertTrue(db.StageDb('daily:%s:20190101' % CODE).empty())
+
+    def test_resume_same_day(self):
+        first = _Remote(self.dates, fail=[('adj_factor', '20190101')])
+        with self.assertRaises(IOError):
+            self._run(first, '20190115')
+        second = _Remote(self.dates)
+        self._run(second, '20190115')
+        self.assertEqual(second.calls, [('adj_factor', '20190101', '20190115')])
+        self.assertEqual(len(self.saved['daily']), len(self.dates))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `tusharedb.util`."""
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tusharedb import util
+
+RATE = 1200  # 每 0.05 秒一个令牌
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _bucket(self, capacity=1):
+        return util.TokenBucket('daily', RATE, capacity, path=self.path)
+
+    def _elapsed(self, acquire, n):
+        start = time.time()
+        for _ in range(n):
+            acquire()
+        return time.time() - start
+
+    def test_rate(self):
+        bucket = self._bucket()
+        # 第一个令牌立即可用，之后每 60 / RATE 秒一个
+        elapsed = self._elapsed(bucket.acquire, 11)
+        self.assertGreaterEqual(elapsed, 10 * 60 / RATE * 0.95)
+        self.assertLess(elapsed, 10 * 60 / RATE * 3)
+
+    def test_capacity(self):
+        bucket = self._bucket(capacity=5)
+        time.sleep(5 * 60 / RATE)
+        self.assertLess(self._elapsed(bucket.acquire, 5), 60 / RATE)
+
+    def test_shared_file(self):
+        # 同一个文件的两个桶(例如两个进程)共享令牌
+        first, second = self._bucket(), self._bucket()
+        elapsed = self._elapsed(lambda: (first.acquire(), second.acquire()), 5)
+        self.assertGreaterEqual(elapsed, 9 * 60 / RATE * 0.95)
+
+    def test_threads(self):
+        bucket = self._bucket()
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(4)])
+                   for _ in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 11 * 60 / RATE * 0.95)
+
+    def test_backoff(self):
+        bucket = self._bucket()
+        bucket.acquire()
+        bucket.backoff()
+        with bucket._locked() as state:
+            self.assertEqual(state[0], 0.)
+            self.assertEqual(state[2], 1.)
+            self.assertGreater(state[1], time.time() + 0.9)
+        # 连续限流时翻倍，reset 后重新计算
+        bucket.backoff()
+        with bucket._locked() as state:
+            self.assertEqual(state[2], 2.)
+        bucket.reset()
+        with bucket._locked() as state:
+            self.assertEqual(state[2], 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+'''
+复权计算
+
+hfq = 价格 * adj_factor
+qfq = 价格 * adj_factor / 最新 adj_factor，每个代码取因子序列中最新交易日的因子(见 base_factor)
+
+结果保留两位小数，与 ``float('%.2f' % x)`` 逐个元素的结果相同:
+先用 np.rint 取整，只有离 .5 边界太近、乘 100 的误差可能改变结果的元素才退回字符串格式化。
+'''
+import numpy as np
+import pandas as pd
+
+PRICE_COLS = ['open', 'close', 'high', 'low']
+
+# x * 100 的相对误差不超过 2 ** -52，离 .5 边界更远的元素 np.rint 的结果一定正确
+_TIE_EPS = 2.0 ** -50
+
+_format = np.vectorize(lambda x: float('%.2f' % x), otypes=[np.float64])
+
+
+def round_price(values):
+    '''
+    向量化的 float('%.2f' % x)
+    return: float64 ndarray
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 100
+    result = np.rint(scaled) / 100
+    with np.errstate(invalid='ignore'):
+        frac = np.abs(scaled - np.floor(scaled) - 0.5)
+        ties = frac <= np.abs(scaled) * _TIE_EPS
+    if ties.any():
+        result[ties] = _format(values[ties])
+    return result
+
+
+def latest_factor(factors, dates, codes=None):
+    '''
+    每一行所属代码在最新交易日的因子，codes 为 None 时所有行属于同一个代码
+    因子缺失的行不参与比较
+    '''
+    factors = np.asarray(factors, dtype=np.float64)
+    dates = np.asarray(dates)
+    if codes is None:
+        group = np.zeros(len(factors), dtype=np.intp)
+    else:
+        group, _ = pd.factorize(np.asarray(codes))
+    valid = ~np.isnan(factors)
+    # 按 (代码, 有效, 日期) 排序，每组最后一个就是最新的有效因子
+    order = np.lexsort((dates, valid, group))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = group[order][1:] != group[order][:-1]
+    base = np.full(group.max() + 1 if len(group) else 0, np.nan)
+    base[group[order][last]] = factors[order][last]
+    return base[group]
+
+
+def base_factor(fcts, factor_col='adj_factor'):
+    '''
+    qfq 的基准: 因子序列(adj_factor 的结果，包括停牌日)中每个代码最新的有效因子，与 pro_bar 相同
+    return: 有 ts_code 时为 {ts_code: 因子}，否则为单个因子，没有因子时为 None
+    '''
+    if fcts is None or fcts.empty:
+        return None
+    codes = np.asarray(fcts['ts_code'], dtype=object) if 'ts_code' in fcts else None
+    base = latest_factor(np.asarray(fcts[factor_col], dtype=np.float64),
+                         np.asarray(fcts['trade_date']), codes)
+    if codes is None:
+        return None if np.isnan(base[0]) else float(base[0])
+    return dict(zip(codes, base))
+
+
+def adjust(df, adj='qfq', columns=None, factor_col='adj_factor', base=None):
+    '''
+    对长表按代码一次性复权，df 需要 trade_date, adj_factor，多个代码时需要 ts_code
+    @adj: qfq, hfq，None 不复权
+    @base: qfq 的基准，见 rescale
+    return: 新的 DataFrame，价格列复权后保留两位小数
+    '''
+    if adj is None or df is None or df.empty:
+        return df
+    if adj not in ('qfq', 'hfq'):
+        raise ValueError('Unknown adj %s' % adj)
+    df = scale(df, columns, factor_col)
+    if adj == 'qfq':
+        return rescale(df, columns, factor_col, base)
+    return df.assign(**{col: round_price(np.asarray(df[col]))
+                        for col in columns or PRICE_COLS if col in df})
+
+
+def scale(df, columns=None, factor_col='adj_factor'):
+    '''
+    价格 * adj_factor，不取整，code:qfq 存储的值
+    '''
+    factors = np.asarray(df[factor_col], dtype=np.float64)
+    return df.assign(**{col: np.asarray(df[col], dtype=np.float64) * factors
+                        for col in columns or PRICE_COLS if col in df})
+
+
+def rescale(df, columns=None, factor_col='adj_factor', base=None):
+    '''
+    scale 的结果除以每个代码最新的因子并取整，即 qfq
+    新的除权只改变最新因子，已保存的 scale 结果不需要重写
+    @base: base_factor 的结果，df 的最后一个交易日之后可能还有因子(例如停牌)，
+           为 None 或缺少某个代码时使用 df 中该代码最新的因子
+    '''
+    if df is None or df.empty:
+        return df
+    factors = np.asarray(df[factor_col], dtype=np.float64)
+    codes = np.asarray(df['ts_code']) if 'ts_code' in df else None
+    own = latest_factor(factors, np.asarray(df['trade_date']), codes)
+    if base is None:
+        base = own
+    else:
+        if isinstance(base, dict):
+            base = pd.Series(base, dtype=np.float64).reindex(
+                np.asarray(df['ts_code'], dtype=object)).values
+        else:
+            base = np.full(len(df), float(base))
+        base = np.where(np.isnan(base), own, base)
+    return df.assign(**{col: round_price(np.asarray(df[col], dtype=np.float64) / base)
+                        for col in columns or PRICE_COLS if col in df})
+
+
+def _apply(prices, factors, base=None):
+    # 与逐个元素计算的顺序相同: 价格 * 因子 / 基准
+    values = prices * factors
+    if base is not None:
+        values /= base
+    return round_price(values)
+
+
+def adjust_panel(prices, factors, adj='qfq'):
+    '''
+    对 (交易日 × 代码) 的二维数组复权，行按交易日升序，见 tusharedb.dense
+    qfq 以每列最后一个有效因子为基准
+    '''
+    prices = np.asarray(prices, dtype=np.float64)
+    factors = np.asarray(factors, dtype=np.float64)
+    base = None
+    if adj == 'qfq':
+        valid = ~np.isnan(factors)
+        last = factors.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+        base = factors[last, np.arange(factors.shape[1])]
+        base[~valid.any(axis=0)] = np.nan
+    elif adj != 'hfq':
+        raise ValueError('Unknown adj %s' % adj)
+    return _apply(prices, factors, base)
+
+
+def fill_factor(df, factor_col='adj_factor'):
+    '''
+    缺失的因子用同一代码上一个交易日的因子填充，与 pro_bar 中按降序 bfill 相同
+    '''
+    if df[factor_col].notna().all():
+        return df
+    dates = np.asarray(df['trade_date'])
+    if 'ts_code' in df:
+        group, _ = pd.factorize(np.asarray(df['ts_code']))
+    else:
+        group = np.zeros(len(df), dtype=np.intp)
+    order = np.lexsort((dates, group))
+    ordered = pd.Series(np.asarray(df[factor_col], dtype=np.float64)[order])
+    filled = np.empty(len(df))
+    filled[order] = ordered.groupby(group[order], sort=False).ffill().values
+    return df.assign(**{factor_col: filled})
@@ -1,19 +1,23 @@
+import collections
 import copy
 import datetime
 import logging
 from functools import partial, wraps
 
+import numpy as np
 import pandas as pd
 import tushare as ts
-from tushare.util.formula import MA
 
-from tusharedb import config
+from tusharedb import adjust, cache, config, indicators
+from tusharedb import db as tsdb
 from tusharedb.db import (PrefixedDb, PrefixedDfDb, dbs, force_bytes,
-                          force_unicode)
+                          force_unicode, merge_segments)
+from tusharedb.server import Client
 
-PRICE_COLS = ['open', 'close', 'high', 'low']
+PRICE_COLS = adjust.PRICE_COLS
 
 
+# 价格保留两位小数，批量计算使用 adjust.round_price
 def FORMAT(x): return float('%.2f' % x)
 
 
@@ -28,11 +32,31 @@ logger = logging.getLogger(__name__)
 
 class DataApi:
 
-    def __init__(self, ts_token=None):
+    def __init__(self, ts_token=None, query_cache=None, native_dtypes=None, server=None):
+        '''
+        @server: tusharedb serve 的 socket 地址，设置后通过服务端读取数据库
+        '''
         self.ts_token = ts_token if ts_token else config.TS_TOKEN
         self.pro = ts.pro_api(
             token=self.ts_token)
         self.dbcls = {}
+        self.cache = query_cache if query_cache is not None else cache.query_cache
+        self.native_dtypes = config.NATIVE_DTYPES if native_dtypes is None else native_dtypes
+        self.client = Client(server) if server else None
+
+    def cache_info(self):
+        if self.client:
+            return cache.CacheInfo(**self.client.call('cache_info'))
+        return self.cache.info()
+
+    def snapshot(self):
+        '''
+        with api.snapshot(): 期间的查询读取同一个快照，可以和 sync 同时运行
+        通过服务端读取时不支持，快照只对本进程打开的数据库有效
+        '''
+        if self.client:
+            raise RuntimeError('snapshot is not supported when reading through a server')
+        return tsdb.snapshot()
 
     def delete(self, api_name):
         db = self.get_dbobj(api_name).delete()
@@ -43,6 +67,9 @@ class DataApi:
                 return dbs[config.DT_CODE_BFQ]
 
     def _query_db(self, api_name, **kwargs):
+        if self.client:
+            return self.client.call('query', api_name, self.native_dtypes, **kwargs)
+
         ts_code = kwargs.get('ts_code', '')
         trade_date = kwargs.get('trade_date', '')
         fields = kwargs.get('fields', '')
@@ -57,43 +84,74 @@ class DataApi:
             api_type = config.API_TYPE_NORMAL
             key = None
 
-        db_configs = config.get_api_db(api_name, api_type)
-        dfs = []
-        for db_config in db_configs:
-            dbcls = dbs[db_config]
-            if key:
-                db = dbcls(key)
-            else:
-                db = dbcls()
-            if fields:
-                tmp1 = tmp2 = fields.split(',')
-
-                extra_fields = config.get_api_extra_fields(
-                    api_name, api_type, **kwargs)
-                for f in extra_fields:
-                    if f not in tmp2:
-                        tmp1.append(f)
+        columns = None
+        if fields:
+            columns = fields.split(',')
+            for f in config.get_api_extra_fields(api_name, api_type, **kwargs):
+                if f not in columns:
+                    columns.append(f)
 
-                df = db.read(tmp1)
+        db_configs = config.get_api_db(api_name, api_type)
+        if columns and len(db_configs) > 1 and 'trade_date' not in columns:
+            # 多个存储按 trade_date 归并，返回前按 fields 去掉
+            columns.append('trade_date')
+        start_date = kwargs.get('start_date')
+        end_date = kwargs.get('end_date')
+        # 下推到存储的等值条件，见 DfDb.read
+        filters = {f: kwargs[f] for f in config.get_api_setup(api_name, api_type)['append_cols']
+                   if kwargs.get(f)}
+        cache_key = (api_name, api_type, key,
+                     tuple(columns) if columns else None,
+                     start_date, end_date, tuple(sorted(filters.items())))
+        # 快照中读取的数据可能比缓存旧，不使用缓存
+        use_cache = not tsdb.in_snapshot()
+        df = self.cache.get(cache_key) if use_cache else None
+        if df is None:
+            dfs = []
+            prefixes = []
+            skipped = []
+            for db_config in db_configs:
+                dbcls = dbs[db_config]
+                if key:
+                    db = dbcls(key)
+                else:
+                    db = dbcls()
+                prefixes.append(db.key_prefix)
+                if (start_date or end_date) and not db.may_contain(start_date, end_date):
+                    # 清单中的日期范围与查询不重叠，不读取
+                    skipped.append(db)
+                    continue
+                dfs.append(db.read(columns, start_date=start_date,
+                                   end_date=end_date, filters=filters))
+
+            dfs = [df for df in dfs if df is not None]
+            if len(dfs) > 1:
+                # 每个存储都按 trade_date 降序，归并即可，不需要重新排序
+                df = merge_segments(dfs)
+            elif dfs:
+                df = dfs[0]
             else:
-                df = db.read()
-            # print(df)
-            dfs.append(df)
-
-        if len(dfs) > 1:
-            df = pd.concat(dfs, sort=False)
-            df = config.filter_df(api_name, api_type, df, **kwargs)
-            df = df.sort_values('trade_date', ascending=False)
-            df.index = range(len(df))
-        else:
-            df = dfs[0]
-            df = config.filter_df(api_name, api_type, df, **kwargs)
+                # 有数据但与日期范围不重叠时为空表；所有存储都没有该 key 时为 None，由 query 从 tushare 获取
+                df = next((db.empty_frame(columns) for db in skipped if db.meta()['rows']), None)
+            # 缓存按查询条件区分
+            if use_cache and df is not None:
+                self.cache.put(cache_key, df, prefixes)
 
         if df is None:
             return None
+        loaded = df
+        df = config.filter_df(api_name, api_type, df, **kwargs)
+        if df is loaded:
+            # 未过滤时是存储中的只读视图或者缓存中的对象，复制后再交给调用方修改
+            df = df.copy()
+
+        if len(db_configs) > 1:
+            df.index = range(len(df))
 
         if fields:
             df = df[fields.split(',')]
+        if not self.native_dtypes:
+            df = config.output_df(db_configs[0], df)
         return df
 
         # if api_name in ('stock_basic',):
@@ -164,24 +222,81 @@ class DataApi:
             return self.pro.query(api_name, **kwargs)
 
         logger.debug('%s, fetch data from tushare db', api_name)
+        if api_name in config.LOCAL_APIS:
+            # 本地生成的数据，tushare 没有对应的接口，没有数据时返回 None
+            return self._query_db(api_name, **kwargs)
 
         try:
             df = self._query_db(api_name, **kwargs)
-            return df
-
         except Exception as e:
             logger.exception(e)
-            df = None
             logger.warning(
                 '%s(%s) fetch data from tushare db error, try to fetch data from tushare api', api_name, kwargs)
+            return self.pro.query(api_name, **kwargs)
 
+        if df is None:
+            logger.info('%s(%s) not in tushare db, fetch data from tushare api', api_name, kwargs)
             return self.pro.query(api_name, **kwargs)
+        return df
+
+    def panel(self, api_name, ts_codes=None, fields=None, start_date=None, end_date=None, as_dict=False):
+        '''
+        按 ts_code 批量读取，每个存储只用一个有序迭代器扫描
+        @ts_codes: None 读取全部
+        @fields: 'close,vol'，结果总是包含 ts_code, trade_date
+        @as_dict: 返回 {列名: np.ndarray}
+        return: 按 ts_code, trade_date 升序排列的长表
+        '''
+        if self.client:
+            df = self.client.call('panel', api_name, self.native_dtypes, ts_codes=ts_codes,
+                                  fields=fields, start_date=start_date, end_date=end_date)
+            if as_dict:
+                return {c: np.asarray(df[c].values) for c in df.columns}
+            return df
+
+        api_type = config.API_TYPE_TS_CODE
+        db_configs = config.get_api_db(api_name, api_type)
+        columns = None
+        if fields:
+            columns = [f for f in ('ts_code', 'trade_date')
+                       if f not in fields.split(',')] + fields.split(',')
+
+        frames = collections.defaultdict(list)
+        for db_config in db_configs:
+            for key, df in dbs[db_config].scan(ts_codes, columns, start_date, end_date):
+                frames[key].append(df)
+
+        dfs = []
+        for key in sorted(frames):
+            df = merge_segments(frames[key])
+            if 'ts_code' not in df:
+                df = df.assign(ts_code=key)
+            dfs.append(df)
+        if not dfs:
+            return {} if as_dict else pd.DataFrame(columns=columns)
+
+        df = pd.concat(dfs, ignore_index=True, sort=False)
+        df = config.filter_df(api_name, api_type, df,
+                              start_date=start_date, end_date=end_date)
+        df['ts_code'] = df['ts_code'].astype('category')
+        df = df.sort_values(['ts_code', 'trade_date'], kind='mergesort')
+        df.index = range(len(df))
+        if columns:
+            df = df[columns]
+        if not self.native_dtypes:
+            df = config.output_df(db_configs[0], df)
+        if as_dict:
+            return {c: np.asarray(df[c].values) for c in df.columns}
+        return df
+
+    def daily_panel(self, **kwargs):
+        return self.panel('daily', **kwargs)
 
     def __getattr__(self, name):
         return partial(self.query, name)
 
 
-api = DataApi(ts_token=config.TS_TOKEN)
+api = DataApi(ts_token=config.TS_TOKEN, server=config.SERVER_ADDRESS)
 
 
 def bfq(ts_code='', start_date=None, end_date=None, freq='D', include_factor=True, fields=None):
@@ -233,22 +348,62 @@ def adj(bfq, start_date=None, end_date=None, adj=None):
         data = data[data['trade_date'] <= end_date]
 
     if not data.empty:
-        for col in PRICE_COLS:
-            if col not in data:
-                continue
-            if adj == 'hfq':
-                data[col] = data[col] * data['adj_factor']
-            else:
-                data[col] = data[col] * data['adj_factor'] / \
-                    float(data['adj_factor'][0])
-            data[col] = data[col].map(FORMAT)
+        # 除 hfq 外都按 qfq 计算
+        data = adjust.adjust(data, 'hfq' if adj == 'hfq' else 'qfq')
     return data
 
 
+def adj_daily(ts_code, start_date=None, end_date=None, adj='qfq'):
+    '''
+    从 code:qfq/code:hfq 读取复权行情，见 sync.sync_adj
+    qfq 以 adj_factor 在 [start_date, end_date] 内最新的因子为基准，与 pro_bar 相同
+    return: 没有生成复权数据时返回 None，读取出错时抛出异常，不从 tushare 获取
+    '''
+    df = api.query('daily_%s' % adj, ts_code=ts_code,
+                   start_date=start_date, end_date=end_date)
+    if df is None or df.empty:
+        return None
+    if adj == 'qfq':
+        fcts = api.adj_factor(ts_code=ts_code, start_date=start_date, end_date=end_date)
+        df = adjust.rescale(df, base=adjust.base_factor(fcts))
+    return df
+
+
+def adj_bars(ts_codes=None, start_date=None, end_date=None, adj='qfq', fields=None):
+    '''
+    批量读取多个代码的复权行情，一次计算
+    @ts_codes: None 读取全部
+    return: 按 ts_code, trade_date 升序排列的长表，包含 adj_factor
+    '''
+    def _factors():
+        # qfq 的基准取 adj_factor 中每个代码最新的因子，见 adjust.base_factor
+        return api.panel('adj_factor', ts_codes=ts_codes, fields='adj_factor',
+                         start_date=start_date, end_date=end_date)
+
+    if config.ADJ_STORES:
+        df = api.panel('daily_%s' % adj, ts_codes=ts_codes,
+                       fields=fields and fields + ',adj_factor',
+                       start_date=start_date, end_date=end_date)
+        if not df.empty:
+            if adj != 'qfq':
+                return df
+            return adjust.rescale(df, base=adjust.base_factor(_factors()))
+
+    df = api.panel('daily', ts_codes=ts_codes, fields=fields,
+                   start_date=start_date, end_date=end_date)
+    if df.empty:
+        return df
+    fcts = _factors()
+    keys = ['ts_code', 'trade_date']
+    data = df.merge(fcts[keys + ['adj_factor']], on=keys, how='left')
+    return adjust.adjust(adjust.fill_factor(data), adj, base=adjust.base_factor(fcts))
+
+
 def pro_bar(ts_code='', start_date=None, end_date=None, freq='D', asset='E',
             market='',
             adj=None,
             ma=[],
+            factors=None,
             retry_count=3):
     """
     BAR数据
@@ -285,35 +440,41 @@ def pro_bar(ts_code='', start_date=None, end_date=None, freq='D', asset='E',
             asset = asset.strip().upper()
             if asset == 'E':
                 if freq == 'D':
-                    df = api.daily(ts_code=ts_code,
-                                   start_date=start_date, end_date=end_date)
-                    if df.empty:
-                        return df
-                    if adj is not None:
-                        fcts = api.adj_factor(ts_code=ts_code, start_date=start_date, end_date=end_date)[
-                            ['trade_date', 'adj_factor']]
-                        data = df.set_index('trade_date', drop=False).merge(fcts.set_index(
-                            'trade_date'), left_index=True, right_index=True, how='left')
-                        data['adj_factor'] = data['adj_factor'].fillna(
-                            method='bfill')
-                        for col in PRICE_COLS:
-                            if col in data:
-                                if adj == 'hfq':
-                                    data[col] = data[col] * data['adj_factor']
-                                else:
-                                    data[col] = data[col] * data['adj_factor'] / \
-                                        float(fcts['adj_factor'][0])
-                                data[col] = data[col].map(FORMAT)
-                        data = data.drop('adj_factor', axis=1)
+                    data = None
+                    if adj is not None and config.ADJ_STORES:
+                        data = adj_daily(ts_code, start_date, end_date, adj)
+                    if data is not None:
+                        data = data.set_index('trade_date', drop=False).drop('adj_factor', axis=1)
                     else:
-                        data = df
+                        df = api.daily(ts_code=ts_code,
+                                       start_date=start_date, end_date=end_date)
+                        if df.empty:
+                            return df
+                        if adj is not None:
+                            fcts = api.adj_factor(ts_code=ts_code, start_date=start_date, end_date=end_date)[
+                                ['trade_date', 'adj_factor']]
+                            data = df.set_index('trade_date', drop=False).merge(fcts.set_index(
+                                'trade_date'), left_index=True, right_index=True, how='left')
+                            data['adj_factor'] = data['adj_factor'].bfill()
+                            data = adjust.adjust(data, adj, base=adjust.base_factor(fcts)) \
+                                .drop('adj_factor', axis=1)
+                        else:
+                            data = df
                     if ma is not None and len(ma) > 0:
+                        # data 按 trade_date 降序，指标按升序计算
+                        close = np.asarray(data['close'], dtype=np.float64)[::-1]
                         for a in ma:
                             if isinstance(a, int):
-                                data['ma%s' % a] = MA(data['close'], a).map(
-                                    FORMAT).shift(-(a-1))
-                                data['ma%s' % a] = data['ma%s' %
-                                                        a].astype(float)
+                                data['ma%s' % a] = adjust.round_price(indicators.ma(close, a))[::-1]
+                    if factors:
+                        ds = api.daily_basic(ts_code=ts_code, start_date=start_date, end_date=end_date)
+                        cols = [c for f, c in (('tor', 'turnover_rate'), ('vr', 'volume_ratio'))
+                                if f in factors]
+                        if ds is None:
+                            ds = pd.DataFrame(columns=['trade_date'] + cols)
+                        ds = ds.set_index('trade_date')[cols].reindex(data['trade_date'].values)
+                        for c in cols:
+                            data[c] = ds[c].values
                     for col in PRICE_COLS:
                         data[col] = data[col].astype(float)
             if asset == 'I':
@@ -0,0 +1,224 @@
+'''
+存储后端
+
+Db 只依赖以下接口，key/value 都是 bytes:
+
+* get(key), put(key, value), delete(key)
+* iterator(prefix=b'', include_key=True, include_value=True): 有序迭代器，支持 seek 和 with
+* write_batch(): with 退出时原子提交，异常时丢弃
+* snapshot(): 只读快照，提供 get, iterator, close
+* compact_range(start=None, stop=None), close()
+
+leveldb: plyvel，只能单进程打开
+lmdb: 内存映射，多个进程可以同时读取，写入由 LMDB 串行化
+'''
+import logging
+
+import plyvel
+
+from tusharedb import config
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+logger = logging.getLogger(__name__)
+
+BACKEND_LEVELDB = 'leveldb'
+BACKEND_LMDB = 'lmdb'
+
+
+class LevelDBBackend:
+    multi_process = False
+
+    def __init__(self, name, **kwargs):
+        self.db = plyvel.DB(name, create_if_missing=True, **kwargs)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def iterator(self, prefix=b'', include_key=True, include_value=True):
+        return self.db.iterator(prefix=prefix, include_key=include_key,
+                                include_value=include_value)
+
+    def write_batch(self):
+        return self.db.write_batch(transaction=True)
+
+    def snapshot(self):
+        return self.db.snapshot()
+
+    def compact_range(self, start=None, stop=None):
+        self.db.compact_range(start=start, stop=stop)
+
+    def close(self):
+        self.db.close()
+
+
+class LmdbIterator:
+    '''
+    与 plyvel 的 prefix iterator 行为一致: 只返回 prefix 下的 key，seek 到第一个 >= target 的 key
+    '''
+
+    def __init__(self, txn, prefix=b'', include_key=True, include_value=True, own_txn=False):
+        self.txn = txn
+        self.own_txn = own_txn
+        self.cursor = txn.cursor()
+        self.prefix = prefix
+        self.include_key = include_key
+        self.include_value = include_value
+        self._valid = self.cursor.set_range(prefix)
+
+    def seek(self, target):
+        self._valid = self.cursor.set_range(max(target, self.prefix))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._valid:
+            raise StopIteration
+        key = bytes(self.cursor.key())
+        if not key.startswith(self.prefix):
+            self._valid = False
+            raise StopIteration
+        value = self.cursor.value()
+        self._valid = self.cursor.next()
+        if not self.include_value:
+            return key
+        if not self.include_key:
+            return value
+        return key, value
+
+    def close(self):
+        self.cursor.close()
+        if self.own_txn:
+            self.txn.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LmdbSnapshot:
+    '''
+    只读事务就是快照
+    '''
+
+    def __init__(self, env):
+        self.txn = env.begin()
+
+    def get(self, key):
+        return self.txn.get(key)
+
+    def iterator(self, prefix=b'', include_key=True, include_value=True):
+        return LmdbIterator(self.txn, prefix, include_key, include_value)
+
+    def close(self):
+        self.txn.abort()
+
+
+class LmdbWriteBatch:
+
+    def __init__(self, env):
+        self.env = env
+        self.txn = None
+
+    def put(self, key, value):
+        self.txn.put(key, value)
+
+    def delete(self, key):
+        self.txn.delete(key)
+
+    def __enter__(self):
+        self.txn = self.env.begin(write=True)
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.txn.commit()
+        else:
+            self.txn.abort()
+
+
+class LmdbBackend:
+    '''
+    value 从内存映射复制为 bytes 返回: 只读事务结束后 LMDB 的 buffer 不再有效，
+    而读出的 DataFrame 会一直引用它
+    '''
+    multi_process = True
+
+    def __init__(self, name, map_size=None, **kwargs):
+        if lmdb is None:
+            raise ImportError('lmdb is required by the lmdb backend')
+        self.env = lmdb.open(name, map_size=map_size or config.LMDB_MAP_SIZE,
+                             readahead=False, **kwargs)
+
+    def get(self, key):
+        with self.env.begin() as txn:
+            return txn.get(key)
+
+    def put(self, key, value):
+        with self.env.begin(write=True) as txn:
+            txn.put(key, value)
+
+    def delete(self, key):
+        with self.env.begin(write=True) as txn:
+            txn.delete(key)
+
+    def iterator(self, prefix=b'', include_key=True, include_value=True):
+        return LmdbIterator(self.env.begin(), prefix, include_key, include_value,
+                            own_txn=True)
+
+    def write_batch(self):
+        return LmdbWriteBatch(self.env)
+
+    def snapshot(self):
+        return LmdbSnapshot(self.env)
+
+    def compact_range(self, start=None, stop=None):
+        # B+ 树删除后页会被复用，不需要压缩
+        pass
+
+    def close(self):
+        self.env.close()
+
+
+BACKENDS = {
+    BACKEND_LEVELDB: LevelDBBackend,
+    BACKEND_LMDB: LmdbBackend,
+}
+
+
+def open_backend(name, backend=None, **kwargs):
+    backend = backend or config.DB_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend %s' % backend)
+    return BACKENDS[backend](name, **kwargs)
+
+
+def migrate(src, dst, batch_size=10000):
+    '''
+    把 src 后端的所有 key 复制到 dst，按 batch_size 分批提交
+    return: 复制的 key 数量
+    '''
+    count = 0
+    with src.iterator() as it:
+        while True:
+            items = [item for _, item in zip(range(batch_size), it)]
+            if not items:
+                break
+            with dst.write_batch() as wb:
+                for key, value in items:
+                    wb.put(key, value)
+            count += len(items)
+            logger.info('migrated %s keys', count)
+    return count
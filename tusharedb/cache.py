@@ -0,0 +1,88 @@
+'''
+DataApi.query 的进程内 LRU 缓存
+
+按 DataFrame 占用字节数淘汰，DfDb 写入/删除某个前缀后自动失效依赖该前缀的缓存。
+'''
+import collections
+import logging
+from threading import RLock
+
+from tusharedb import config
+
+logger = logging.getLogger(__name__)
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def df_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class DataFrameCache:
+
+    def __init__(self, maxsize=0):
+        '''
+        @maxsize: 最大字节数，0 表示关闭缓存
+        '''
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.currsize = 0
+        self._data = collections.OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key):
+        if not self.maxsize:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, df, prefixes):
+        '''
+        @prefixes: df 读取自哪些 DfDb 的 key_prefix，用于写入时失效
+        '''
+        if not self.maxsize or df is None:
+            return
+        size = df_size(df)
+        if size > self.maxsize:
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (df, size, tuple(prefixes))
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.currsize -= item[1]
+
+    def invalidate(self, prefix):
+        if not self._data:
+            return
+        with self._lock:
+            for key, (_, _, prefixes) in list(self._data.items()):
+                for p in prefixes:
+                    if p.startswith(prefix) or prefix.startswith(p):
+                        logger.debug('invalidate %s by %s', key, prefix)
+                        self._pop(key)
+                        break
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, self.currsize)
+
+
+query_cache = DataFrameCache(config.QUERY_CACHE_SIZE)
@@ -6,6 +6,7 @@ import sys
 
 import click
 
+from tusharedb import backend, dataset, db, dense, indicators, server
 from tusharedb import sync as dbsync
 
 
@@ -47,6 +48,26 @@ def sync_daily(cache):
         dbsync.sync_code_recent(nocache=True)
 
 
+@sync.command()
+def rebuild_code_stores():
+    '''不请求 tushare，由按日期保存的数据重建按代码保存的数据'''
+    dbsync.rebuild_code_stores()
+
+
+@sync.command()
+@click.option('--full/--incremental', default=False, help='清空后重新生成')
+def sync_adj(full):
+    '''由按代码保存的 daily 和 adj_factor 生成复权行情 code:qfq, code:hfq'''
+    dbsync.sync_adj(full=full)
+
+
+@sync.command()
+@click.option('--end', default=None, help='YYYYMMDD，合并该日期及之前的数据，默认两天前')
+def merge_code(end):
+    '''把 recent 数据合并到历史数据，推进 sync_code_history_end'''
+    dbsync.merge_code(end)
+
+
 @sync.command()
 def sync_news():
     '''增量同步新闻'''
@@ -54,6 +75,65 @@ def sync_news():
     dbsync.sync_news()
 
 
+@sync.command()
+@click.option('--to', 'to_backend', default='lmdb', type=click.Choice(['leveldb', 'lmdb']), help='目标后端')
+@click.option('--dest', required=True, help='目标数据库路径')
+def migrate(to_backend, dest):
+    '''把当前数据库复制到其他存储后端'''
+    src = db.Db().root
+    dst = backend.open_backend(dest, backend=to_backend)
+    count = backend.migrate(src, dst)
+    dst.close()
+    click.echo('migrated %s keys to %s' % (count, dest))
+
+
+@sync.command()
+@click.option('--address', default=None, help='Unix socket 地址，默认 TS_SERVER')
+def serve(address):
+    '''启动本地读服务，其他进程通过 DataApi(server=...) 查询'''
+    server.serve(address)
+
+
+@sync.command()
+@click.option('--format', 'fmt', default='parquet', type=click.Choice(dataset.FORMATS), help='文件格式')
+@click.option('--dest', required=True, help='导出目录')
+@click.option('--type', 'types', multiple=True, help='数据类型，例如 daily:bfq，默认全部')
+@click.option('--full/--incremental', default=False, help='重写所有分区，默认只导出变化的分区')
+def export(fmt, dest, types, full):
+    '''导出为 Hive 分区的 Parquet/Arrow 数据集'''
+    count = dataset.export(dest, fmt, types or None, full)
+    click.echo('exported %s partitions to %s' % (count, dest))
+
+
+@sync.command('import')
+@click.option('--format', 'fmt', default='parquet', type=click.Choice(dataset.FORMATS), help='文件格式')
+@click.option('--source', required=True, help='export 导出的目录')
+@click.option('--type', 'types', multiple=True, help='数据类型，例如 daily:bfq，默认全部')
+def import_(fmt, source, types):
+    '''从 export 导出的数据集导入当前数据库'''
+    count = dataset.import_dataset(source, fmt, types or None)
+    click.echo('imported %s partitions from %s' % (count, source))
+
+
+@sync.command()
+@click.option('--path', default=None, help='面板目录，默认 TS_PANEL_DIR')
+@click.option('--full/--incremental', default=False, help='重新生成所有字段')
+def build_panels(path, full):
+    '''从 daily 数据生成 交易日 x 代码 的稠密面板'''
+    count = dense.update(path, full=full)
+    click.echo('%s dates written' % count)
+
+
+@sync.command()
+@click.option('--path', default=None, help='面板目录，默认 TS_PANEL_DIR')
+@click.option('--full/--incremental', default=False, help='从头计算所有指标')
+def build_indicators(path, full):
+    '''在稠密面板上计算 config.INDICATORS 中的指标'''
+    counts = indicators.update(path, full=full)
+    for name, count in counts.items():
+        click.echo('%s: %s dates computed' % (name, count))
+
+
 def main():
     sync()
 
@@ -0,0 +1,260 @@
+'''
+列存储编码
+
+每个值由固定的头部和一段连续的 buffer 组成::
+
+    MAGIC(4) | header_len(uint32) | header(json) | padding | buffer
+
+header 记录 dtype, shape, codec，数值列通过 ``np.frombuffer`` 读取，不再经过 pickle。
+未压缩的值返回只读视图，不复制；压缩的值(默认 zstd)解压时分配一次内存，结果同样只读。
+DataApi 返回给调用方之前会复制，只有内部扫描直接使用只读结果。旧版本 pickle 格式的值仍可读取。
+
+codec 写法为 ``编码[+压缩]``，例如 ``dict+zstd``, ``delta``, ``lz4``:
+
+* 编码: raw, pickle, dict(低基数 object 列), delta(日期/递增整数)
+* 压缩: zstd, lz4, zlib，zstd/lz4 未安装时写入退化为 zlib
+'''
+import json
+import logging
+import pickle
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+VERSION = 1
+MAGIC = b'TSC' + bytes((VERSION,))
+ALIGN = 8
+
+CODEC_RAW = 'raw'
+CODEC_PICKLE = 'pickle'
+CODEC_DICT = 'dict'
+CODEC_DELTA = 'delta'
+
+COMPRESSIONS = ('zstd', 'lz4', 'zlib')
+
+# 不同值超过该比例时 dict 编码不划算
+DICT_MAX_RATIO = 0.5
+
+_HEADER_LEN = struct.Struct('<I')
+
+logger = logging.getLogger(__name__)
+
+_warned = set()
+
+
+def _pack(header, body=b''):
+    header = json.dumps(header, separators=(',', ':')).encode()
+    size = len(MAGIC) + _HEADER_LEN.size + len(header)
+    padding = b'\x00' * (-size % ALIGN)
+    return b''.join((MAGIC, _HEADER_LEN.pack(len(header)), header, padding, body))
+
+
+def _unpack(data):
+    pos = len(MAGIC)
+    header_len, = _HEADER_LEN.unpack_from(data, pos)
+    pos += _HEADER_LEN.size
+    header = json.loads(bytes(data[pos:pos + header_len]).decode())
+    pos += header_len
+    pos += -pos % ALIGN
+    return header, pos
+
+
+def is_encoded(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def parse_codec(spec):
+    '''
+    'dict+zstd' -> ('dict', 'zstd')
+    '''
+    encoding, compression = None, None
+    for part in (spec or '').split('+'):
+        if part in COMPRESSIONS:
+            compression = part
+        elif part:
+            encoding = part
+    return encoding, compression
+
+
+def compress(body, compression):
+    if compression == 'zstd' and zstandard is None or \
+            compression == 'lz4' and lz4_frame is None:
+        if compression not in _warned:
+            _warned.add(compression)
+            logger.warning('%s is not installed, use zlib instead', compression)
+        compression = 'zlib'
+
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(body), compression
+    elif compression == 'lz4':
+        return lz4_frame.compress(body), compression
+    elif compression == 'zlib':
+        return zlib.compress(body), compression
+    return body, None
+
+
+def decompress(body, compression):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required to read this value')
+        return zstandard.ZstdDecompressor().decompress(body)
+    elif compression == 'lz4':
+        if lz4_frame is None:
+            raise ImportError('lz4 is required to read this value')
+        return lz4_frame.decompress(body)
+    elif compression == 'zlib':
+        return zlib.decompress(body)
+    return body
+
+
+def _min_int_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _encode_dict(arr):
+    codes, categories = pd.factorize(arr)
+    if len(categories) > len(arr) * DICT_MAX_RATIO or \
+            not all(isinstance(v, str) for v in categories):
+        return None
+    codes = codes.astype(_min_int_dtype(len(categories)))
+    header = {'codec': CODEC_DICT, 'dtype': codes.dtype.str,
+              'categories': list(categories)}
+    return header, codes.tobytes()
+
+
+def _encode_delta(arr):
+    if len(arr) == 0:
+        return None
+    if arr.dtype.hasobject:
+        if not all(isinstance(v, str) and v.isdigit() and v[0] != '0' for v in arr):
+            return None
+        kind = 'str'
+    elif arr.dtype.kind in 'iu':
+        kind = arr.dtype.str
+    else:
+        return None
+    values = arr.astype(np.int64)
+    diffs = np.diff(values)
+    dtype = np.dtype(np.int32)
+    if len(diffs) and np.abs(diffs).max() > np.iinfo(dtype).max:
+        dtype = np.dtype(np.int64)
+    header = {'codec': CODEC_DELTA, 'dtype': dtype.str, 'kind': kind,
+              'first': int(values[0])}
+    return header, diffs.astype(dtype).tobytes()
+
+
+def encode_array(values, spec=None):
+    '''
+    @spec: codec 写法，见模块说明，None 使用 raw/pickle
+    '''
+    arr = np.asarray(values)
+    encoding, compression = parse_codec(spec)
+
+    encoded = None
+    if arr.ndim == 1 and encoding == CODEC_DICT and arr.dtype.hasobject:
+        encoded = _encode_dict(arr)
+    elif arr.ndim == 1 and encoding == CODEC_DELTA:
+        encoded = _encode_delta(arr)
+
+    if encoded is None:
+        if arr.dtype.hasobject:
+            header = {'codec': CODEC_PICKLE, 'dtype': 'object'}
+            body = pickle.dumps(arr, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            arr = np.ascontiguousarray(arr)
+            header = {'codec': CODEC_RAW, 'dtype': arr.dtype.str}
+            body = arr.tobytes()
+    else:
+        header, body = encoded
+
+    header['shape'] = arr.shape
+    if compression:
+        body, header['compression'] = compress(body, compression)
+    return _pack(header, body)
+
+
+def decode_array(data, as_category=False, rows=None):
+    '''
+    @as_category: dict 编码的列直接返回 pd.Categorical，不展开成 object
+    @rows: slice 或行号数组，只返回这些行；dict 编码只展开这些行，delta 只累加到最后一行
+    '''
+    if not is_encoded(data):
+        arr = pickle.loads(data)
+        return arr if rows is None else arr[rows]
+
+    header, pos = _unpack(data)
+    codec = header['codec']
+    compression = header.get('compression')
+    if compression:
+        data, pos = decompress(data[pos:], compression), 0
+
+    if codec == CODEC_PICKLE:
+        arr = pickle.loads(data[pos:])
+        return arr if rows is None else arr[rows]
+    elif codec == CODEC_RAW:
+        arr = np.frombuffer(data, dtype=np.dtype(header['dtype']), offset=pos)
+        arr = arr.reshape(header['shape'])
+        return arr if rows is None else arr[rows]
+    elif codec == CODEC_DICT:
+        codes = np.frombuffer(data, dtype=np.dtype(header['dtype']), offset=pos)
+        if rows is not None:
+            codes = codes[rows]
+        if as_category:
+            return pd.Categorical.from_codes(codes, header['categories'])
+        # code -1 (缺失值) 正好取到末尾的 None
+        categories = np.array(header['categories'] + [None], dtype=object)
+        return categories[codes]
+    elif codec == CODEC_DELTA:
+        diffs = np.frombuffer(data, dtype=np.dtype(header['dtype']), offset=pos)
+        n = len(diffs) + 1
+        if isinstance(rows, slice):
+            n = max(rows.indices(n)[1], 1)
+        values = np.empty(n, dtype=np.int64)
+        values[0] = 0
+        np.cumsum(diffs[:n - 1], dtype=np.int64, out=values[1:])
+        values += header['first']
+        if rows is not None:
+            values = values[rows]
+        if header['kind'] == 'str':
+            return values.astype(str).astype(object)
+        return values.astype(np.dtype(header['kind']))
+    else:
+        raise ValueError('Unknown codec %s' % codec)
+
+
+def encode_index(index):
+    if isinstance(index, pd.RangeIndex):
+        start = int(index[0]) if len(index) else 0
+        step = int(index[1] - index[0]) if len(index) > 1 else 1
+        header = {'kind': 'range', 'name': index.name, 'start': start,
+                  'stop': start + step * len(index), 'step': step}
+        return _pack(header)
+    return encode_array(index.values)
+
+
+def decode_index(data, rows=None):
+    if not is_encoded(data):
+        index = pickle.loads(data)
+        return index if rows is None else index[rows]
+
+    header, _ = _unpack(data)
+    if header.get('kind') == 'range':
+        index = pd.RangeIndex(header['start'], header['stop'], header['step'],
+                              name=header['name'])
+        return index if rows is None else index[rows]
+    return pd.Index(decode_array(data, rows=rows), copy=False)
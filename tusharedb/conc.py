@@ -12,9 +12,14 @@ process_pool = process.ProcessPoolExecutor(
 logger = logging.getLogger(__name__)
 
 
+def _fetch_and_task(fetch, task, key, **kwargs):
+    return task(key, fetch(key, **kwargs), **kwargs)
+
+
 class ConcurrentExecutor:
     '''
         考虑到leveldb只能单进程使用，而获取到数据 dataframe 后有大量的cpu计算，对df进行多进程处理
+        lmdb 等支持多进程读取的后端，fetch 也在子进程中执行，不再把 dataframe 传给子进程
     '''
 
     def __init__(self, fetch, task, reduce):
@@ -24,11 +29,16 @@ class ConcurrentExecutor:
 
     def __call__(self, inkeys, **kwargs):
 
+        multi_process = db.Db().root.multi_process
         with click.progressbar(inkeys, label='Fetch:') as bar:
             futures = []
             for key in bar:
-                r = self.fetch(key, **kwargs)
-                f = process_pool.submit(self.task, key, r, **kwargs)
+                if multi_process:
+                    f = process_pool.submit(
+                        _fetch_and_task, self.fetch, self.task, key, **kwargs)
+                else:
+                    r = self.fetch(key, **kwargs)
+                    f = process_pool.submit(self.task, key, r, **kwargs)
                 futures.append(f)
                 # self.task(code, r)
 
@@ -66,7 +76,7 @@ class JobResultDb(db.PrefixedDfDb):
         if not self.job_name:
             raise KeyError('job_name can not be None')
 
-        self.db = self.db.prefixed_db(db.force_bytes(self.job_name + ':'))
+        self.prefixed(self.job_name + ':')
 
 
 class TsDbJob:
@@ -77,14 +87,13 @@ class TsDbJob:
                     {'job_name': self.job_name})
         obj = cls_()
         if db_key:
-            obj.db.prefixed_db(db.force_bytes(db_key))
+            obj.prefixed(db_key)
         return obj
 
     def to_db(self, df, db_key=None):
 
         job_db = self.get_db_obj(db_key)
-        job_db.delete()
-        job_db.save(df)
+        job_db.replace(df)
 
     def read_db(self, columns=None, db_key=None):
         job_db = self.get_db_obj(db_key)
@@ -1,9 +1,18 @@
 import collections
 import os
+import tempfile
 
 TS_TOKEN = os.environ.get('TS_TOKEN')
 LEVEL_DB_NAME = os.environ.get('LEVEL_DB_NAME')
 
+# 存储后端: leveldb, lmdb，见 tusharedb.backend
+DB_BACKEND = os.environ.get('TS_DB_BACKEND', 'leveldb')
+LMDB_NAME = os.environ.get('LMDB_NAME')
+LMDB_MAP_SIZE = int(os.environ.get('TS_LMDB_MAP_SIZE', 64 * 1024 ** 3))
+
+# tusharedb serve 的 Unix socket 地址，设置后 api 通过服务端读取
+SERVER_ADDRESS = os.environ.get('TS_SERVER')
+
 SYNC_START = '1990-12-19'
 SYNC_CODE_HISTORY_END = '2019-01-01'
 
@@ -11,6 +20,26 @@ PROCESS_POOL_SIZE = int(os.environ.get(
     'TS_PROCESS_POOL_SIZE', os.cpu_count())) or 1
 THREAD_POOL_SIZE = 5
 
+# 稠密面板目录，见 tusharedb.dense，设置后 sync_daily 结束时更新
+PANEL_DIR = os.environ.get('TS_PANEL_DIR')
+
+# 重新读取最后几个交易日，sync_daily 会重新收集近2天数据
+PANEL_REFRESH_DAYS = 2
+
+# tushare 每个接口每分钟的请求次数，'*' 为默认，见 util.limiter
+RATE_LIMITS = {'*': 200, 'index_daily': 20, 'news': 10}
+# 令牌桶状态文件目录，多个 sync 进程共享
+RATE_LIMIT_DIR = os.environ.get('TS_RATE_LIMIT_DIR', os.path.join(
+    tempfile.gettempdir(), 'tusharedb-ratelimit'))
+# 被限流时 tushare 返回的错误信息
+RATE_LIMIT_ERRORS = ('每分钟最多访问', '最多访问该接口')
+
+# 维护 code:qfq/code:hfq，pro_bar 复权时直接读取
+ADJ_STORES = bool(os.environ.get('TS_ADJ_STORES'))
+
+# DataApi.query 缓存大小(字节)，0 关闭缓存
+QUERY_CACHE_SIZE = int(os.environ.get('TS_QUERY_CACHE_SIZE', 0))
+
 
 LIST_STATUS = ('L', 'D', 'P')  # 上市状态： L上市 D退市 P暂停上市
 EXCHANGE = ('SSE', 'SZSE', 'HKEX')  # 交易所 SSE上交所 SZSE深交所 HKEX港交所
@@ -29,23 +58,122 @@ DT_CODE_RECENTBASIC = 'code:recentbase'
 DT_CODE_RECENTADJFACTOR = 'code:recentadjfactor'
 
 DT_CODE_INDEX = 'code:index'
+
+# 复权行情，见 sync.sync_adj
+# hfq: 复权并取整后的价格，只追加；qfq: 价格 * adj_factor，读取时除以最新因子
+DT_CODE_QFQ = 'code:qfq'
+DT_CODE_HFQ = 'code:hfq'
 DT_DAILY_INDEX = 'daily:index'
 
 DT_NORMAL_STOCK_BASIC = 'normal:stockbasic'
+DT_NORMAL_TRADE_CAL = 'normal:tradecal'
+
+# 交易日历使用的交易所
+TRADE_CAL_EXCHANGE = 'SSE'
+
+# 重新收集最近几天的数据
+SYNC_STALE_DAYS = 2
 
 DT_NEWS = 'daily:news'
 
 
+# 列编码，见 tusharedb.codec，'*' 为该数据类型的默认编码
+COMPRESSION = os.environ.get('TS_COMPRESSION', 'zstd')
+
+_STORE_CODECS = {'ts_code': 'dict+' + COMPRESSION,
+                 'trade_date': 'delta+' + COMPRESSION, '*': COMPRESSION}
+
+COLUMN_CODECS = {
+    DT_DAILY_BFQ: _STORE_CODECS,
+    DT_DAILY_ADJFACTOR: _STORE_CODECS,
+    DT_DAILY_BASIC: _STORE_CODECS,
+    DT_DAILY_INDEX: _STORE_CODECS,
+    DT_CODE_BFQ: _STORE_CODECS,
+    DT_CODE_BASIC: _STORE_CODECS,
+    DT_CODE_ADJFACTOR: _STORE_CODECS,
+    DT_CODE_RECENTBFQ: _STORE_CODECS,
+    DT_CODE_RECENTBASIC: _STORE_CODECS,
+    DT_CODE_RECENTADJFACTOR: _STORE_CODECS,
+    DT_CODE_INDEX: _STORE_CODECS,
+    DT_CODE_QFQ: _STORE_CODECS,
+    DT_CODE_HFQ: _STORE_CODECS,
+    DT_NORMAL_STOCK_BASIC: {'exchange': 'dict', 'list_status': 'dict',
+                            'is_hs': 'dict', 'market': 'dict',
+                            'curr_type': 'dict', 'area': 'dict',
+                            'industry': 'dict'},
+}
+
+
+def get_column_codec(data_type, column):
+    codecs = COLUMN_CODECS.get(data_type, {})
+    return codecs.get(column, codecs.get('*'))
+
+
+# 稠密面板的字段 {数据类型: [字段]}
+PANEL_FIELDS = {
+    DT_DAILY_BFQ: ['open', 'high', 'low', 'close', 'vol', 'amount'],
+    DT_DAILY_ADJFACTOR: ['adj_factor'],
+    DT_DAILY_BASIC: ['turnover_rate', 'volume_ratio', 'pe', 'pb', 'total_mv', 'circ_mv'],
+}
+
+# 面板上计算的指标 {字段: (指标, [输入字段], 参数)}，见 tusharedb.indicators
+# 输入字段加 :hfq 后缀使用后复权价格，例如 close:hfq
+INDICATORS = {
+    'ma5': ('ma', ['close'], 5),
+    'ma10': ('ma', ['close'], 10),
+    'ma20': ('ma', ['close'], 20),
+    'ma60': ('ma', ['close'], 60),
+    'ema12': ('ema', ['close'], 12),
+    'ema26': ('ema', ['close'], 26),
+    'atr14': ('atr', ['high', 'low', 'close'], 14),
+    'vr5': ('volume_ratio', ['vol'], 5),
+    'tor5': ('ma', ['turnover_rate'], 5),
+}
+
+# 按 trade_date 分区保存的数据类型，Y 按年，M 按月
+PARTITIONS = {
+    DT_CODE_BFQ: 'Y',
+    DT_CODE_BASIC: 'Y',
+    DT_CODE_ADJFACTOR: 'Y',
+    DT_CODE_RECENTBFQ: 'Y',
+    DT_CODE_RECENTBASIC: 'Y',
+    DT_CODE_RECENTADJFACTOR: 'Y',
+    DT_CODE_INDEX: 'Y',
+    DT_CODE_QFQ: 'Y',
+    DT_CODE_HFQ: 'Y',
+}
+
+# 分区内 append 的 segment 超过该数量时重写分区
+MAX_SEGMENTS = 8
+
 APISETUPS = collections.defaultdict(dict)
 
+# 存储的列类型，按数据类型(db)注册，见 setup_api(schema=...)
+SCHEMAS = {}
+
+# 只在本地生成的数据，tushare 没有对应的接口，见 setup_api(local=True)
+LOCAL_APIS = set()
+
+# 有等值索引的列，按数据类型(db)注册，为 setup_api 中除日期外的 filters
+INDEXES = {}
+
+DTYPE_DATE = 'date'  # int32 YYYYMMDD
+DTYPE_CATEGORY = 'category'
+
+# 为 True 时 DataApi 直接返回 int32 trade_date，否则转回 tushare 的字符串
+NATIVE_DTYPES = bool(os.environ.get('TS_NATIVE_DTYPES'))
+
 API_TYPE_NORMAL = 'normal'
 API_TYPE_TS_CODE = 'ts_code'
 API_TYPE_TRADE_DATE = 'ts_date'
 
 
-def setup_api(api_name,  db=None, ts_code_db=None, trade_date_db=None, filters=None):
+def setup_api(api_name,  db=None, ts_code_db=None, trade_date_db=None, filters=None, schema=None,
+              local=False):
     '''
     @api_type: normal, ts_code, trade_date
+    @schema: {column: DTYPE_DATE | DTYPE_CATEGORY}
+    @local: 只在本地生成，查询出错时不从 tushare 获取
     '''
     _filters = filters if filters else []
     append_cols = [f for f in _filters if f not in ('start_date', 'end_date')]
@@ -81,21 +209,55 @@ def setup_api(api_name,  db=None, ts_code_db=None, trade_date_db=None, filters=N
         APISETUPS[key]['filters'] = _filters
         APISETUPS[key]['append_cols'] = append_cols
 
+    if local:
+        LOCAL_APIS.add(api_name)
+
+    if append_cols:
+        # 等值条件，保存时生成索引
+        for dbs in (db, ts_code_db, trade_date_db):
+            if not dbs:
+                continue
+            for data_type in dbs if isinstance(dbs, (tuple, list)) else (dbs,):
+                INDEXES[data_type] = append_cols
+
+    if schema:
+        for dbs in (db, ts_code_db, trade_date_db):
+            if not dbs:
+                continue
+            for data_type in dbs if isinstance(dbs, (tuple, list)) else (dbs,):
+                SCHEMAS[data_type] = schema
+
+
+_BAR_SCHEMA = {'trade_date': DTYPE_DATE, 'ts_code': DTYPE_CATEGORY}
+
 
 setup_api('stock_basic', db=DT_NORMAL_STOCK_BASIC,
-          filters=['is_hs', 'list_status', 'exchange'])
+          filters=['is_hs', 'list_status', 'exchange'],
+          schema={'exchange': DTYPE_CATEGORY, 'industry': DTYPE_CATEGORY,
+                  'list_status': DTYPE_CATEGORY, 'is_hs': DTYPE_CATEGORY,
+                  'market': DTYPE_CATEGORY, 'area': DTYPE_CATEGORY})
 
 setup_api('daily', ts_code_db=(DT_CODE_BFQ, DT_CODE_RECENTBFQ),
-          trade_date_db=DT_DAILY_BFQ, filters=['start_date', 'end_date'])
+          trade_date_db=DT_DAILY_BFQ, filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA)
 
 setup_api('adj_factor', ts_code_db=(DT_CODE_ADJFACTOR, DT_CODE_RECENTADJFACTOR),
-          trade_date_db=DT_DAILY_ADJFACTOR, filters=['start_date', 'end_date'])
+          trade_date_db=DT_DAILY_ADJFACTOR, filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA)
 
 setup_api('daily_basic', ts_code_db=(DT_CODE_BASIC, DT_CODE_RECENTBASIC),
-          trade_date_db=DT_DAILY_BASIC, filters=['start_date', 'end_date'])
+          trade_date_db=DT_DAILY_BASIC, filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA)
 
 setup_api('index_daily', ts_code_db=(DT_CODE_INDEX,),
-          trade_date_db=DT_DAILY_INDEX, filters=['start_date', 'end_date'])
+          trade_date_db=DT_DAILY_INDEX, filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA)
+
+setup_api('daily_qfq', ts_code_db=(DT_CODE_QFQ,), filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA, local=True)
+
+setup_api('daily_hfq', ts_code_db=(DT_CODE_HFQ,), filters=['start_date', 'end_date'],
+          schema=_BAR_SCHEMA, local=True)
 
 setup_api('news', ts_code_db=(), trade_date_db=DT_NEWS,
           filters=['start_date', 'end_date'])
@@ -134,13 +296,72 @@ def get_write_api_db(api_name, api_type, recent=True):
         return dbs[0]
 
 
+def get_indexes(data_type):
+    return INDEXES.get(data_type, ())
+
+
+def get_schema(data_type):
+    return SCHEMAS.get(data_type, {})
+
+
+def to_date(value):
+    '''
+    '20190101' / '2019-01-01' -> 20190101
+    '''
+    return int(str(value).replace('-', '')[:8])
+
+
+def apply_schema(data_type, df, category=True):
+    '''
+    按 schema 转换列类型，已经是目标类型的列不做处理
+    @category: False 时不转换 category 列(写入时由 dict 编码处理)
+    '''
+    schema = get_schema(data_type)
+    if df is None or not schema:
+        return df
+    changes = {}
+    for column, dtype in schema.items():
+        if column not in df:
+            continue
+        s = df[column]
+        if dtype == DTYPE_DATE and s.dtype.kind not in 'iu':
+            try:
+                changes[column] = s.astype('int32')
+            except (TypeError, ValueError):
+                pass
+        elif dtype == DTYPE_CATEGORY and category and s.dtype.name != 'category':
+            changes[column] = s.astype('category')
+    return df.assign(**changes) if changes else df
+
+
+def output_df(data_type, df):
+    '''
+    int32 trade_date 转回 tushare 的 YYYYMMDD 字符串，category 列转回 object
+    只在 native_dtypes 为 False 时调用
+    '''
+    changes = {}
+    for column, dtype in get_schema(data_type).items():
+        if dtype == DTYPE_DATE and column in df and df[column].dtype.kind in 'iu':
+            changes[column] = df[column].astype(str).astype(object)
+    for column in df.columns:
+        if column not in changes and df[column].dtype.name == 'category':
+            changes[column] = df[column].astype(object)
+    return df.assign(**changes) if changes else df
+
+
+def _like(s, value):
+    if s.dtype.kind in 'iu':
+        return to_date(value)
+    return value
+
+
 def filter_df(api_name, api_type, df, **kwargs):
     filters = get_api_setup(api_name, api_type)['filters']
     for f in filters:
         if f == 'start_date' and 'start_date' in kwargs and kwargs['start_date']:
-            df = df[df['trade_date'] >= kwargs['start_date']]
+            df = df[df['trade_date'] >= _like(df['trade_date'], kwargs['start_date'])]
         elif f == 'end_date' and 'end_date' in kwargs and kwargs['end_date']:
-            df = df[df['trade_date'] <= kwargs['end_date']]
+            df = df[df['trade_date'] <= _like(df['trade_date'], kwargs['end_date'])]
         else:
             if f in kwargs and kwargs[f]:
                 df = df[df[f] == kwargs[f]]
@@ -0,0 +1,224 @@
+'''
+导出为 Hive 分区的 Parquet/Arrow 数据集，以及从数据集导入
+
+目录结构::
+
+    <dest>/daily_bfq/year=2019/month=01/part.parquet     按日期保存的数据，按年/月分区
+    <dest>/code_bfq/code=000001.SZ/part.parquet          按代码保存的数据，按代码分区
+    <dest>/normal_stockbasic/part.parquet
+    <dest>/_export.json                                  {数据类型: {分区: 摘要}}
+
+增量导出: 对每个分区的原始 key/value 计算摘要，只解码并重写摘要变化的分区。
+导出的列保持存储类型(int32 trade_date, category ts_code)。
+没有 trade_date 的按日期数据增加 __key__ 列保存存储 key。
+'''
+import hashlib
+import itertools
+import json
+import logging
+import os
+
+import pandas as pd
+
+from tusharedb import config, db
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+FORMATS = (FORMAT_PARQUET, FORMAT_ARROW)
+
+STATE_FILE = '_export.json'
+PART_NAME = 'part'
+
+# 没有 trade_date 的按日期数据(例如 daily:news)导出时保存存储 key，导入时按它拆分
+KEY_COL = '__key__'
+
+
+def data_types():
+    '''
+    setup_api 注册的所有数据类型
+    '''
+    types = set()
+    for s in config.APISETUPS.values():
+        for k in ('db', 'ts_code_db', 'trade_date_db'):
+            types.update(s.get(k, ()))
+    return sorted(types)
+
+
+def _dir_name(data_type):
+    return data_type.replace(':', '_')
+
+
+def _partition(data_type, key):
+    '''
+    存储 key -> Hive 分区路径
+    '''
+    kind = data_type.split(':')[0]
+    if kind == 'daily':
+        return 'year=%s/month=%s' % (key[:4], key[4:6])
+    elif kind == 'code':
+        return 'code=%s' % key
+    return ''
+
+
+def _with_key(data_type, key, df):
+    if data_type.split(':')[0] == 'daily' and 'trade_date' not in df:
+        return df.assign(**{KEY_COL: key})
+    return df
+
+
+def _check(fmt):
+    if pa is None:
+        raise ImportError('pyarrow is required to export or import datasets')
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s' % fmt)
+
+
+def _write(df, path, fmt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    tmp = path + '.tmp'
+    if fmt == FORMAT_PARQUET:
+        pq.write_table(table, tmp)
+    else:
+        feather.write_feather(table, tmp)
+    os.replace(tmp, path)
+
+
+def _read(path, fmt):
+    if fmt == FORMAT_PARQUET:
+        return pq.read_table(path).to_pandas()
+    return feather.read_table(path).to_pandas()
+
+
+def _load_state(dest):
+    path = os.path.join(dest, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(dest, state):
+    path = os.path.join(dest, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _digests(obj, data_type):
+    '''
+    按分区计算原始 key/value 的摘要，不解码
+    return: {分区: (摘要, [key])}
+    '''
+    prefix = obj.key_prefix
+    keyed = data_type.split(':')[0] != 'normal'
+
+    def _key(item):
+        return db.force_unicode(item[0][len(prefix):].split(b':', 1)[0]) if keyed else ''
+
+    result = {}
+    with obj.reader.iterator(prefix=prefix) as it:
+        for key, items in itertools.groupby(it, _key):
+            partition = _partition(data_type, key)
+            h = result.setdefault(partition, (hashlib.blake2b(digest_size=16), []))
+            for k, v in items:
+                h[0].update(k)
+                h[0].update(v)
+            h[1].append(key)
+    return {p: (h.hexdigest(), keys) for p, (h, keys) in result.items()}
+
+
+def export(dest, fmt=FORMAT_PARQUET, types=None, full=False):
+    '''
+    @types: 导出的数据类型，默认全部
+    @full: 忽略上次导出的摘要，重写所有分区
+    return: 重写的分区数量
+    '''
+    _check(fmt)
+    os.makedirs(dest, exist_ok=True)
+    state = {} if full else _load_state(dest)
+    written = 0
+    with db.snapshot():
+        for data_type in types or data_types():
+            dbcls = db.dbs[data_type]
+            digests = _digests(dbcls(), data_type)
+            old = state.get(data_type, {})
+            changed = {p: keys for p, (digest, keys) in digests.items()
+                       if old.get(p) != '%s:%s' % (fmt, digest)}
+            root = os.path.join(dest, _dir_name(data_type))
+
+            for partition in set(old) - set(digests):
+                # 数据库中已删除的分区
+                path = os.path.join(root, partition, '%s.%s' % (PART_NAME, fmt))
+                if os.path.exists(path):
+                    os.remove(path)
+
+            for partition, keys in sorted(changed.items()):
+                if partition:
+                    dfs = [_with_key(data_type, key, df) for key, df in dbcls.scan(keys)]
+                else:
+                    dfs = [dbcls().read()]
+                dfs = [df for df in dfs if df is not None]
+                if not dfs:
+                    continue
+                df = pd.concat(dfs, sort=False) if len(dfs) > 1 else dfs[0]
+                _write(df, os.path.join(root, partition, '%s.%s' % (PART_NAME, fmt)), fmt)
+                written += 1
+
+            state[data_type] = {p: '%s:%s' % (fmt, digest)
+                                for p, (digest, _) in digests.items()}
+            _save_state(dest, state)
+            logger.info('export %s: %s of %s partitions changed',
+                        data_type, len(changed), len(digests))
+    return written
+
+
+def import_dataset(src, fmt=FORMAT_PARQUET, types=None, method='replace'):
+    '''
+    导入 export 生成的数据集，每个分区文件一个 WriteBatch
+    按日期保存的数据按 trade_date(没有 trade_date 时按导出的 KEY_COL)拆回每天一个 key
+    return: 导入的分区数量
+    '''
+    _check(fmt)
+    count = 0
+    for data_type in types or data_types():
+        root = os.path.join(src, _dir_name(data_type))
+        if not os.path.isdir(root):
+            continue
+        kind = data_type.split(':')[0]
+        dbcls = db.dbs[data_type]
+        n = 0
+        for dirpath, _, filenames in sorted(os.walk(root)):
+            name = '%s.%s' % (PART_NAME, fmt)
+            if name not in filenames:
+                continue
+            df = _read(os.path.join(dirpath, name), fmt)
+            if kind == 'normal':
+                getattr(dbcls(), method)(df)
+            elif kind == 'code':
+                key = os.path.basename(dirpath).split('=', 1)[1]
+                dbcls.save_many({key: df}, method)
+            elif KEY_COL in df:
+                keys = df.pop(KEY_COL).astype(str)
+                dbcls.save_many({key: part.reset_index(drop=True)
+                                 for key, part in df.groupby(keys, sort=True)}, method)
+            elif 'trade_date' not in df:
+                logger.warning('%s has no trade_date, skip %s', data_type, dirpath)
+                continue
+            else:
+                dates = df['trade_date'].astype(str)
+                dbcls.save_many({date: part.reset_index(drop=True)
+                                 for date, part in df.groupby(dates, sort=True)}, method)
+            n += 1
+        count += n
+        logger.info('import %s: %s partitions', data_type, n)
+    return count
@@ -1,19 +1,29 @@
 import copy
+import itertools
+import json
 import logging
-import pickle
+import os
+from contextlib import contextmanager
 from functools import partial
-from threading import Lock
+from threading import Lock, local
 
+import numpy as np
 import pandas as pd
-import plyvel
 
-from tusharedb import config
+from tusharedb import backend, cache, codec, config
 
 LEVEL_DB_NAME = config.LEVEL_DB_NAME
+if config.DB_BACKEND == backend.BACKEND_LMDB:
+    LEVEL_DB_NAME = config.LMDB_NAME
+
+# {db name: (pid, backend)}，fork 出的子进程需要重新打开
 LEVEL_DBS = {}
 
 lock = Lock()
 
+# 当前线程使用的快照 {db name: snapshot}
+_local = local()
+
 
 def force_bytes(s):
     try:
@@ -33,34 +43,82 @@ class Db:
     name = LEVEL_DB_NAME
 
     def __init__(self,  **kwargs):
-        global LEVEL_DB
         with lock:
-            if not self.name in LEVEL_DBS:
-                LEVEL_DBS[self.name] = plyvel.DB(
-                    self.name, create_if_missing=True, ** kwargs)
-            self.db = LEVEL_DBS[self.name]
+            pid = os.getpid()
+            if self.name not in LEVEL_DBS or LEVEL_DBS[self.name][0] != pid:
+                LEVEL_DBS[self.name] = (
+                    pid, backend.open_backend(self.name, **kwargs))
+            self.root = LEVEL_DBS[self.name][1]
+        self.key_prefix = b''
+
+    def prefixed(self, prefix):
+        self.key_prefix += force_bytes(prefix)
+
+    def write_batch(self):
+        '''
+        原子写入，key 需带完整前缀，见 key_prefix
+        '''
+        return self.root.write_batch()
+
+    @contextmanager
+    def batch(self, wb=None):
+        if wb is not None:
+            yield wb
+        else:
+            with self.write_batch() as wb:
+                yield wb
+            self.on_write()
+
+    def on_write(self):
+        cache.query_cache.invalidate(self.key_prefix)
 
     def close(self):
         del LEVEL_DBS[self.name]
-        if isinstance(self.db, plyvel.DB):
-            self.db.close()
-        else:
-            self.db.db.close()
+        self.root.close()
+
+    @property
+    def reader(self):
+        '''
+        读取使用的后端，在 snapshot() 中为快照
+        '''
+        snapshots = getattr(_local, 'snapshots', None)
+        if snapshots and self.name in snapshots:
+            return snapshots[self.name]
+        return self.root
+
+    def get(self, key):
+        return self.reader.get(self.key_prefix + force_bytes(key))
+
+    def put(self, key, value):
+        self.root.put(self.key_prefix + force_bytes(key), force_bytes(value))
+
+    def iterator(self, prefix=b'', include_key=True, include_value=True):
+        '''
+        同 prefixed_db.iterator，返回的 key 不含 key_prefix
+        '''
+        n = len(self.key_prefix)
+        it = self.reader.iterator(prefix=self.key_prefix + force_bytes(prefix),
+                                  include_key=include_key, include_value=include_value)
+        if not include_key:
+            return it
+        elif not include_value:
+            return (k[n:] for k in it)
+        return ((k[n:], v) for k, v in it)
 
     def keys(self):
-        return self.db.iterator(include_value=False)
+        return self.iterator(include_value=False)
 
     def values(self):
-        return self.db.iterator(include_key=False)
+        return self.iterator(include_key=False)
 
     def empty(self):
-        for key in self.db.iterator(include_value=False):
+        for key in self.iterator(include_value=False):
             return False
 
         return True
 
     def items(self):
-        return self.db.iterator()
+        return self.iterator()
 
 
 class PrefixedDb(Db):
@@ -69,67 +127,308 @@ class PrefixedDb(Db):
     def __init__(self,  **kwargs):
         super().__init__(**kwargs)
         if self.prefix:
-            self.db = self.db.prefixed_db(force_bytes(self.prefix))
+            self.prefixed(self.prefix)
         else:
             raise ValueError('prefix can not be none')
 
 
 class DfDb(Db):
     index_col = 'index'
+    data_type = None
+    partitioned = False
+    meta_key = '__meta__'
+    index_prefix = '__index_'
 
     def pre_save(self, df):
-        return df
+        return sort_frame(config.apply_schema(self.data_type, df, category=False))
 
     def saved_index(self):
-        v = self.db.get(force_bytes(self.index_col))
+        v = self.get(self.index_col)
         if v:
-            return pickle.loads(v)
+            return codec.decode_index(v)
         else:
             return None
 
-    def save(self, df):
+    def _key(self, column, part=''):
+        return self.key_prefix + force_bytes(part) + force_bytes(column)
+
+    def columns(self, part=''):
+        '''
+        part 下保存的列名，不含 index 和子 part
+        '''
+        prefix = force_bytes(part)
+        for key in self.iterator(prefix=prefix, include_value=False):
+            name = force_unicode(key[len(prefix):])
+            if ':' in name or name == self.index_col or name.startswith('__'):
+                continue
+            yield name
+
+    def _save_part(self, b, df, part=''):
+        for column in df.columns:
+            v = df[column]
+            b.put(self._key(column, part), codec.encode_array(
+                v.values, self.column_codec(column)))
+        b.put(self._key(self.index_col, part), codec.encode_index(df.index))
+        self._save_indexes(b, df, part)
+
+    def save(self, df, wb=None):
         df = self.pre_save(df)
-        with self.db.write_batch() as wb:
-            for column in df.columns:
-                v = df[column]
-                self.db.put(column.encode(),
-                            pickle.dumps(v.values))
-            self.db.put(force_bytes(self.index_col), pickle.dumps(df.index))
-
-    def delete(self, columns=None):
-        with self.db.write_batch() as wb:
-            for column in columns if columns else self.keys():
-                self.db.delete(force_bytes(column))
+        with self.batch(wb) as b:
+            self._save_part(b, df)
+            self._save_meta(b, self._meta_info(df, self.meta()))
+
+    def meta(self):
+        '''
+        {rows, min, max, dtypes}，min/max 为 trade_date，没有清单的旧数据返回 None
+        '''
+        v = self.get(self.meta_key)
+        return json.loads(bytes(v).decode()) if v else None
+
+    def _meta_info(self, df, meta=None):
+        dtypes = dict(meta['dtypes']) if meta else {}
+        dtypes.update((c, str(df[c].dtype)) for c in df.columns)
+        info = {'rows': len(df), 'min': None, 'max': None, 'dtypes': dtypes}
+        if len(df) and 'trade_date' in df and df['trade_date'].dtype.kind in 'iu':
+            info['min'] = int(df['trade_date'].min())
+            info['max'] = int(df['trade_date'].max())
+        return info
+
+    def _save_meta(self, b, meta):
+        b.put(self._key(self.meta_key), force_bytes(json.dumps(meta)))
+
+    def may_contain(self, start_date=None, end_date=None):
+        '''
+        根据清单判断 [start_date, end_date] 内是否可能有数据，没有清单时返回 True
+        '''
+        meta = self.meta()
+        if meta is None:
+            return True
+        if not meta['rows']:
+            return False
+        if meta['min'] is None:
+            return True
+        if start_date and meta['max'] < config.to_date(start_date):
+            return False
+        if end_date and meta['min'] > config.to_date(end_date):
+            return False
+        return True
+
+    def empty_frame(self, columns=None):
+        '''
+        按清单中的列类型构造没有行的 DataFrame
+        '''
+        meta = self.meta()
+        if meta is None:
+            return None
+        dtypes = meta['dtypes']
+        return self._result(pd.DataFrame(
+            {c: pd.Series(dtype=dtypes[c]) for c in columns or sorted(dtypes) if c in dtypes}))
+
+    def column_codec(self, column):
+        if self.data_type:
+            return config.get_column_codec(self.data_type, column)
+
+    def delete(self, columns=None, wb=None):
+        with self.batch(wb) as b:
+            for column in columns if columns else list(self.keys()):
+                b.delete(self._key(column))
             if columns is None:
-                self.db.delete(force_bytes(self.index_col))
+                b.delete(self._key(self.index_col))
+            else:
+                self._drop_meta_columns(b, columns)
+
+    def _drop_meta_columns(self, b, columns):
+        meta = self.meta()
+        if meta:
+            for column in columns:
+                meta['dtypes'].pop(column, None)
+            self._save_meta(b, meta)
+
+    def replace(self, df, wb=None):
+        '''
+        删除旧列并写入 df，在同一个 WriteBatch 中提交
+        '''
+        df = self.pre_save(df)
+        with self.batch(wb) as b:
+            self.delete(wb=b)
+            self._save_part(b, df)
+            self._save_meta(b, self._meta_info(df))
+
+    def append(self, df, wb=None):
+        '''
+        按 trade_date upsert，非分区存储需要重写整个 key
+        '''
+        old = self.read()
+        df = self.pre_save(df)
+        if old is not None:
+            df = merge_segments([old, df])
+        self.replace(df, wb=wb)
 
-    def read(self, columns=None):
-        _columns = columns if columns else self.keys()
-        serieses = list()
-        tmp = dict()
+    def last_date(self):
         if self.empty():
-            return
+            return None
+        df = self.read(['trade_date'])
+        if df is None or df.empty:
+            return None
+        return int(df['trade_date'].max())
+
+    def _read_part(self, columns=None, part='', start_date=None, end_date=None, filters=None):
+        _columns = columns if columns else list(self.columns(part))
+        values = dict()
         for c in _columns:
-            if c == force_bytes(self.index_col):
+            c = force_unicode(c)
+            if c == self.index_col:
                 continue
-            try:
-
-                v = pickle.loads(
-                    self.db.get(force_bytes(c)))
-            except TypeError:
-                logging.error('Error: get %s from db %s' % (c, self.db))
-                raise
-
-            tmp[force_unicode(c)] = v
-            index = pickle.loads(self.db.get(force_bytes(self.index_col)))
+            values[c] = self.get(part + c)
+            if values[c] is None:
+                logging.error('Error: get %s from db %s' % (c, self.key_prefix))
+                raise TypeError('column %s not found' % c)
+        if values:
+            values[self.index_col] = self.get(part + self.index_col)
+        rows = self._rows(values, part, start_date, end_date, filters) if values else None
+        return self._decode_frame(values, rows)
+
+    def _rows(self, values, part='', start_date=None, end_date=None, filters=None):
+        '''
+        谓词下推，只解码满足条件的行，返回 None 表示全部行
+        日期范围在降序的 trade_date 上二分查找，得到连续的行；等值条件使用保存时生成的索引
+        不能下推的条件由 filter_df 过滤
+        '''
+        rows = None
+        if start_date or end_date:
+            v = values.get('trade_date') or self.get(part + 'trade_date')
+            dates = codec.decode_array(v) if v is not None else None
+            if dates is not None and dates.dtype.kind in 'iu' and \
+                    (dates[:-1] >= dates[1:]).all():
+                keys = -dates.astype(np.int64)
+                start = np.searchsorted(keys, -config.to_date(end_date)) if end_date else 0
+                stop = np.searchsorted(keys, -config.to_date(start_date), 'right') \
+                    if start_date else len(keys)
+                rows = slice(start, stop)
+
+        for column, value in (filters or {}).items():
+            v = self.get(part + self.index_prefix + column)
+            if v is None:
+                continue
+            positions = np.array(json.loads(bytes(v).decode()).get(str(value), []),
+                                 dtype=np.intp)
+            if isinstance(rows, slice):
+                positions = positions[(positions >= rows.start) & (positions < rows.stop)]
+            elif rows is not None:
+                positions = np.intersect1d(rows, positions)
+            rows = positions
+        return rows
+
+    def _save_indexes(self, b, df, part=''):
+        '''
+        等值索引 {值: [行号]}，列见 config.get_indexes
+        '''
+        for column in config.get_indexes(self.data_type):
+            if column not in df:
+                continue
+            index = {}
+            for i, v in enumerate(df[column].values):
+                if v is not None and v == v:
+                    index.setdefault(str(v), []).append(i)
+            b.put(self._key(self.index_prefix + column, part), force_bytes(json.dumps(index)))
+
+    def _decode_frame(self, values, rows=None):
+        '''
+        {列名: 编码后的值}，包括 index_col
+        @rows: 只解码这些行，见 _rows
+        '''
+        schema = config.get_schema(self.data_type)
+        tmp = dict()
+        for c, v in values.items():
+            if c == self.index_col:
+                continue
+            tmp[c] = codec.decode_array(
+                v, as_category=schema.get(c) == config.DTYPE_CATEGORY, rows=rows)
         if tmp:
-            # print(tmp, index)
-            df = pd.DataFrame(data=tmp, index=index)
-            df = self.handler_result(df)
-            return df
+            index = codec.decode_index(values[self.index_col], rows=rows)
+            # copy=False: 保留 frombuffer 视图，不做 block 合并，结果只读，见 DataApi._query_db
+            return pd.DataFrame(data=tmp, index=index, copy=False)
         else:
             return None
 
+    @classmethod
+    def chunk_range(cls, label):
+        '''
+        分区 label 对应的 (min, max) trade_date，非分区存储返回 None
+        '''
+        return None
+
+    @classmethod
+    def scan(cls, keys=None, columns=None, start_date=None, end_date=None):
+        '''
+        用一个有序迭代器读取该数据类型下的多个 key，yield (key, df)
+        @keys: None 读取全部 key，否则按排序后的 key 依次 seek
+        '''
+        obj = cls()
+        prefix = obj.key_prefix
+        wanted = set(columns) | {obj.index_col} if columns else None
+        start = config.to_date(start_date) if start_date else None
+        end = config.to_date(end_date) if end_date else None
+
+        def _key(item):
+            return force_unicode(item[0][len(prefix):].split(b':', 1)[0])
+
+        with obj.reader.iterator(prefix=prefix) as it:
+            def _items():
+                if keys is None:
+                    yield from it
+                    return
+                for key in sorted(keys):
+                    key_prefix = prefix + force_bytes(key + ':')
+                    it.seek(key_prefix)
+                    for k, v in it:
+                        if not k.startswith(key_prefix):
+                            break
+                        yield k, v
+
+            for key, items in itertools.groupby(_items(), _key):
+                parts = {}
+                for k, v in items:
+                    rest = force_unicode(k[len(prefix) + len(key) + 1:])
+                    part, _, column = rest.rpartition(':')
+                    if column.startswith('__') or wanted and column not in wanted:
+                        continue
+                    r = cls.chunk_range(part.split(':')[0]) if part else None
+                    if r and (start and r[1] < start or end and r[0] > end):
+                        continue
+                    parts.setdefault(part, {})[column] = v
+                df = obj._merge_parts(parts)
+                if df is not None:
+                    yield key, df
+
+    def _merge_parts(self, parts):
+        '''
+        {part: {列名: 值}}，part 形如 '' / '2019' / '2019:s1'
+        '''
+        def _order(part):
+            chunk, _, segment = part.partition(':')
+            return chunk, int(segment[1:]) if segment else 0
+
+        dfs = [self._decode_frame(parts[part]) for part in sorted(parts, key=_order)]
+        return self._result(merge_segments([df for df in dfs if df is not None]))
+
+    def _result(self, df):
+        if df is None:
+            return None
+        # 兼容旧数据: 字符串日期 -> int32
+        df = config.apply_schema(self.data_type, df)
+        return self.handler_result(df)
+
+    def read(self, columns=None, start_date=None, end_date=None, filters=None):
+        '''
+        @start_date/end_date: 跳过分区并只解码日期范围内的行
+        @filters: {列名: 值}，有等值索引的列只解码匹配的行
+        条件不一定都能下推，返回结果仍需 filter_df 过滤
+        '''
+        if self.empty():
+            return
+        return self._result(self._read_part(columns, '', start_date, end_date, filters))
+
     def handler_result(self, df):
         return df
 
@@ -140,7 +439,7 @@ class PrefixedDfDb(DfDb):
     def __init__(self,  **kwargs):
         super().__init__(**kwargs)
         if self.prefix:
-            self.db = self.db.prefixed_db(force_bytes(self.prefix))
+            self.prefixed(self.prefix)
         else:
             raise ValueError('prefix can not be none')
 
@@ -173,22 +472,36 @@ class StateDb(PrefixedDb):
     prefix = 'ts:state:'
     logger = logging.getLogger('StateDb')
 
-    def _db(self, name):
-        return self.db.prefixed_db(force_bytes(name + ':'))
-
-    def _keys(self, name):
-        for key in self._db(name).iterator(include_value=False):
-            yield force_unicode(key)
+    def _keys(self, name, prefix=''):
+        n = len(force_bytes(name + ':'))
+        for key in self.iterator(prefix=force_bytes(name + ':' + prefix), include_value=False):
+            yield force_unicode(key[n:])
 
-    def _append(self, name, value):
+    def _append(self, name, value, wb=None, data='1'):
+        '''
+        @data: 与值一起保存的内容，见 get_<name>
+        '''
         self.logger.debug('Add %s to db %s', value, name)
-        self._db(name).put(force_bytes(value), force_bytes('1'))
+        if wb is None:
+            self.put(name + ':' + value, data)
+        else:
+            wb.put(self.key_prefix + force_bytes(name + ':' + value), force_bytes(data))
+
+    def _contains(self, name, value):
+        return self.get(name + ':' + value) is not None
 
-    def _delete(self, name):
-        self.logger.debug('Delete all keys in db %s', name)
-        with self._db(name).write_batch() as b:
-            for key in self._keys(name):
-                b.delete(force_bytes(key))
+    def _data(self, name, value):
+        v = self.get(name + ':' + value)
+        return None if v is None else force_unicode(bytes(v))
+
+    def _delete(self, name, prefix='', wb=None):
+        '''
+        @prefix: 只删除以 prefix 开头的值
+        '''
+        self.logger.debug('Delete keys %s* in db %s', prefix, name)
+        with self.batch(wb) as b:
+            for key in list(self._keys(name, prefix)):
+                b.delete(self.key_prefix + force_bytes(name + ':' + key))
 
     def __getattr__(self, name):
         if name.startswith('append_'):
@@ -197,19 +510,23 @@ class StateDb(PrefixedDb):
             return partial(self._keys, name[5:])
         elif name.startswith('delete_'):
             return partial(self._delete, name[7:])
+        elif name.startswith('has_'):
+            return partial(self._contains, name[4:])
+        elif name.startswith('get_'):
+            return partial(self._data, name[4:])
 
     @property
     def sync_code_history_end(self):
-        tmp = self.db.get(force_bytes('sync_code_history_end'))
+        tmp = self.get('sync_code_history_end')
         if tmp:
             return force_unicode(tmp)
         else:
             return config.SYNC_CODE_HISTORY_END
 
     @sync_code_history_end.setter
-    def set_sync_code_history_end(self, value):
+    def sync_code_history_end(self, value):
         self.logger.info('set sync_code_history_end to %s', value)
-        self.db.put(force_bytes('sync_code_history_end'), force_bytes(value))
+        self.put('sync_code_history_end', value)
 
 
 # class DailyCodeDb(DailyBaseDb):
@@ -254,9 +571,284 @@ class _BaseDb(PrefixedDfDb):
     def __init__(self, key=None, **kwargs):
         super().__init__(**kwargs)
         if key:
-            self.db = self.db.prefixed_db(force_bytes(key+':'))
+            self.prefixed(key+':')
         self.key = key
 
+    @classmethod
+    def save_many(cls, dfs, method='replace'):
+        '''
+        {key: df}, 所有 key 在同一个 WriteBatch 中提交
+        '''
+        save_many([(cls(key), df) for key, df in dfs.items()], method)
+
+    @classmethod
+    def list_keys(cls):
+        '''
+        该数据类型下所有 key，按 key 排序
+        '''
+        last = None
+        for key in cls().iterator(include_value=False):
+            key = force_unicode(key.split(b':', 1)[0])
+            if key != last:
+                yield key
+            last = key
+
+    @classmethod
+    def clear(cls, batch_size=10000):
+        '''
+        删除该数据类型下所有 key，分批提交
+        '''
+        obj = cls()
+        while True:
+            keys = list(itertools.islice(obj.iterator(include_value=False), batch_size))
+            if not keys:
+                break
+            with obj.batch() as b:
+                for key in keys:
+                    b.delete(obj.key_prefix + key)
+
+
+class StageDb(_BaseDb):
+    '''
+    sync 已获取、尚未写入正式存储的结果，key 为 <api_name>:<ts_code|trade_date>:<窗口>
+    进度记录在 StateDb 的 window 中，与暂存结果在同一个 WriteBatch 中写入
+    '''
+    prefix = 'ts:stage:'
+
+    @classmethod
+    def clear(cls, prefix, wb=None):
+        '''
+        删除以 prefix 开头的暂存结果和进度记录
+        '''
+        obj = cls()
+        state = StateDb()
+        with obj.batch(wb) as b:
+            for key in list(obj.iterator(prefix=force_bytes(prefix), include_value=False)):
+                b.delete(obj.key_prefix + key)
+            state.delete_window(prefix, wb=b)
+
+
+class PartitionedDfDb(_BaseDb):
+    '''
+    按 trade_date 分区保存，freq: Y 按年, M 按月
+    分区清单保存在 __chunks__: {分区: {min, max, rows, segments}}，读取时只读与日期范围重叠的分区
+    append 的新行写入分区下新的 segment (<分区>:s<n>:)，读取时按 trade_date 去重
+    '''
+    freq = 'Y'
+    partitioned = True
+    chunks_key = '__chunks__'
+
+    def chunk_labels(self, trade_dates):
+        return trade_dates // (10000 if self.freq == 'Y' else 100)
+
+    @classmethod
+    def chunk_range(cls, label):
+        if not label.isdigit():
+            return None
+        if cls.freq == 'Y':
+            return int(label) * 10000 + 101, int(label) * 10000 + 1231
+        return int(label) * 100 + 1, int(label) * 100 + 31
+
+    def chunks(self):
+        v = self.get(self.chunks_key)
+        return json.loads(bytes(v).decode()) if v else {}
+
+    def _chunk_parts(self, name, chunk):
+        yield name + ':'
+        for i in range(1, chunk.get('segments', 0) + 1):
+            yield '%s:s%d:' % (name, i)
+
+    def _chunk_info(self, df, chunk=None):
+        info = {'min': int(df['trade_date'].min()),
+                'max': int(df['trade_date'].max()),
+                'rows': len(df), 'segments': 0}
+        if chunk:
+            info['min'] = min(info['min'], chunk['min'])
+            info['max'] = max(info['max'], chunk['max'])
+            info['rows'] += chunk['rows']
+            info['segments'] = chunk.get('segments', 0) + 1
+        return info
+
+    def _partitionable(self, df):
+        if 'trade_date' not in df or df['trade_date'].dtype.kind not in 'iu':
+            logging.warning('%s can not be partitioned without trade_date',
+                            self.key_prefix)
+            return False
+        return True
+
+    def _split(self, df):
+        labels = self.chunk_labels(df['trade_date'].values)
+        for label in np.unique(labels):
+            yield str(label), df[labels == label]
+
+    def _save_chunks(self, b, df, chunks, meta=None):
+        df = self.pre_save(df)
+        if not self._partitionable(df):
+            self._save_part(b, df)
+            self._save_meta(b, self._meta_info(df, meta))
+            return
+
+        for name, part in self._split(df):
+            if name in chunks:
+                # 分区整体重写，删除原有的列和 segment
+                self._delete_chunk(b, name)
+            self._save_part(b, part, name + ':')
+            chunks[name] = self._chunk_info(part)
+        self._save_manifest(b, chunks, df, meta)
+
+    def _save_manifest(self, b, chunks, df, meta=None):
+        '''
+        分区清单和整个 key 的清单一起更新
+        @meta: 已有的清单，用于合并列类型
+        '''
+        b.put(self._key(self.chunks_key), force_bytes(json.dumps(chunks)))
+        meta = self._meta_info(df, meta)
+        meta['rows'] = sum(c['rows'] for c in chunks.values())
+        if chunks:
+            meta['min'] = min(c['min'] for c in chunks.values())
+            meta['max'] = max(c['max'] for c in chunks.values())
+        self._save_meta(b, meta)
+
+    def meta(self):
+        meta = super().meta()
+        if meta is None:
+            # 清单之前写入的分区数据
+            chunks = self.chunks()
+            if chunks:
+                meta = {'rows': sum(c['rows'] for c in chunks.values()),
+                        'min': min(c['min'] for c in chunks.values()),
+                        'max': max(c['max'] for c in chunks.values()),
+                        'dtypes': {}}
+        return meta
+
+    def _delete_chunk(self, b, name):
+        prefix = force_bytes(name + ':')
+        for key in self.iterator(prefix=prefix, include_value=False):
+            b.delete(self._key(key))
+
+    def save(self, df, wb=None):
+        '''
+        重写 df 包含的分区，其它分区不变；分区之前写入的数据整体替换
+        '''
+        chunks = self.chunks()
+        if not chunks:
+            return self.replace(df, wb=wb)
+        with self.batch(wb) as b:
+            self._save_chunks(b, df, chunks, self.meta())
+
+    def replace(self, df, wb=None):
+        with self.batch(wb) as b:
+            self.delete(wb=b)
+            self._save_chunks(b, df, {})
+
+    def append(self, df, wb=None):
+        '''
+        按 trade_date upsert，只写入新行；分区的 segment 超过 config.MAX_SEGMENTS 时重写该分区
+        同一个 WriteBatch 中不能对同一个 key 多次 append
+        '''
+        chunks = self.chunks()
+        if not chunks and not self.empty():
+            # 分区之前写入的数据，整体转为分区存储
+            return super().append(df, wb=wb)
+
+        df = self.pre_save(df)
+        if not self._partitionable(df):
+            return super().append(df, wb=wb)
+
+        with self.batch(wb) as b:
+            for name, part in self._split(df):
+                chunk = chunks.get(name)
+                if chunk is None:
+                    self._save_part(b, part, name + ':')
+                    chunks[name] = self._chunk_info(part)
+                elif chunk.get('segments', 0) >= config.MAX_SEGMENTS:
+                    merged = merge_segments([self._read_chunk(name, chunk), part])
+                    self._delete_chunk(b, name)
+                    self._save_part(b, merged, name + ':')
+                    chunks[name] = self._chunk_info(merged)
+                else:
+                    chunks[name] = self._chunk_info(part, chunk)
+                    self._save_part(b, part, '%s:s%d:' %
+                                    (name, chunks[name]['segments']))
+            self._save_manifest(b, chunks, df, self.meta())
+
+    def compact(self, wb=None):
+        '''
+        合并所有分区的 segment
+        '''
+        chunks = self.chunks()
+        with self.batch(wb) as b:
+            merged = None
+            for name, chunk in chunks.items():
+                if not chunk.get('segments'):
+                    continue
+                merged = self._read_chunk(name, chunk)
+                self._delete_chunk(b, name)
+                self._save_part(b, merged, name + ':')
+                chunks[name] = self._chunk_info(merged)
+            if merged is not None:
+                self._save_manifest(b, chunks, merged, self.meta())
+
+    def last_date(self):
+        chunks = self.chunks()
+        if not chunks:
+            return super().last_date()
+        return max(c['max'] for c in chunks.values())
+
+    def delete(self, columns=None, wb=None):
+        if columns is None:
+            return super().delete(wb=wb)
+        with self.batch(wb) as b:
+            parts = ['']
+            for name, chunk in self.chunks().items():
+                parts.extend(self._chunk_parts(name, chunk))
+            for part in parts:
+                for column in columns:
+                    b.delete(self._key(column, part))
+            self._drop_meta_columns(b, columns)
+
+    def select_chunks(self, start_date=None, end_date=None):
+        start = config.to_date(start_date) if start_date else None
+        end = config.to_date(end_date) if end_date else None
+        for name, c in sorted(self.chunks().items()):
+            if start is not None and c['max'] < start:
+                continue
+            if end is not None and c['min'] > end:
+                continue
+            yield name, c
+
+    def _read_chunk(self, name, chunk, columns=None, start_date=None, end_date=None):
+        if not chunk.get('segments'):
+            return self._read_part(columns, name + ':', start_date, end_date)
+
+        _columns = columns
+        if columns and 'trade_date' not in columns:
+            # 去重需要 trade_date
+            _columns = list(columns) + ['trade_date']
+        dfs = [self._read_part(_columns, part, start_date, end_date)
+               for part in self._chunk_parts(name, chunk)]
+        df = merge_segments([df for df in dfs if df is not None])
+        if df is not None and _columns is not columns:
+            df = df[columns]
+        return df
+
+    def read(self, columns=None, start_date=None, end_date=None, filters=None):
+        if not self.chunks():
+            # 分区之前写入的数据
+            return super().read(columns, start_date, end_date, filters)
+
+        # 分区按年降序拼接，结果按 trade_date 降序
+        dfs = [self._read_chunk(name, chunk, columns, start_date, end_date)
+               for name, chunk in reversed(list(self.select_chunks(start_date, end_date)))]
+        dfs = [sort_frame(df) for df in dfs if df is not None]
+        if not dfs:
+            # 日期范围内没有分区
+            return self.empty_frame(columns)
+        df = pd.concat(dfs) if len(dfs) > 1 else dfs[0]
+        # segment 归并和分区拼接后保留了原来的行号，重新编号
+        df.index = range(len(df))
+        return self._result(df)
+
 
 class DbHandler:
     def __init__(self):
@@ -269,7 +861,14 @@ class DbHandler:
         prefix = 'ts:%s:%s:' % (db_type, data_type)
         # if prefix not in self.valid_prefix:
         #     raise ValueError('db cls config %s not valid' % prefix)
-        _cls = type('TsDb_'+prefix, (_BaseDb,), {'prefix': prefix})
+        alias = '%s:%s' % (db_type, data_type)
+        attrs = {'prefix': prefix, 'data_type': alias}
+        if alias in config.PARTITIONS:
+            base = PartitionedDfDb
+            attrs['freq'] = config.PARTITIONS[alias]
+        else:
+            base = _BaseDb
+        _cls = type('TsDb_'+prefix, (base,), attrs)
 
         return _cls
 
@@ -282,6 +881,121 @@ class DbHandler:
         #     print(key, db, id(db), db.prefix)
         return self._dbs[alias]
 
+    def save_many(self, dfs, method='replace'):
+        '''
+        {(alias, key): df}, 例如同一个 code 的 bfq/adjfactor/basic
+        '''
+        save_many([(self[alias](key), df)
+                   for (alias, key), df in dfs.items()], method)
+
+
+def save_many(objs, method='replace'):
+    '''
+    [(dfdb, df), ...] 在同一个 WriteBatch 中提交，读者不会看到写了一半的列
+    @method: save, replace, append
+    '''
+    if not objs:
+        return
+    with objs[0][0].write_batch() as wb:
+        for obj, df in objs:
+            getattr(obj, method)(df, wb=wb)
+    for obj, _ in objs:
+        obj.on_write()
+
+
+def in_snapshot(name=LEVEL_DB_NAME):
+    snapshots = getattr(_local, 'snapshots', None)
+    return bool(snapshots) and name in snapshots
+
+
+@contextmanager
+def snapshot():
+    '''
+    with snapshot(): 期间当前线程所有 Db 的读取都来自同一个 LevelDB 快照，
+    不会读到 sync 写入一半的数据。只用于读取，append/save 依赖的清单也会从快照读取
+    '''
+    root = Db()
+    snapshots = _local.__dict__.setdefault('snapshots', {})
+    previous = snapshots.get(root.name)
+    snap = root.root.snapshot()
+    snapshots[root.name] = snap
+    try:
+        yield snap
+    finally:
+        if previous is None:
+            del snapshots[root.name]
+        else:
+            snapshots[root.name] = previous
+        snap.close()
+
+
+def sort_frame(df):
+    '''
+    存储中的数据按 trade_date 降序排列(与 tushare 一致)，已排序时直接返回
+    '''
+    if df is None or 'trade_date' not in df or df['trade_date'].is_monotonic_decreasing:
+        return df
+    return df.sort_values('trade_date', ascending=False, kind='mergesort')
+
+
+def _dedup(df):
+    '''
+    已排序的数据中重复的 trade_date 相邻，保留每组最后一行
+    '''
+    dates = df['trade_date'].values
+    drop = np.zeros(len(df), dtype=bool)
+    drop[:-1] = dates[:-1] == dates[1:]
+    return df[~drop] if drop.any() else df
+
+
+def _merge_two(a, b):
+    '''
+    线性归并两个降序的 segment，日期相同时 b 排在 a 后面
+    '''
+    ka = -a['trade_date'].values.astype(np.int64)
+    kb = -b['trade_date'].values.astype(np.int64)
+    n = len(a) + len(b)
+    ib = np.searchsorted(ka, kb, side='right') + np.arange(len(b))
+    ia = np.ones(n, dtype=bool)
+    ia[ib] = False
+    order = np.empty(n, dtype=np.intp)
+    order[ib] = np.arange(len(a), n)
+    order[ia] = np.arange(len(a))
+    return pd.concat([a, b], sort=False).take(order)
+
+
+def merge_segments(dfs):
+    '''
+    按顺序合并多个 segment，trade_date 重复时保留后面的，结果按 trade_date 降序
+    日期范围不重叠时直接按范围拼接，否则两两线性归并，不做整体排序
+    '''
+    if not dfs:
+        return None
+    if len(dfs) == 1:
+        return sort_frame(dfs[0])
+    if any('trade_date' not in df for df in dfs):
+        # 没有 trade_date 无法去重和排序，调用方需要读取 trade_date
+        raise ValueError('merge_segments requires trade_date')
+
+    dfs = [sort_frame(df) for df in dfs if not df.empty] or dfs[-1:]
+    if len(dfs) == 1:
+        return _dedup(dfs[0])
+    if any(df['trade_date'].dtype.kind not in 'iu' for df in dfs):
+        # 旧数据中的字符串日期
+        df = pd.concat(dfs, sort=False)
+        df = df.sort_values('trade_date', ascending=False, kind='mergesort')
+        return _dedup(df)
+
+    ranges = sorted(((df['trade_date'].iat[0], df['trade_date'].iat[-1], i)
+                     for i, df in enumerate(dfs)), reverse=True)
+    if all(ranges[k][1] > ranges[k + 1][0] for k in range(len(ranges) - 1)):
+        return _dedup(pd.concat([dfs[i] for _, _, i in ranges], sort=False))
+
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = _merge_two(df, other)
+    return _dedup(df)
+
 
 dbs = DbHandler()
 
@@ -0,0 +1,271 @@
+'''
+稠密面板: 每个字段一个 交易日 × 代码 的二维 float64 .npy，用 np.load(mmap_mode='r') 打开
+
+目录结构::
+
+    <path>/dates.npy     int32 交易日，升序，行
+    <path>/codes.npy     代码，列，先按 stock_basic 排序，新出现的代码追加在后面
+    <path>/<field>.npy   shape (len(dates), len(codes))，缺失为 NaN
+
+数据来自 daily:* 存储，update 只追加新的交易日行；出现新代码时重写文件增加列。
+dates.npy 最后写入，读者只使用前 len(dates) 行。
+'''
+import io
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import config, db
+
+logger = logging.getLogger(__name__)
+
+DATES_FILE = 'dates.npy'
+CODES_FILE = 'codes.npy'
+
+DTYPE = np.dtype(np.float64)
+
+# 一次读取并写入的交易日数量
+CHUNK_DAYS = 250
+
+
+class Panel:
+    '''
+    values: 只读 memmap，按 dates/codes 对齐
+    '''
+
+    def __init__(self, field, values, dates, codes):
+        self.field = field
+        self.values = values
+        self.dates = dates
+        self.codes = codes
+
+    def slice(self, start_date=None, end_date=None, codes=None):
+        '''
+        按日期范围和代码取子数组，日期范围是连续的行，不复制
+        '''
+        start = np.searchsorted(self.dates, config.to_date(start_date)) if start_date else 0
+        end = np.searchsorted(self.dates, config.to_date(end_date), 'right') \
+            if end_date else len(self.dates)
+        values = self.values[start:end]
+        dates = self.dates[start:end]
+        if codes is None:
+            return Panel(self.field, values, dates, self.codes)
+        idx = pd.Index(self.codes).get_indexer(codes)
+        if (idx < 0).any():
+            raise KeyError('codes not in panel: %s' % list(np.asarray(codes)[idx < 0]))
+        return Panel(self.field, values[:, idx], dates, np.asarray(codes))
+
+    def to_frame(self):
+        return pd.DataFrame(self.values, index=self.dates, columns=self.codes)
+
+
+def _path(path):
+    path = path or config.PANEL_DIR
+    if not path:
+        raise ValueError('panel path can not be none, set TS_PANEL_DIR')
+    return path
+
+
+def _field_file(path, field):
+    return os.path.join(path, field + '.npy')
+
+
+def _save(path, name, arr):
+    tmp = os.path.join(path, name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, os.path.join(path, name))
+
+
+def _header(shape):
+    return {'descr': np.lib.format.dtype_to_descr(DTYPE),
+            'fortran_order': False, 'shape': tuple(shape)}
+
+
+def _read_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, _ = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape, f.tell()
+
+
+def _header_bytes(shape):
+    buf = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buf, _header(shape))
+    return buf.getvalue()
+
+
+def _write_rows(path, field, rows, block):
+    '''
+    从第 rows 行开始写入 block，文件只保留 rows + len(block) 行
+    header 中的 shape 在数据之后更新，长度不变时原地修改；
+    否则(旧版本 numpy 写入的 header 没有预留空间)在临时文件中写入新的 header 和数据后替换
+    '''
+    filename = _field_file(path, field)
+    block = np.ascontiguousarray(block, dtype=DTYPE)
+    with open(filename, 'r+b') as f:
+        shape, offset = _read_header(f)
+        header = _header_bytes((rows + len(block), shape[1]))
+        if len(header) == offset:
+            f.seek(offset + rows * shape[1] * DTYPE.itemsize)
+            f.write(block.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header)
+            return
+        # 已有的数据从原来的 header 之后开始
+        f.seek(offset)
+        data = np.fromfile(f, dtype=DTYPE, count=rows * shape[1])
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(data.tobytes())
+        f.write(block.tobytes())
+    os.replace(tmp, filename)
+
+
+def _create(path, field, n_codes):
+    _save(path, field + '.npy', np.empty((0, n_codes), dtype=DTYPE))
+
+
+def _expand(path, field, n_rows, n_codes):
+    '''
+    新代码追加为 NaN 列
+    '''
+    old = np.load(_field_file(path, field), mmap_mode='r')[:n_rows]
+    values = np.full((n_rows, n_codes), np.nan, dtype=DTYPE)
+    values[:, :old.shape[1]] = old
+    _save(path, field + '.npy', values)
+
+
+def write_field(path, field, rows, block):
+    '''
+    从第 rows 行开始写入 block，用于 dense 之外生成的字段(见 tusharedb.indicators)
+    文件不存在时创建，代码增加时先追加 NaN 列
+    '''
+    path = _path(path)
+    n_codes = block.shape[1]
+    if not os.path.exists(_field_file(path, field)):
+        _create(path, field, n_codes)
+    elif np.load(_field_file(path, field), mmap_mode='r').shape[1] < n_codes:
+        _expand(path, field, rows, n_codes)
+    _write_rows(path, field, rows, block)
+
+
+def _universe(codes, new_codes):
+    '''
+    已有的代码顺序不变，新代码排序后追加
+    '''
+    known = set(codes)
+    extra = sorted({c for c in new_codes if c not in known})
+    if not extra:
+        return codes
+    return np.concatenate([codes, np.array(extra, dtype=str)])
+
+
+def _stock_basic_codes():
+    df = db.dbs[config.DT_NORMAL_STOCK_BASIC]().read(['ts_code'])
+    if df is None:
+        return np.array([], dtype=str)
+    return np.array(sorted(df['ts_code'].astype(str)), dtype=str)
+
+
+def load_axes(path=None):
+    path = _path(path)
+    dates = np.load(os.path.join(path, DATES_FILE))
+    codes = np.load(os.path.join(path, CODES_FILE))
+    return dates, codes
+
+
+def load(field, path=None, mmap_mode='r'):
+    '''
+    打开一个字段，不读入内存
+    '''
+    path = _path(path)
+    dates, codes = load_axes(path)
+    values = np.load(_field_file(path, field), mmap_mode=mmap_mode)
+    # update 中断时文件可能比轴多出行或列
+    return Panel(field, values[:len(dates), :len(codes)], dates, codes)
+
+
+def _fill(block, frames, field, code_index):
+    for i, df in enumerate(frames):
+        if df is None or field not in df:
+            continue
+        idx = code_index.get_indexer(df['ts_code'].astype(str))
+        block[i, idx] = pd.to_numeric(df[field], errors='coerce').values
+
+
+def update(path=None, fields=None, full=False, refresh=None):
+    '''
+    把 daily:* 中新的交易日追加到面板
+    @fields: {数据类型: [字段]}，默认 config.PANEL_FIELDS
+    @full: 重新生成所有字段
+    @refresh: 重新读取最后 refresh 个已有交易日，默认 config.PANEL_REFRESH_DAYS
+    return: 写入的交易日数量
+    '''
+    path = _path(path)
+    fields = fields or config.PANEL_FIELDS
+    refresh = config.PANEL_REFRESH_DAYS if refresh is None else refresh
+    os.makedirs(path, exist_ok=True)
+
+    with db.snapshot():
+        all_dates = np.array([int(k) for k in db.dbs[config.DT_DAILY_BFQ].list_keys() if k.isdigit()],
+                             dtype=np.int32)
+        if full or not os.path.exists(os.path.join(path, DATES_FILE)):
+            dates = np.array([], dtype=np.int32)
+            codes = _stock_basic_codes()
+            existing = set()
+        else:
+            dates, codes = load_axes(path)
+            existing = {f for names in fields.values() for f in names
+                        if os.path.exists(_field_file(path, f))}
+
+        rows = max(len(dates) - refresh, 0)
+        new_dates = all_dates[all_dates > dates[rows - 1]] if rows else all_dates
+        missing = [f for names in fields.values() for f in names if f not in existing]
+        if missing:
+            # 新字段需要从头生成，所有字段的行保持一致
+            rows = 0
+            new_dates = all_dates
+            for f in missing:
+                _create(path, f, len(codes))
+        if not len(new_dates):
+            return 0
+
+        n_codes = len(codes)
+        for start in range(0, len(new_dates), CHUNK_DAYS):
+            keys = [str(d) for d in new_dates[start:start + CHUNK_DAYS]]
+            frames = {}
+            for data_type, names in fields.items():
+                columns = ['ts_code'] + list(names)
+                found = dict(db.dbs[data_type].scan(keys, columns))
+                frames[data_type] = [found.get(k) for k in keys]
+
+            codes = _universe(codes, [c for dfs in frames.values() for df in dfs
+                                      if df is not None for c in df['ts_code'].astype(str)])
+            if len(codes) > n_codes:
+                logger.info('panel: %s new codes', len(codes) - n_codes)
+                for names in fields.values():
+                    for f in names:
+                        _expand(path, f, rows, len(codes))
+                n_codes = len(codes)
+            code_index = pd.Index(codes)
+
+            for data_type, names in fields.items():
+                for f in names:
+                    block = np.full((len(keys), len(codes)), np.nan, dtype=DTYPE)
+                    _fill(block, frames[data_type], f, code_index)
+                    _write_rows(path, f, rows, block)
+            rows += len(keys)
+
+        dates = np.concatenate([dates[:rows - len(new_dates)], new_dates]).astype(np.int32)
+        _save(path, CODES_FILE, codes)
+        _save(path, DATES_FILE, dates)
+    logger.info('panel: %s dates written, %s x %s', len(new_dates), len(dates), len(codes))
+    return len(new_dates)
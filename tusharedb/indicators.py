@@ -0,0 +1,274 @@
+'''
+技术指标，对 (交易日 × 代码) 的二维数组一次计算所有代码
+
+函数的输入输出都按交易日升序，也可以传入一维数组(单个代码)；缺失值(停牌)为 NaN，
+窗口内有缺失值时结果为 NaN，与 tushare.util.formula 一致。
+
+update 把 config.INDICATORS 中的指标写入稠密面板目录(见 tusharedb.dense)，
+每个指标一个 <字段>.npy。每次只计算面板新增的交易日和最后 refresh 个交易日:
+窗口指标从之前的输入行开始计算，EMA 保存 refresh 之前一行的状态 <字段>.state.npz。
+结果和状态按行列位置保存，_indicators.json 记录交易日和代码的摘要，面板的轴变化后从头计算。
+'''
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import config, dense
+
+logger = logging.getLogger(__name__)
+
+META_FILE = '_indicators.json'
+
+# 输入字段的后缀，例如 close:hfq 为 close * adj_factor
+HFQ_SUFFIX = ':hfq'
+
+
+def _float(x):
+    return np.asarray(x, dtype=np.float64)
+
+
+def rolling_mean(x, n):
+    '''
+    最近 n 行的均值，前 n - 1 行为 NaN
+    使用 pandas rolling(每列一次)，结果与 tushare MA 完全相同，取整后不会有差异
+    '''
+    x = _float(x)
+    if x.ndim == 1:
+        return np.asarray(pd.Series(x).rolling(n).mean())
+    return np.asarray(pd.DataFrame(x).rolling(n).mean())
+
+
+def shift(x, n=1):
+    '''
+    下移 n 行，即 n 个交易日之前的值
+    '''
+    x = _float(x)
+    out = np.full(x.shape, np.nan)
+    if n < len(x):
+        out[n:] = x[:len(x) - n]
+    return out
+
+
+def ma(close, n):
+    return rolling_mean(close, n)
+
+
+def ema(x, n, state=None, save_at=None):
+    '''
+    与 tushare EMA(ewm(span=n, adjust=True, min_periods=n - 1)) 相同，按行递推
+    @state: x 第一行之前的 (num, den, count)，None 从头开始
+    @save_at: 返回第 save_at 行之前的状态，默认最后一行之后
+    return: (values, state)
+    '''
+    x = _float(x)
+    decay = 1 - 2.0 / (n + 1)
+    shape = x.shape[1:]
+    if state is None:
+        num, den, count = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=np.int64)
+    else:
+        num, den, count = (np.array(a) for a in state)
+    save_at = len(x) if save_at is None else save_at
+
+    out = np.empty(x.shape)
+    saved = None
+    for i in range(len(x)):
+        if i == save_at:
+            saved = (num.copy(), den.copy(), count.copy())
+        valid = ~np.isnan(x[i])
+        num *= decay
+        den *= decay
+        num += np.where(valid, x[i], 0)
+        den += valid
+        count += valid
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[i] = np.where(count >= n - 1, num / den, np.nan)
+    if saved is None:
+        saved = (num, den, count)
+    return out, saved
+
+
+def true_range(high, low, close):
+    prev = shift(close)
+    high, low = _float(high), _float(low)
+    return np.maximum(np.maximum(high - low, np.abs(prev - high)), np.abs(prev - low))
+
+
+def atr(high, low, close, n=14):
+    '''
+    真实波幅的 n 日均值，与 tushare ATR 相同
+    '''
+    return rolling_mean(true_range(high, low, close), n)
+
+
+def volume_ratio(vol, n=5):
+    '''
+    量比: 当日成交量 / 之前 n 日平均成交量
+    '''
+    vol = _float(vol)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return vol / shift(rolling_mean(vol, n))
+
+
+def turnover(vol, float_share):
+    '''
+    换手率(%)，vol 单位为手，float_share 单位为万股
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _float(vol) / _float(float_share)
+
+
+# {名称: (函数, 计算一行需要之前的输入行数)}
+_WINDOWED = {
+    'ma': (ma, lambda n: n - 1),
+    'atr': (atr, lambda n: n),
+    'volume_ratio': (volume_ratio, lambda n: n),
+    'turnover': (turnover, lambda n: 0),
+}
+
+_RECURSIVE = {
+    'ema': ema,
+}
+
+
+def _spec(spec):
+    '''
+    (指标, [输入字段], 参数)，转换为可以和 json 比较的 list
+    '''
+    kind, inputs, param = spec
+    if kind not in _WINDOWED and kind not in _RECURSIVE:
+        raise ValueError('Unknown indicator %s' % kind)
+    return [kind, list(inputs), param]
+
+
+def _field_file(path, field):
+    return os.path.join(path, field + '.npy')
+
+
+def _load_input(path, field, start, stop):
+    '''
+    读取面板 [start, stop) 行，field:hfq 为 field * adj_factor
+    '''
+    if field.endswith(HFQ_SUFFIX):
+        field = field[:-len(HFQ_SUFFIX)]
+        return _load_input(path, field, start, stop) * _load_input(path, 'adj_factor', start, stop)
+    return np.array(dense.load(field, path).values[start:stop], dtype=np.float64)
+
+
+def _state_file(path, name):
+    return os.path.join(path, name + '.state.npz')
+
+
+def _load_meta(path):
+    filename = os.path.join(path, META_FILE)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _save_meta(path, meta):
+    filename = os.path.join(path, META_FILE)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def _load_state(path, name, row, n_codes):
+    '''
+    第 row 行之前的 EMA 状态，按代码位置保存，代码数量不同时不能使用
+    '''
+    filename = _state_file(path, name)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as f:
+        if int(f['row']) != row or len(f['num']) != n_codes:
+            return None
+        return f['num'], f['den'], f['count']
+
+
+def _save_state(path, name, row, state):
+    filename = _state_file(path, name)
+    num, den, count = state
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, row=row, num=num, den=den, count=count)
+    os.replace(filename + '.tmp', filename)
+
+
+def _digest(values):
+    h = hashlib.blake2b(digest_size=16)
+    for v in values:
+        h.update(str(v).encode())
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def _start(meta, spec, dates, codes_digest, refresh):
+    '''
+    需要重新计算的第一行
+    已有的结果和状态按行列位置保存，参数、交易日或代码(包括顺序)变化时从头计算
+    '''
+    if not meta or meta.get('spec') != spec:
+        return 0
+    rows = meta['rows']
+    if rows > len(dates) or meta.get('dates') != _digest(dates[:rows]) or \
+            meta.get('codes') != codes_digest:
+        return 0
+    return max(rows - refresh, 0)
+
+
+def update(path=None, indicators=None, full=False, refresh=None):
+    '''
+    计算面板中新的交易日的指标
+    @indicators: {字段: (指标, [输入字段], 参数)}，默认 config.INDICATORS
+    @full: 从头计算
+    @refresh: 重新计算最后 refresh 个已有交易日，默认 config.PANEL_REFRESH_DAYS，与 dense.update 一致
+    return: {字段: 计算的交易日数量}
+    '''
+    path = path or config.PANEL_DIR
+    if not path:
+        raise ValueError('panel path can not be none, set TS_PANEL_DIR')
+    indicators = config.INDICATORS if indicators is None else indicators
+    refresh = config.PANEL_REFRESH_DAYS if refresh is None else refresh
+    dates, codes = dense.load_axes(path)
+    n = len(dates)
+    metas = _load_meta(path)
+    dates_digest, codes_digest = _digest(dates), _digest(codes)
+    result = {}
+
+    for name, spec in indicators.items():
+        spec = _spec(spec)
+        kind, inputs, param = spec
+        start = 0 if full else _start(metas.get(name), spec, dates, codes_digest, refresh)
+        if start and not os.path.exists(_field_file(path, name)):
+            start = 0
+
+        if kind in _RECURSIVE:
+            state = _load_state(path, name, start, len(codes)) if start else None
+            if state is None:
+                start = 0
+            # 保存下次 update 开始的那一行之前的状态
+            save_row = max(n - refresh, start)
+            values, state = _RECURSIVE[kind](
+                _load_input(path, inputs[0], start, n), param, state, save_row - start)
+            _save_state(path, name, save_row, state)
+        else:
+            func, lookback = _WINDOWED[kind]
+            lo = max(start - lookback(param), 0)
+            args = [_load_input(path, f, lo, n) for f in inputs]
+            if param is not None:
+                args.append(param)
+            values = func(*args)[start - lo:]
+
+        if start == 0 and os.path.exists(_field_file(path, name)):
+            os.remove(_field_file(path, name))
+        dense.write_field(path, name, start, values)
+        metas[name] = {'spec': spec, 'rows': n,
+                       'dates': dates_digest, 'codes': codes_digest}
+        _save_meta(path, metas)
+        result[name] = n - start
+        logger.info('indicator %s: %s dates computed', name, n - start)
+    return result
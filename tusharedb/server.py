@@ -0,0 +1,212 @@
+'''
+本地读服务
+
+只有一个进程能打开 LevelDB，tusharedb serve 持有数据库和查询缓存，
+其他进程通过 Unix socket 查询，DataApi(server=...) 为客户端模式。
+
+协议: 每个帧为 8 字节长度 + 内容
+    请求: 1 帧 json {method, api_name, kwargs, native_dtypes, format}
+    响应: 1 帧 json {status, format, ...} + 数据帧
+        arrow: 1 帧 Arrow IPC stream
+        columns: index 1 帧 + 每列 1 帧，编码见 tusharedb.codec
+'''
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from tusharedb import codec, config
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_ARROW = 'arrow'
+FORMAT_COLUMNS = 'columns'
+
+_FRAME_LEN = struct.Struct('<Q')
+
+
+def send_frame(sock, data):
+    sock.sendall(_FRAME_LEN.pack(len(data)))
+    sock.sendall(data)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        size = sock.recv_into(view[pos:], n - pos)
+        if not size:
+            raise EOFError('connection closed')
+        pos += size
+    return buf
+
+
+def recv_frame(sock):
+    n, = _FRAME_LEN.unpack(_recv_exact(sock, _FRAME_LEN.size))
+    return _recv_exact(sock, n)
+
+
+def send_json(sock, obj):
+    send_frame(sock, json.dumps(obj).encode())
+
+
+def recv_json(sock):
+    return json.loads(bytes(recv_frame(sock)).decode())
+
+
+def send_df(sock, df, fmt):
+    # object 列(例如 output_df 转换的字符串)在客户端会被推断为 str，按列名恢复
+    objects = [c for c in df.columns if df[c].dtype == object]
+    if fmt == FORMAT_ARROW:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        send_json(sock, {'status': 'ok', 'format': fmt, 'objects': objects})
+        send_frame(sock, sink.getvalue())
+        return
+
+    categories = [c for c in df.columns if df[c].dtype.name == 'category']
+    send_json(sock, {'status': 'ok', 'format': fmt, 'objects': objects,
+                     'columns': list(df.columns), 'categories': categories})
+    send_frame(sock, codec.encode_index(df.index))
+    for c in df.columns:
+        spec = codec.CODEC_DICT if c in categories else None
+        send_frame(sock, codec.encode_array(np.asarray(df[c].values), spec))
+
+
+def recv_df(sock, header):
+    '''
+    列类型与服务端的 DataFrame 相同，见 send_df
+    '''
+    if header['format'] == FORMAT_ARROW:
+        df = pa.ipc.open_stream(recv_frame(sock)).read_all().to_pandas()
+    else:
+        index = codec.decode_index(recv_frame(sock))
+        data = {}
+        for c in header['columns']:
+            data[c] = codec.decode_array(recv_frame(sock),
+                                         as_category=c in header['categories'])
+        df = pd.DataFrame(data=data, index=index, columns=header['columns'], copy=False)
+    objects = [c for c in header.get('objects', ()) if df[c].dtype != object]
+    return df.astype({c: object for c in objects}) if objects else df
+
+
+class Client:
+
+    def __init__(self, address=None):
+        self.address = address or config.SERVER_ADDRESS
+        self.format = FORMAT_ARROW if pa is not None else FORMAT_COLUMNS
+        self._sock = None
+        self._lock = Lock()
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.address)
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def call(self, method, api_name=None, native_dtypes=False, **kwargs):
+        request = {'method': method, 'api_name': api_name, 'kwargs': kwargs,
+                   'native_dtypes': native_dtypes, 'format': self.format}
+        with self._lock:
+            try:
+                sock = self._connect()
+                send_json(sock, request)
+                header = recv_json(sock)
+                if header['status'] == 'ok':
+                    return recv_df(sock, header)
+            except (OSError, EOFError):
+                self.close()
+                raise
+        if header['status'] == 'none':
+            return None
+        elif header['status'] == 'value':
+            return header['value']
+        raise RuntimeError('tusharedb server error: %s' % header.get('error'))
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_json(self.request)
+            except EOFError:
+                return
+            try:
+                result = self.server.dispatch(request)
+            except Exception as e:
+                logger.exception(e)
+                send_json(self.request, {'status': 'error', 'error': str(e)})
+                continue
+
+            if result is None:
+                send_json(self.request, {'status': 'none'})
+            elif isinstance(result, pd.DataFrame):
+                fmt = request.get('format', FORMAT_COLUMNS)
+                if fmt == FORMAT_ARROW and pa is None:
+                    fmt = FORMAT_COLUMNS
+                send_df(self.request, result, fmt)
+            else:
+                send_json(self.request, {'status': 'value', 'value': result})
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, apis):
+        '''
+        @apis: {native_dtypes: DataApi}
+        '''
+        self.apis = apis
+        if os.path.exists(address):
+            os.unlink(address)
+        super().__init__(address, RequestHandler)
+
+    def dispatch(self, request):
+        api = self.apis[bool(request.get('native_dtypes'))]
+        method = request['method']
+        kwargs = request.get('kwargs') or {}
+        if method == 'query':
+            # 服务端只读本地数据库，失败时由客户端决定是否请求 tushare
+            return api._query_db(request['api_name'], **kwargs)
+        elif method == 'panel':
+            return api.panel(request['api_name'], **kwargs)
+        elif method == 'cache_info':
+            return api.cache_info()._asdict()
+        raise ValueError('Unknown method %s' % method)
+
+
+def serve(address=None):
+    from tusharedb.api import DataApi
+
+    address = address or config.SERVER_ADDRESS
+    if not address:
+        raise ValueError('server address can not be none, set TS_SERVER')
+    apis = {False: DataApi(native_dtypes=False),
+            True: DataApi(native_dtypes=True)}
+    server = Server(address, apis)
+    logger.info('tusharedb server listening on %s', address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(address)
@@ -1,86 +1,264 @@
 import datetime
+import itertools
 import logging
+import queue
+import threading
 
 import click
 import pandas as pd
 import tushare as ts
 
-from tusharedb import config, db, util
+from tusharedb import adjust, config, db, dense, indicators, util
 
 api = ts.pro_api(token=config.TS_TOKEN)
 logger = logging.getLogger(__name__)
 
 
+def sync_trade_cal():
+    '''
+    交易日历保存在本地，tushare 返回到当年年底
+    '''
+    df = util.query(api, 'trade_cal', exchange=config.TRADE_CAL_EXCHANGE,
+                    start_date=config.SYNC_START.replace('-', ''),
+                    end_date=datetime.datetime.now().strftime('%Y1231'),
+                    fields='cal_date,is_open')
+    db.dbs[config.DT_NORMAL_TRADE_CAL]().replace(df)
+    return df
+
+
+def trade_dates(start_date, end_date):
+    '''
+    [start_date, end_date] 内的交易日 YYYYMMDD，本地日历没有覆盖 end_date 时重新获取
+    '''
+    start_date = str(config.to_date(start_date))
+    end_date = str(config.to_date(end_date))
+    df = db.dbs[config.DT_NORMAL_TRADE_CAL]().read()
+    if df is None or df.empty or df['cal_date'].max() < end_date:
+        logger.info('fetch trade_cal from tushare')
+        df = sync_trade_cal()
+    df = df[(df['is_open'].astype(int) == 1) &
+            (df['cal_date'] >= start_date) & (df['cal_date'] <= end_date)]
+    return sorted(df['cal_date'])
+
+
+def plan(name, start_date=config.SYNC_START, stale_days=config.SYNC_STALE_DAYS):
+    '''
+    需要获取的交易日: 未完成的，以及最近 stale_days 天的
+    @name: StateDb 中记录完成日期的名字，例如 daily
+    '''
+    sate = db.StateDb()
+    done = set(getattr(sate, 'list_' + name)())
+    now = datetime.datetime.now()
+    stale = (now - datetime.timedelta(days=stale_days)).strftime('%Y%m%d')
+    return [date for date in trade_dates(start_date, now)
+            if date not in done or date >= stale]
+
+
+def pipeline(items, fetch, write, workers=None, label=None, queue_size=None):
+    '''
+    fetch(item) 在线程池中并发执行，请求速度由 util.query 的令牌桶控制；
+    结果放入有界队列，由当前线程依次 write(item, result)，只有一个线程写数据库
+    fetch 出错时停止获取新的 item，出错的 item 已获取的窗口暂存到 StageDb(见 _fetch_window)，
+    已获取的结果写完后抛出异常
+    '''
+    workers = workers or config.THREAD_POOL_SIZE
+    results = queue.Queue(maxsize=queue_size or workers * 2)
+    items = list(items)
+    it = iter(items)
+    lock = threading.Lock()
+    stop = threading.Event()
+    done = object()
+
+    def _worker():
+        try:
+            while not stop.is_set():
+                with lock:
+                    item = next(it, done)
+                if item is done:
+                    break
+                _fetched.windows = []
+                try:
+                    results.put((item, fetch(item), None))
+                except Exception as e:
+                    stop.set()
+                    results.put((item, _fetched.windows, e))
+        finally:
+            results.put(done)
+
+    threads = [threading.Thread(target=_worker, daemon=True)
+               for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+
+    error = None
+    running = len(threads)
+    try:
+        with click.progressbar(length=len(items), label=label) as bar:
+            while running:
+                r = results.get()
+                if r is done:
+                    running -= 1
+                    continue
+                item, result, e = r
+                if e is not None:
+                    logger.error('fetch %s error: %s', item, e)
+                    error = error or e
+                    _stage_windows(result)
+                else:
+                    write(item, result)
+                bar.update(1)
+    finally:
+        # write 出错时队列可能已满，取出剩余结果让线程退出
+        stop.set()
+        while running:
+            if results.get() is done:
+                running -= 1
+        for t in threads:
+            t.join()
+    if error is not None:
+        raise error
+
+
+# 当前线程 fetch 的 item 中已请求的窗口 [(name, df, end)]，fetch 出错时交给写线程暂存
+_fetched = threading.local()
+
+
+def _next_day(date):
+    return (datetime.datetime.strptime(date, '%Y%m%d') + datetime.timedelta(days=1)).strftime('%Y%m%d')
+
+
+def _fetch_window(api_name, key, window, end=None, **kwargs):
+    '''
+    按 (api_name, key, window) 记录进度，window 是窗口的开始，不随运行的日期变化，窗口的结束 end 保存在进度记录中
+    item 获取出错时已请求的窗口由 pipeline 的写线程暂存在 StageDb，重新运行时读取已暂存的窗口，
+    只请求暂存的 end 之后的部分；item 成功时不暂存，直接写入正式存储
+    @end: 窗口结束日期 YYYYMMDD，即 kwargs 中的 end_date，None 表示窗口不会变化
+    '''
+    name = '%s:%s:%s' % (api_name, key, window)
+    staged = db.StateDb().get_window(name)
+    if staged is None:
+        df = util.query(api, api_name, **kwargs)
+    else:
+        df = db.StageDb(name).read()
+        df = df if df is not None else pd.DataFrame()
+        if end is None or staged >= end:
+            logger.debug('resume %s from stage', name)
+            return df
+        # 上次运行时窗口结束得更早，只请求之后的部分，结果按 trade_date 降序
+        logger.debug('resume %s from stage, fetch %s-%s', name, _next_day(staged), end)
+        tail = util.query(api, api_name, **dict(kwargs, start_date=_next_day(staged)))
+        df = pd.concat([tail, df], ignore_index=True)
+
+    windows = getattr(_fetched, 'windows', None)
+    if windows is not None:
+        windows.append((name, df, end))
+    return df
+
+
+def _stage_windows(windows):
+    '''
+    在写线程中暂存窗口，结果和进度在同一个 WriteBatch 中写入
+    '''
+    if not windows:
+        return
+    sate = db.StateDb()
+    with sate.write_batch() as b:
+        for name, df, end in windows:
+            db.StageDb(name).replace(df, wb=b)
+            sate.append_window(name, wb=b, data=end or '1')
+
+
+def _clear_windows(apis, key):
+    for api_name in apis:
+        db.StageDb.clear('%s:%s:' % (api_name, key))
+
+
 def sync_daily():
     sate = db.StateDb()
-    dates = [date for date in sate.list_daily()]
     apis = ['daily', 'adj_factor', 'daily_basic']
     # apis = ['daily_basic', ]
     # methods = {'daily': db.dbs[config.DT_DAILY_BFQ],
     #            'adj_factor': db.dbs[config.DT_DAILY_ADJFACTOR], 'daily_basic': db.dbs[config.DT_DAILY_BASIC]}
-    with click.progressbar(pd.date_range(config.SYNC_START, datetime.datetime.now())) as bar:
-        for date in bar:
 
-            _date = date.strftime('%Y%m%d')
-            # 重新收集近2天数据
-            if _date in dates and date < (datetime.datetime.now() - datetime.timedelta(days=2)):
+    def fetch(_date):
+        to_save = {}
+        for api_name in apis:
+            logger.debug(
+                'fetch data from tushare, api_name: %s, trade_date: %s', api_name, _date)
+            df = _fetch_window(api_name, _date, _date, trade_date=_date)
+            if df.empty:
                 continue
-            for api_name in apis:
-                logger.debug(
-                    'fetch data from tushare, api_name: %s, trade_date: %s', api_name, _date)
-                util.speed_it()
-                df = api.query(api_name, trade_date=_date)
-                if df.empty:
-                    continue
-                else:
-                    api_type = config.API_TYPE_TRADE_DATE
-                    dbcls_config = config.get_write_api_db(api_name, api_type)
-                    dbcls = db.dbs[dbcls_config]
-                    dbcls(_date).save(df)
-            sate.append_daily(_date)
+            else:
+                api_type = config.API_TYPE_TRADE_DATE
+                dbcls_config = config.get_write_api_db(api_name, api_type)
+                to_save[(dbcls_config, _date)] = df
+        return to_save
+
+    def write(_date, to_save):
+        db.dbs.save_many(to_save)
+        sate.append_daily(_date)
+        _clear_windows(apis, _date)
+
+    pipeline(plan('daily'), fetch, write)
+
+    if config.PANEL_DIR:
+        dense.update()
+        indicators.update()
+
 
+def _fetch_code_window(api_name, code, start_date, end_date):
+    start_date = start_date.strftime('%Y%m%d')
+    end_date = end_date.strftime('%Y%m%d')
+    return _fetch_window(api_name, code, start_date, end=end_date,
+                         ts_code=code, start_date=start_date, end_date=end_date)
 
-def _sync_code(start, end, apis, recent, ok_codes, callback, ):
-    codes = api.stock_basic(list_status='L',
-                            fields='ts_code')
+
+def _sync_code(start, end, apis, recent, ok_codes, callback, append=False):
+    '''
+    @append: 从已保存的最后一个交易日开始获取，按 trade_date upsert，不重写历史
+    '''
+    codes = util.query(api, 'stock_basic', list_status='L',
+                       fields='ts_code')
     codes = codes.ts_code
-    sate = db.StateDb()
+    ok_codes = set(ok_codes)
     # codes = ['601600.SH', '601601.SH']
-    with click.progressbar(codes) as bar:
 
-        for code in bar:
-            if code in ok_codes:
-                logger.debug('pass %s', code)
-                continue
-            for api_name in apis:
-                dfs = []
-                start_date = start
-                config_end_date = end
-                for end_date in pd.date_range(start=start_date, end=config_end_date, freq='5Y'):
-                    util.speed_it()
-                    logger.debug('fetch data from tushare, api_name: %s, ts_code:%s, start_date: %s, end_date:%s',
-                                 api_name, code, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
-                    dfs.append(api.query(api_name, ts_code=code,
-                                         start_date=start_date.strftime('%Y%m%d'), end_date=end_date.strftime('%Y%m%d')))
-
-                    start_date = end_date + datetime.timedelta(days=1)
+    def fetch(code):
+        to_save = {}
+        for api_name in apis:
+            db_config = config.get_write_api_db(
+                api_name, config.API_TYPE_TS_CODE, recent=recent)
+            dfs = []
+            start_date = start
+            config_end_date = end
+            if append:
+                last_date = db.dbs[db_config](code).last_date()
+                if last_date:
+                    start_date = max(start, datetime.datetime.strptime(
+                        str(last_date), '%Y%m%d'))
+            for end_date in pd.date_range(start=start_date, end=config_end_date, freq='5Y'):
                 logger.debug('fetch data from tushare, api_name: %s, ts_code:%s, start_date: %s, end_date:%s',
-                             api_name, code, start_date.strftime('%Y%m%d'), config_end_date.strftime('%Y%m%d'))
-                util.speed_it()
-                dfs.append(api.query(api_name, ts_code=code,
-                                     start_date=start_date.strftime('%Y%m%d'), end_date=config_end_date.strftime('%Y%m%d')))
+                             api_name, code, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+                dfs.append(_fetch_code_window(api_name, code, start_date, end_date))
 
-                df = pd.concat(dfs)
-                if df.empty:
-                    continue
-                else:
-                    db_config = config.get_write_api_db(
-                        api_name, config.API_TYPE_TS_CODE, recent=recent)
-                    dbcls = db.dbs[db_config]
-                    dbcls(code).delete()
-                    dbcls(code).save(df)
+                start_date = end_date + datetime.timedelta(days=1)
+            logger.debug('fetch data from tushare, api_name: %s, ts_code:%s, start_date: %s, end_date:%s',
+                         api_name, code, start_date.strftime('%Y%m%d'), config_end_date.strftime('%Y%m%d'))
+            dfs.append(_fetch_code_window(api_name, code, start_date, config_end_date))
+
+            df = pd.concat(dfs)
+            if df.empty:
+                continue
+            else:
+                to_save[(db_config, code)] = df
+        return to_save
 
-            callback(code)
+    def write(code, to_save):
+        db.dbs.save_many(to_save, 'append' if append else 'replace')
+        callback(code)
+        _clear_windows(apis, code)
+
+    pipeline([code for code in codes if code not in ok_codes], fetch, write)
 
 
 def sync_code_history():
@@ -110,11 +288,117 @@ def sync_code_recent(nocache=True):
 
     ok_codes = [date for date in sate.list_recentcode()]
 
-    _sync_code(start, end, apis, True, ok_codes, sate.append_recentcode)
+    _sync_code(start, end, apis, True, ok_codes,
+               sate.append_recentcode, append=True)
 
     # 正常结束，去掉cache记录
     sate.delete_recentcode()
 
+    if config.ADJ_STORES:
+        sync_adj()
+
+
+def rebuild_code_stores(apis=('daily', 'adj_factor', 'daily_basic')):
+    '''
+    不请求 tushare，把按日期保存的数据转置为按代码保存
+    每次读取一年的 daily 数据，按 ts_code 拆分后追加到 code 存储的年分区，内存占用与总年数无关；
+    sync_code_history_end 之前的写入历史存储，之后的写入 recent 存储
+    '''
+    sate = db.StateDb()
+    history_end = config.to_date(sate.sync_code_history_end)
+    for api_name in apis:
+        for recent in (False, True):
+            db.dbs[config.get_write_api_db(
+                api_name, config.API_TYPE_TS_CODE, recent=recent)].clear()
+    sate.delete_code()
+
+    items = []
+    for api_name in apis:
+        dbcls = db.dbs[config.get_write_api_db(api_name, config.API_TYPE_TRADE_DATE)]
+        dates = [key for key in dbcls.list_keys() if key.isdigit()]
+        for year, keys in itertools.groupby(dates, lambda key: key[:4]):
+            items.append((api_name, year, list(keys)))
+
+    def fetch(item):
+        api_name, year, keys = item
+        dbcls = db.dbs[config.get_write_api_db(api_name, config.API_TYPE_TRADE_DATE)]
+        dfs = [df for _, df in dbcls.scan(keys)]
+        if not dfs:
+            return {}
+        df = pd.concat(dfs, ignore_index=True, sort=False)
+        recent = df['trade_date'].astype(int).values > history_end
+        to_save = {}
+        for is_recent in (False, True):
+            part = df[recent == is_recent]
+            if part.empty:
+                continue
+            db_config = config.get_write_api_db(
+                api_name, config.API_TYPE_TS_CODE, recent=is_recent)
+            for code, rows in part.groupby(part['ts_code'].astype(str), sort=True):
+                to_save[(db_config, code)] = rows.reset_index(drop=True)
+        return to_save
+
+    history_dbs = {config.get_write_api_db(api_name, config.API_TYPE_TS_CODE, recent=False)
+                   for api_name in apis}
+    codes = set()
+
+    def write(item, to_save):
+        db.dbs.save_many(to_save, 'append')
+        codes.update(code for db_config, code in to_save if db_config in history_dbs)
+
+    # 同时最多 workers + queue_size 年的数据在内存中
+    pipeline(items, fetch, write, workers=2, label='Rebuild:', queue_size=1)
+    with sate.batch() as b:
+        for code in codes:
+            sate.append_code(code, wb=b)
+
+
+def _read_code(api_name, code, start_date=None):
+    '''
+    合并 history 和 recent 存储中一个代码 start_date 及之后的数据，按 trade_date 降序
+    '''
+    dfs = [db.dbs[db_config](code).read(start_date=start_date)
+           for db_config in config.get_api_db(api_name, config.API_TYPE_TS_CODE)]
+    dfs = [df for df in dfs if df is not None]
+    if not dfs:
+        return None
+    df = db.merge_segments(dfs)
+    if start_date:
+        df = df[df['trade_date'].astype(int).values >= config.to_date(start_date)]
+    return df
+
+
+def sync_adj(codes=None, full=False):
+    '''
+    不请求 tushare，由 code 存储中的 daily 和 adj_factor 生成 code:qfq, code:hfq
+    每个代码从 code:hfq 的最后一个交易日开始追加，已有的行不会改变:
+    hfq 与最新因子无关，qfq 保存 价格 * adj_factor，读取时除以最新因子
+    @full: 清空后重新生成
+    '''
+    if full:
+        for db_config in (config.DT_CODE_QFQ, config.DT_CODE_HFQ):
+            db.dbs[db_config].clear()
+    if codes is None:
+        codes = sorted({code for db_config in config.get_api_db('daily', config.API_TYPE_TS_CODE)
+                        for code in db.dbs[db_config].list_keys()})
+
+    def fetch(code):
+        # 从最后一个交易日开始读取，缺失的因子可以用上一个交易日填充
+        last = db.dbs[config.DT_CODE_HFQ](code).last_date()
+        bars = _read_code('daily', code, last)
+        fcts = _read_code('adj_factor', code, last)
+        if bars is None or bars.empty or fcts is None:
+            return {}
+        data = bars.merge(fcts[['trade_date', 'adj_factor']], on='trade_date', how='left')
+        data = adjust.fill_factor(data)
+        return {(config.DT_CODE_HFQ, code): adjust.adjust(data, 'hfq'),
+                (config.DT_CODE_QFQ, code): adjust.scale(data)}
+
+    def write(code, to_save):
+        db.dbs.save_many(to_save, 'append')
+
+    pipeline(codes, fetch, write, label='Adj:')
+
 
 def sync_index():
     api_names = ['index_daily', ]
@@ -123,95 +407,162 @@ def sync_index():
     # codes = ['601600.SH', '601601.SH']
     start = datetime.datetime.strptime(config.SYNC_START, '%Y-%m-%d')
     end = datetime.datetime.now()
-    with click.progressbar(codes) as bar:
-        for code in bar:
-            for api_name in api_names:
-                dfs = []
-                start_date = start
-                config_end_date = end
-                for end_date in pd.date_range(start=start_date, end=config_end_date, freq='5Y'):
-                    logger.debug('%s,%s,%s,%s', api_name,
-                                 code, start_date, end_date)
-                    util.speed_20_per_min()
-                    dfs.append(api.query(api_name, ts_code=code,
-                                         start_date=start_date.strftime('%Y%m%d'), end_date=end_date.strftime('%Y%m%d')))
-
-                    start_date = end_date + datetime.timedelta(days=1)
+
+    def fetch(code):
+        to_save = {}
+        for api_name in api_names:
+            dfs = []
+            start_date = start
+            config_end_date = end
+            for end_date in pd.date_range(start=start_date, end=config_end_date, freq='5Y'):
                 logger.debug('%s,%s,%s,%s', api_name,
-                             code, start_date, config_end_date)
-                util.speed_20_per_min()
-                dfs.append(api.query(api_name, ts_code=code,
-                                     start_date=start_date.strftime('%Y%m%d'), end_date=config_end_date.strftime('%Y%m%d')))
-
-                df = pd.concat(dfs)
-                df = df.sort_values('trade_date')
-                df.index = pd.DatetimeIndex(df.trade_date)
-                df = df.reindex(pd.date_range(
-                    df.index[0], df.index[-1]), method='bfill')
-                df = df.assign(trade_date=df.index.strftime('%Y%m%d'))
-                if df.empty:
-                    continue
+                             code, start_date, end_date)
+                dfs.append(_fetch_code_window(api_name, code, start_date, end_date))
+
+                start_date = end_date + datetime.timedelta(days=1)
+            logger.debug('%s,%s,%s,%s', api_name,
+                         code, start_date, config_end_date)
+            dfs.append(_fetch_code_window(api_name, code, start_date, config_end_date))
+
+            df = pd.concat(dfs)
+            df = df.sort_values('trade_date')
+            df.index = pd.DatetimeIndex(df.trade_date)
+            df = df.reindex(pd.date_range(
+                df.index[0], df.index[-1]), method='bfill')
+            df = df.assign(trade_date=df.index.strftime('%Y%m%d'))
+            if df.empty:
+                continue
+            else:
+                dbcls_config = config.get_write_api_db(
+                    api_name, config.API_TYPE_TS_CODE)
+                to_save[(dbcls_config, code)] = df
+        return to_save
+
+    def write(code, to_save):
+        db.dbs.save_many(to_save)
+        _clear_windows(api_names, code)
+
+    pipeline(codes, fetch, write)
+
+
+def merge_code(end=None, apis=('daily', 'adj_factor', 'daily_basic')):
+    '''
+    把 recent 存储中 end 及之前的数据合并到历史存储，推进 sync_code_history_end，
+    之后压缩 recent 存储释放的 key 范围
+    每个代码的迁移在一个 WriteBatch 中提交，任何时刻一行只在一个存储中；中断后重新运行即可
+    @end: YYYYMMDD，默认 SYNC_STALE_DAYS 天前
+    '''
+    sate = db.StateDb()
+    if end is None:
+        end = (datetime.datetime.now() -
+               datetime.timedelta(days=config.SYNC_STALE_DAYS)).strftime('%Y%m%d')
+    end = config.to_date(end)
+    if end <= config.to_date(sate.sync_code_history_end):
+        logger.info('sync_code_history_end is already %s', sate.sync_code_history_end)
+        return
+
+    pairs = [(config.get_write_api_db(api_name, config.API_TYPE_TS_CODE, recent=True),
+              config.get_write_api_db(api_name, config.API_TYPE_TS_CODE, recent=False))
+             for api_name in apis]
+    codes = sorted({code for recent_db, _ in pairs
+                    for code in db.dbs[recent_db].list_keys()})
+
+    def fetch(code):
+        moves = []
+        for recent_db, history_db in pairs:
+            recent = db.dbs[recent_db](code)
+            df = recent.read()
+            if df is None:
+                continue
+            old = df['trade_date'].astype(int).values <= end
+            if old.any():
+                moves.append((recent, db.dbs[history_db](code), df[old], df[~old]))
+        return moves
+
+    def write(code, moves):
+        if not moves:
+            return
+        with db.Db().write_batch() as wb:
+            for recent, history, old, rest in moves:
+                history.append(old, wb=wb)
+                if rest.empty:
+                    recent.delete(wb=wb)
                 else:
-                    dbcls_config = config.get_write_api_db(
-                        api_name, config.API_TYPE_TS_CODE)
-                    dbcls = db.dbs[dbcls_config]
-                    dbcls(code).save(df)
+                    recent.replace(rest, wb=wb)
+        for recent, history, _, _ in moves:
+            recent.on_write()
+            history.on_write()
+            # 合并 append 产生的 segment
+            history.compact()
 
+    pipeline(codes, fetch, write, label='Merge:')
 
-def merge_code():
-    pass
+    end = datetime.datetime.strptime(str(end), '%Y%m%d').strftime('%Y-%m-%d')
+    sate.sync_code_history_end = end
+    root = db.Db().root
+    for recent_db, _ in pairs:
+        prefix = db.force_bytes(db.dbs[recent_db].prefix)
+        root.compact_range(start=prefix, stop=prefix + b'\xff')
 
 
 def sync_stock_basic():
     dbcls = db.dbs[config.get_write_api_db(
         'stock_basic', config.API_TYPE_NORMAL)]
 
-    df = api.stock_basic(
+    df = util.query(
+        api, 'stock_basic',
         fields='ts_code,symbol,name,area,industry,fullname,enname,market,exchange,curr_type,list_status,list_date,delist_date,is_hs')
-    dbcls().save(df)
+    dbcls().replace(df)
 
 
 def sync_news():
     sate = db.StateDb()
-    dates = [date for date in sate.list_news()]
+    dates = set(sate.list_news())
     apis = ['news']
     # apis = ['daily_basic', ]
     # methods = {'daily': db.dbs[config.DT_DAILY_BFQ],
     #            'adj_factor': db.dbs[config.DT_DAILY_ADJFACTOR], 'daily_basic': db.dbs[config.DT_DAILY_BASIC]}
-    with click.progressbar(pd.date_range('2018-10-11', datetime.datetime.now())) as bar:
-
-        for date in bar:
-            _date = date.strftime('%Y%m%d')
-            # 重新收集近2天数据
-            if _date in dates and date < (datetime.datetime.now() - datetime.timedelta(days=2)):
-                logger.debug('pass %s' % _date)
+    todo = []
+    for date in pd.date_range('2018-10-11', datetime.datetime.now()):
+        _date = date.strftime('%Y%m%d')
+        # 重新收集近2天数据
+        if _date in dates and date < (datetime.datetime.now() - datetime.timedelta(days=2)):
+            logger.debug('pass %s' % _date)
+            continue
+        todo.append(date)
+
+    def fetch(date):
+        _date = date.strftime('%Y%m%d')
+        to_save = {}
+        for api_name in apis:
+            start_date = date.strftime('%Y%m%d %H:%M:%S')
+            dfs = []
+            for end_date in pd.date_range(date, date + datetime.timedelta(days=1), freq='8h')[1:]:
+                end_date = end_date.strftime('%Y%m%d %H:%M:%S')
+                logger.debug(
+                    'fetch data from tushare, api_name: %s, start_date: %s, end_date:%s', api_name, start_date,  _date)
+                tmp = _fetch_window(api_name, _date, '%s-%s' % (start_date, end_date),
+                                    start_date=start_date, end_date=end_date)
+                dfs.append(tmp)
+                logger.debug('%s rows', len(tmp))
+                start_date = end_date
+
+            df = pd.concat(dfs)
+            if df.empty:
                 continue
-            for api_name in apis:
-                start_date = date.strftime('%Y%m%d %H:%M:%S')
-                dfs = []
-                for end_date in pd.date_range(date, date + datetime.timedelta(days=1), freq='8h')[1:]:
-                    end_date = end_date.strftime('%Y%m%d %H:%M:%S')
-                    logger.debug(
-                        'fetch data from tushare, api_name: %s, start_date: %s, end_date:%s', api_name, start_date,  _date)
-                    util.speed_10_per_min()
-                    tmp = api.query(
-                        api_name, start_date=start_date, end_date=end_date)
-                    dfs.append(tmp)
-                    print(len(tmp))
-                    start_date = end_date
-
-                df = pd.concat(dfs)
-                if df.empty:
-                    sate.append_news(_date)
-                    continue
-                else:
-                    api_type = config.API_TYPE_TRADE_DATE
-                    dbcls_config = config.get_write_api_db(
-                        api_name, api_type)
-                    dbcls = db.dbs[dbcls_config]
-                    dbcls(_date).save(df)
-
-            sate.append_news(_date)
+            else:
+                api_type = config.API_TYPE_TRADE_DATE
+                dbcls_config = config.get_write_api_db(
+                    api_name, api_type)
+                to_save[(dbcls_config, _date)] = df
+        return to_save
+
+    def write(date, to_save):
+        db.dbs.save_many(to_save)
+        sate.append_news(date.strftime('%Y%m%d'))
+        _clear_windows(apis, date.strftime('%Y%m%d'))
+
+    pipeline(todo, fetch, write)
 
 
 if __name__ == "__main__":
@@ -1,44 +1,117 @@
+import contextlib
 import logging
+import os
+import struct
+import threading
 import time
 
+from tusharedb import config
 
-def speed_fun(minutes=1, max_cnt=200):
-    cnt = 0
-    start = None
-    sum_ = 0
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-    def cal():
-        sec = minutes * 60
-        nonlocal cnt, start, sum_
-        if start is None:
-            start = time.time()
-            return
-        end = time.time()
-        cnt += 1
-        sum_ += (end - start)
 
-        if cnt >= max_cnt:
-            logging.debug('Start sleep... sleep time: %s', sec-sum_+1)
-            time.sleep(sec-sum_ + 1)
-            cnt = 0
-            sum_ = 0
-            start = None
-            logging.debug('Stop sleep...')
-        else:
-            start = end
+class TokenBucket:
+    '''
+    令牌桶，状态保存在文件中，多个进程通过 flock 共享同一个桶
+    @rate: 每分钟令牌数
+    @capacity: 桶容量，1 表示请求按 60/rate 秒均匀发出，任意一分钟内不会超过 rate
+    '''
+    _state = struct.Struct('<ddd')  # tokens, 更新时间, 退避秒数
 
-        if sum_ > sec:
-            logging.debug('Reset without sleep')
-            cnt = 0
-            sum_ = 0
-            start = None
+    def __init__(self, name, rate, capacity=1, path=None):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        path = path or config.RATE_LIMIT_DIR
+        os.makedirs(path, exist_ok=True)
+        self.filename = os.path.join(path, name + '.bucket')
+        self._lock = threading.Lock()
 
-        logging.debug('cnt: %s, sum_: %s', cnt, sum_)
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, self._state.size, 0)
+                if len(data) == self._state.size:
+                    state = list(self._state.unpack(data))
+                else:
+                    state = [self.capacity, time.time(), 0.]
+                yield state
+                os.pwrite(fd, self._state.pack(*state), 0)
+            finally:
+                os.close(fd)
 
-    return cal
+    def acquire(self):
+        '''
+        取一个令牌，没有令牌时睡眠到下一个令牌产生
+        '''
+        while True:
+            with self._locked() as state:
+                tokens, updated, _ = state
+                now = time.time()
+                if now > updated:
+                    tokens = min(self.capacity, tokens + (now - updated) * self.rate / 60)
+                    updated = now
+                if tokens >= 1:
+                    state[0], state[1] = tokens - 1, updated
+                    return
+                state[0], state[1] = tokens, updated
+                wait = max(updated - now, 0) + (1 - tokens) * 60 / self.rate
+            logging.debug('%s: wait %.2fs for token', self.name, wait)
+            time.sleep(wait)
 
+    def backoff(self):
+        '''
+        被限流时清空令牌并暂停，连续限流时暂停时间翻倍，最长 60 秒
+        '''
+        with self._locked() as state:
+            state[2] = min(max(state[2] * 2, 60 / self.rate, 1.), 60.)
+            state[0] = 0.
+            state[1] = max(state[1], time.time()) + state[2]
+            logging.warning('%s: throttled, back off %.1fs', self.name, state[2])
 
-speed_it = speed_fun()
+    def reset(self):
+        with self._locked() as state:
+            state[2] = 0.
 
-speed_20_per_min = speed_fun(max_cnt=20)
-speed_10_per_min = speed_fun(max_cnt=9)
+
+_buckets = {}
+
+
+def limiter(api_name):
+    '''
+    每个 tushare 接口一个桶，每分钟次数见 config.RATE_LIMITS
+    '''
+    if api_name not in _buckets:
+        rate = config.RATE_LIMITS.get(api_name, config.RATE_LIMITS['*'])
+        _buckets[api_name] = TokenBucket(api_name, rate)
+    return _buckets[api_name]
+
+
+def is_throttled(e):
+    return any(s in str(e) for s in config.RATE_LIMIT_ERRORS)
+
+
+def query(api, api_name, retry=5, **kwargs):
+    '''
+    限流后调用 api.query，被限流时退避并重试
+    '''
+    bucket = limiter(api_name)
+    for i in range(retry):
+        bucket.acquire()
+        try:
+            df = api.query(api_name, **kwargs)
+        except Exception as e:
+            if not is_throttled(e) or i == retry - 1:
+                raise
+            bucket.backoff()
+            continue
+        if i:
+            bucket.reset()
+        return df